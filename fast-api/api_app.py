@@ -19,7 +19,7 @@ from typing import Optional
 from urllib.parse import quote
 import csv
 import contextvars
-import psycopg2
+from contextlib import asynccontextmanager
 from bcrypt import hashpw, gensalt
 import subprocess
 import sys
@@ -156,7 +156,6 @@ from langchain_community.chat_models import ChatOllama
 from langchain.schema import HumanMessage
 
 
-from sentence_transformers import CrossEncoder
 from rouge_score import rouge_scorer
 from bert_score import score as bert_score
 import uuid
@@ -175,16 +174,31 @@ from fastapi import HTTPException
 
 
 # Custom modules (assumed to be in your project)
-from reranker import rerank_documents  # your reranker function
+from reranker import rerank_documents, RerankService  # your reranker function
 from hybrid import Hybrid, cypher_retriever, async_cypher_retriever   # your KG retrieval
-from embedd_class import customembedding  # your custom embedding class
 from retriever import CustomChromaRetriever
-from db_utils import connect_db
+from db_pool import db, DatabaseError
+from session_cache import session_cache
+from auth_tokens import SessionTokenSigner, DEFAULT_SECRET_KEY
+from model_registry import model_registry
+from embedding_cache import CachedEmbedding
+from retrieval_cache import retrieval_cache, CORPUS_VERSIONS_DDL
+from pgvector_retriever import PGVectorRetriever, SEARCH_MODES
+from pgvector_indexes import (check_vector_indexes, check_hash_indexes, check_lexical_column,
+                              check_embedding_normalization, QUANTIZATIONS, VECTOR_QUANTIZATION)
+from unified_embeddings import UNIFIED_TABLE
+from mmap_retriever import MMapRetriever
+from dedup import deduplicator
+from mmr import mmr_selector
+from candidate_policy import candidate_policy
 
 # --- Configuration ---
-SECRET_KEY = "YOUR_SECRET_KEY"  # Replace with a strong secret in production
+SECRET_KEY = os.environ.get("SECRET_KEY", DEFAULT_SECRET_KEY)  # Replace with a strong secret in production
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_HOURS = 24  # token valid for 24 hours
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("SESSION_TOKEN_EXPIRE_MINUTES", 60))
+
+# Signed session tokens are opt-in via SESSION_TOKEN_MODE=signed (see auth_tokens.py).
+token_signer = SessionTokenSigner(SECRET_KEY, algorithm=ALGORITHM, expire_minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
 
 
@@ -196,7 +210,22 @@ SIMILARITY_THRESHOLD = 0.3
 # ------------------------------------------------------------------
 # App Setup and CORS Configuration
 # ------------------------------------------------------------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared connection pool before serving requests and close it on shutdown.
+    await db.open()
+    await initialize_pgvector()
+    await rerank_service.start()
+    await graph_db.averify()
+    try:
+        yield
+    finally:
+        await rerank_service.stop()
+        await graph_db.aclose()
+        graph_db.close()
+        await db.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Note: We're skipping the RAGAS router and using our fallback endpoint instead
 
@@ -233,45 +262,37 @@ bearer_scheme = HTTPBearer()
 # ------------------------------------------------------------------
 
 # --- Helper: Retrieve full user info from USERS_FILE ---
-def get_user_info(user_id: str):
+async def get_user_info(user_id: str):
     """
     Retrieve full user info from the PostgreSQL database based on the given user_id.
     """
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in get_user_info")
-        return None
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT user_id, username, password_hash, office_code, is_admin, disabled, created_at
-                FROM users
-                WHERE user_id = %s;
-            """, (user_id,))
-            row = cur.fetchone()
-            if row is None:
-                return None
-            user = {
-                "user_id": row[0],
-                "username": row[1],
-                "password_hash": row[2],
-                "office_code": row[3],
-                "is_admin": row[4],
-                "disabled": row[5],
-                "created_at": row[6].strftime('%Y-%m-%d %H:%M:%S') if row[6] else None
-            }
-            return user
-    except psycopg2.Error as e:
+        row = await db.fetchone("""
+            SELECT user_id, username, password_hash, office_code, is_admin, disabled, created_at
+            FROM users
+            WHERE user_id = %s;
+        """, (user_id,))
+        if row is None:
+            return None
+        user = {
+            "user_id": row[0],
+            "username": row[1],
+            "password_hash": row[2],
+            "office_code": row[3],
+            "is_admin": row[4],
+            "disabled": row[5],
+            "created_at": row[6].strftime('%Y-%m-%d %H:%M:%S') if row[6] else None
+        }
+        return user
+    except DatabaseError as e:
         print(f"Database error in get_user_info: {e}")
         return None
-    finally:
-        conn.close()
         
 def generate_token():
     """Generate a unique session token using UUID."""
     return str(uuid.uuid4())
 
-def get_current_user(authorization: str = Header(...)):
+async def get_current_user(authorization: str = Header(...)):
     """
     Retrieve and validate the session token from the Authorization header.
     If valid, return the full user info (including user_id and office_id)
@@ -279,18 +300,26 @@ def get_current_user(authorization: str = Header(...)):
     """
     session_token = authorization
 
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
+    # Signed tokens carry the user's claims and are validated without a database round trip.
+    if token_signer.enabled and token_signer.looks_signed(session_token):
+        claims = token_signer.decode(session_token)
+        if claims is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired session token")
+        return token_signer.user_info(claims)
+
+    # Serve repeat requests from the in-process cache; disabled accounts are never cached.
+    cached_user = session_cache.get(session_token)
+    if cached_user is not None:
+        return cached_user
+
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Query the sessions table to find a session with the provided token.
-            cur.execute(
+            await cur.execute(
                 "SELECT user_id, expires_at FROM sessions WHERE session_token = %s;",
                 (session_token,)
             )
-            session_row = cur.fetchone()
+            session_row = await cur.fetchone()
             if not session_row:
                 raise HTTPException(status_code=401, detail="Invalid or expired session token")
             
@@ -300,11 +329,11 @@ def get_current_user(authorization: str = Header(...)):
                 raise HTTPException(status_code=401, detail="Invalid or expired session token")
             
             # Retrieve user info from the users table.
-            cur.execute(
+            await cur.execute(
                 "SELECT user_id, username, office_code, is_admin, created_at, disabled FROM users WHERE user_id = %s;",
                 (user_id,)
             )
-            user_row = cur.fetchone()
+            user_row = await cur.fetchone()
             if not user_row:
                 raise HTTPException(status_code=404, detail="User not found")
             
@@ -313,11 +342,11 @@ def get_current_user(authorization: str = Header(...)):
                 # Log the attempt
                 print(f"API access attempt by disabled user: {user_row[1]} (ID: {user_row[0]})")
                 # Invalidate any existing sessions for this user
-                cur.execute(
+                await cur.execute(
                     "UPDATE sessions SET expires_at = %s WHERE user_id = %s;",
                     (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id)
                 )
-                conn.commit()
+                await cur.connection.commit()
                 # Return an error
                 raise HTTPException(status_code=403, detail="This account has been disabled. Please contact an administrator.")
             
@@ -331,11 +360,10 @@ def get_current_user(authorization: str = Header(...)):
                 "disabled": user_row[5]
             }
             
-            return user_info
-    except psycopg2.Error as e:
+        session_cache.put(session_token, user_info, expires_at)
+        return user_info
+    except DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
-    finally:
-        conn.close()
 
 # --- Chat History--------------- ---
 
@@ -345,21 +373,17 @@ async def load_chat_history(user_id: str, chat_id: str):
     Uses the new schema where messages are stored in chat_messages table.
     Returns a list of message objects in the same format as before for backward compatibility.
     """
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in load_chat_history")
-        return []
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Get all messages for this chat ordered by message_index
-            cur.execute("""
+            await cur.execute("""
                 SELECT cm.id, cm.message_index, cm.sender, cm.content, cm.timestamp
                 FROM chat_messages cm
                 WHERE cm.user_id = %s AND cm.chat_id = %s
                 ORDER BY cm.message_index;
             """, (user_id, chat_id))
             
-            message_rows = cur.fetchall()
+            message_rows = await cur.fetchall()
             if not message_rows:
                 return []
                 
@@ -376,13 +400,13 @@ async def load_chat_history(user_id: str, chat_id: str):
                     current_exchange["bot"] = content
                     
                     # Fetch any associated sources for this message
-                    cur.execute("""
+                    await cur.execute("""
                         SELECT title, content, url
                         FROM message_sources
                         WHERE message_id = %s;
                     """, (msg_id,))
                     
-                    source_rows = cur.fetchall()
+                    source_rows = await cur.fetchall()
                     if source_rows:
                         # Convert source rows to the format expected by the frontend
                         sources_data = {
@@ -411,11 +435,9 @@ async def load_chat_history(user_id: str, chat_id: str):
                     current_exchange = {}
                     
             return history
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"Database error in load_chat_history: {e}")
         return []
-    finally:
-        conn.close()
 
 
 @app.post('/api/chat_history')
@@ -427,40 +449,35 @@ async def add_to_chat_history(user_id: str, chat_id: str, user_message: str, bot
     - Stores user and bot messages in the chat_messages table
     - Stores associated sources in the message_sources table
     """
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Check if the chat exists
-            cur.execute(
+            await cur.execute(
                 "SELECT title FROM user_chats WHERE user_id = %s AND chat_id = %s;",
                 (user_id, chat_id)
             )
-            row = cur.fetchone()
+            row = await cur.fetchone()
             
             # If chat doesn't exist, create it with a default title
             if not row:
                 title = "Untitled Chat"
-                cur.execute(
+                await cur.execute(
                     "INSERT INTO user_chats (user_id, chat_id, title) VALUES (%s, %s, %s);",
                     (user_id, chat_id, title)
                 )
-                conn.commit()
             else:
                 title = row[0]
             
             # Get the current highest message_index for this chat
-            cur.execute(
+            await cur.execute(
                 "SELECT COALESCE(MAX(message_index), -1) FROM chat_messages WHERE user_id = %s AND chat_id = %s;",
                 (user_id, chat_id)
             )
-            max_index = cur.fetchone()[0]
+            max_index = (await cur.fetchone())[0]
             
             # Insert user message
             user_index = max_index + 1
-            cur.execute(
+            await cur.execute(
                 """
                 INSERT INTO chat_messages (user_id, chat_id, message_index, sender, content, timestamp)
                 VALUES (%s, %s, %s, %s, %s, %s)
@@ -471,7 +488,7 @@ async def add_to_chat_history(user_id: str, chat_id: str, user_message: str, bot
             
             # Insert bot message
             bot_index = user_index + 1
-            cur.execute(
+            await cur.execute(
                 """
                 INSERT INTO chat_messages (user_id, chat_id, message_index, sender, content, timestamp)
                 VALUES (%s, %s, %s, %s, %s, %s)
@@ -479,11 +496,12 @@ async def add_to_chat_history(user_id: str, chat_id: str, user_message: str, bot
                 """,
                 (user_id, chat_id, bot_index, 'bot', bot_response, datetime.now())
             )
-            bot_message_id = cur.fetchone()[0]
+            bot_message_id = (await cur.fetchone())[0]
             
             # If sources exist, store them in the message_sources table
             if sources is not None:
                 pdf_elements = sources.get('pdf_elements', [])
+                source_rows = []
                 
                 for element in pdf_elements:
                     title = element.get('name', 'Unnamed Source')
@@ -503,22 +521,21 @@ async def add_to_chat_history(user_id: str, chat_id: str, user_message: str, bot
                                     except:
                                         source_content = ""
                     
-                    cur.execute(
+                    source_rows.append((bot_message_id, title, source_content, url))
+                
+                if source_rows:
+                    await cur.executemany(
                         """
                         INSERT INTO message_sources (message_id, title, content, url)
                         VALUES (%s, %s, %s, %s);
                         """,
-                        (bot_message_id, title, source_content, url)
+                        source_rows
                     )
             
-            conn.commit()
             print(f"[DEBUG] Added messages to chat history for user_id: {user_id}, chat_id: {chat_id}")
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"[DEBUG] Error updating chat history for user_id: {user_id}, chat_id: {chat_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to update chat history: {e}")
-    finally:
-        conn.close()
 
 
 @app.get('/api/username')
@@ -536,63 +553,52 @@ async def update_username(request: Request, current_user: dict = Depends(get_cur
     if not new_username:
         raise HTTPException(status_code=400, detail="New username is required.")
     
-    # Connect to the PostgreSQL database.
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
-            # Update the username for the current user and return the new username.
-            cur.execute("""
-                UPDATE users
-                SET username = %s
-                WHERE user_id = %s
-                RETURNING username;
-            """, (new_username, current_user.get("user_id")))
-            result = cur.fetchone()
-            if not result:
-                raise HTTPException(status_code=404, detail="User not found.")
-            
-            conn.commit()
-            print("Username updated successfully for user_id:", current_user.get("user_id"))
-    except psycopg2.Error as e:
+        # Update the username for the current user and return the new username.
+        result = await db.fetchone("""
+            UPDATE users
+            SET username = %s
+            WHERE user_id = %s
+            RETURNING username;
+        """, (new_username, current_user.get("user_id")))
+        if not result:
+            raise HTTPException(status_code=404, detail="User not found.")
+        session_cache.invalidate_user(current_user.get("user_id"))
+        print("Username updated successfully for user_id:", current_user.get("user_id"))
+    except DatabaseError as e:
         print("Database error occurred while updating username:", e)
         raise HTTPException(status_code=400, detail=f"Failed to update username: {e}")
-    finally:
-        conn.close()
-        print("Database connection closed.")
     
-    return {"message": "Username updated successfully", "username": new_username}
+    response = {"message": "Username updated successfully", "username": new_username}
+    if token_signer.enabled:
+        # Signed tokens embed the username: revoke the ones carrying the old name,
+        # then hand back a token with the new claim.
+        token_signer.revoke_user(current_user.get("user_id"))
+        response["session_token"], _, _ = token_signer.issue(
+            current_user.get("user_id"), new_username, current_user.get("office_code"), current_user.get("is_admin")
+        )
+    return response
 
 @app.get("/api/offices")
 async def get_offices():
     """
     Retrieve all offices from the PostgreSQL database.
     """
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     offices = []
     try:
-        with conn.cursor() as cur:
-            # Update the query to use the correct column names
-            cur.execute("SELECT office_id, office_code, office_name FROM offices;")
-            rows = cur.fetchall()
-            for row in rows:
-                office = {
-                    "office_id": row[0],
-                    "office_code": row[1],
-                    "office_name": row[2]
-                }
-                offices.append(office)
+        # Update the query to use the correct column names
+        rows = await db.fetchall("SELECT office_id, office_code, office_name FROM offices;")
+        for row in rows:
+            office = {
+                "office_id": row[0],
+                "office_code": row[1],
+                "office_name": row[2]
+            }
+            offices.append(office)
         return offices
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"[ERROR] Database error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve offices: {e}")
-    finally:
-        conn.close()
 
 @app.post("/api/offices")
 async def update_office(request: Request, current_user: dict = Depends(get_current_user)):
@@ -607,15 +613,11 @@ async def update_office(request: Request, current_user: dict = Depends(get_curre
     if not update_data:
         raise HTTPException(status_code=400, detail="No update data provided")
     
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Verify that the office exists.
-            cur.execute("SELECT office_code FROM offices WHERE office_code = %s;", (office_code,))
-            office = cur.fetchone()
+            await cur.execute("SELECT office_code FROM offices WHERE office_code = %s;", (office_code,))
+            office = await cur.fetchone()
             if not office:
                 raise HTTPException(status_code=404, detail="Office not found")
             
@@ -629,15 +631,12 @@ async def update_office(request: Request, current_user: dict = Depends(get_curre
             values.append(office_code)
             
             update_query = f"UPDATE offices SET {', '.join(set_clauses)} WHERE office_code = %s;"
-            cur.execute(update_query, tuple(values))
-            conn.commit()
+            await cur.execute(update_query, tuple(values))
             print(f"Office with office_code {office_code} updated with data: {update_data}")
             
         return {"message": "Office updated successfully", "office": data}
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Failed to update office: {e}")
-    finally:
-        conn.close()
 
 @app.post('/api/signup')
 async def signup(request: Request):
@@ -650,16 +649,11 @@ async def signup(request: Request):
         print("Error: Username, password, and office code are required")
         return JSONResponse(content={"error": "Username, password, and office code are required"}, status_code=400)
 
-    conn = connect_db()
-    if conn is None:
-        print("Error: Database connection failed")
-        return JSONResponse(content={"error": "Database connection failed"}, status_code=500)
-
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Verify the provided office code exists.
-            cur.execute("SELECT 1 FROM offices WHERE office_code = %s;", (office_code,))
-            if not cur.fetchone():
+            await cur.execute("SELECT 1 FROM offices WHERE office_code = %s;", (office_code,))
+            if not await cur.fetchone():
                 print("Error: Invalid office code provided:", office_code)
                 return JSONResponse(content={"error": "Invalid office code"}, status_code=400)
             print("Office verified. Office Code:", office_code)
@@ -675,20 +669,16 @@ async def signup(request: Request):
             print("Password hashed successfully.")
 
             # Insert the new user record into the database using office_code.
-            cur.execute("""
+            await cur.execute("""
                 INSERT INTO users (user_id, username, password_hash, office_code, created_at)
                 VALUES (%s, %s, %s, %s, %s);
             """, (user_id, username, hashed_password, office_code, created_at))
-            conn.commit()
             print("New user inserted with ID:", user_id)
 
         return JSONResponse(content={"message": "User created successfully", "user_id": user_id}, status_code=201)
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print("Database error occurred:", e)
         return JSONResponse(content={"error": f"Failed to create user: {e}"}, status_code=400)
-    finally:
-        conn.close()
-        print("Database connection closed.")
 
 @app.post('/api/login')
 async def login(request: Request):
@@ -700,23 +690,18 @@ async def login(request: Request):
         print("Error: Username and password are required")
         return JSONResponse(content={"error": "Username and password are required"}, status_code=400)
 
-    conn = connect_db()
-    if conn is None:
-        print("Error: Database connection failed")
-        return JSONResponse(content={"error": "Database connection failed"}, status_code=500)
-
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT user_id, password_hash, is_admin, disabled FROM users WHERE username = %s;",
+        async with db.transaction() as cur:
+            await cur.execute(
+                "SELECT user_id, password_hash, is_admin, disabled, office_code FROM users WHERE username = %s;",
                 (username,)
             )
-            user_row = cur.fetchone()
+            user_row = await cur.fetchone()
             if not user_row:
                 print("Error: Invalid username or password")
                 return JSONResponse(content={"error": "Invalid username or password"}, status_code=401)
 
-            user_id, password_hash_db, is_admin, is_disabled = user_row
+            user_id, password_hash_db, is_admin, is_disabled, office_code = user_row
             
             # Check if the user account is disabled
             if is_disabled:
@@ -727,30 +712,33 @@ async def login(request: Request):
                 print("Error: Invalid username or password")
                 return JSONResponse(content={"error": "Invalid username or password"}, status_code=401)
 
-            session_token = generate_token()
-            expires_at = (datetime.now() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+            if token_signer.enabled:
+                # The sessions row records the token id so logins stay auditable;
+                # requests themselves are validated from the signature alone.
+                session_token, session_id, expires_ts = token_signer.issue(user_id, username, office_code, is_admin)
+                expires_at = datetime.fromtimestamp(expires_ts).strftime('%Y-%m-%d %H:%M:%S')
+            else:
+                session_token = generate_token()
+                session_id = session_token
+                expires_at = (datetime.now() + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
 
-            cur.execute(
+            await cur.execute(
                 """
                 INSERT INTO sessions (user_id, session_token, expires_at)
                 VALUES (%s, %s, %s);
                 """,
-                (user_id, session_token, expires_at)
+                (user_id, session_id, expires_at)
             )
-            conn.commit()
-            print(f"Session created for user_id: {user_id}, token: {session_token}")
+            print(f"Session created for user_id: {user_id}, token: {session_id}")
 
         return JSONResponse(content={
             "message": "Login successful",
             "session_token": session_token,
             "is_admin": is_admin if is_admin is not None else False
         }, status_code=200)
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"Database error during login: {e}")
         return JSONResponse(content={"error": f"Failed to login: {e}"}, status_code=500)
-    finally:
-        conn.close()
-        print("Database connection closed.")
 
 
 @app.post('/api/logout')
@@ -764,27 +752,26 @@ async def logout(Authorization: str = Header(None)):
     if not session_token:
         return JSONResponse(content={"error": "Session token required"}, status_code=401)
     
-    conn = connect_db()
-    if conn is None:
-        return JSONResponse(content={"error": "Database connection failed"}, status_code=500)
-    
+    session_cache.invalidate_token(session_token)
+    session_id = session_token
+    if token_signer.looks_signed(session_token):
+        # Signed tokens stay valid until they expire unless their id is revoked.
+        session_id = token_signer.revoke(session_token)
+        if session_id is None:
+            return JSONResponse(content={"error": "Invalid session token"}, status_code=401)
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE sessions SET expires_at = %s WHERE session_token = %s;",
-                (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), session_token)
-            )
-            if cur.rowcount == 0:
-                return JSONResponse(content={"error": "Invalid session token"}, status_code=401)
-            conn.commit()
-            print(f"[DEBUG] Session with token {session_token} expired at {datetime.now()}")
+        updated = await db.execute(
+            "UPDATE sessions SET expires_at = %s WHERE session_token = %s;",
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), session_id)
+        )
+        if updated == 0:
+            return JSONResponse(content={"error": "Invalid session token"}, status_code=401)
+        print(f"[DEBUG] Session with token {session_token} expired at {datetime.now()}")
         
         return JSONResponse(content={"message": "Logged out successfully"}, status_code=200)
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"[DEBUG] Database error during logout: {e}")
         return JSONResponse(content={"error": f"Failed to log out: {e}"}, status_code=500)
-    finally:
-        conn.close()
 
 
 
@@ -809,32 +796,28 @@ async def admin_get(user_id: Optional[str] = None, current_admin: dict = Depends
     """
     if user_id:
         # Retrieve chat history for a specific user from PostgreSQL.
-        conn = connect_db()
-        if conn is None:
-            raise HTTPException(status_code=500, detail="Database connection failed")
-            
         try:
-            with conn.cursor() as cur:
+            async with db.transaction() as cur:
                 # Get all chats for the specified user
-                cur.execute("""
+                await cur.execute("""
                     SELECT chat_id, title, username, office_code
                     FROM user_chats
                     WHERE user_id = %s;
                 """, (user_id,))
                 
-                chat_rows = cur.fetchall()
+                chat_rows = await cur.fetchall()
                 user_chat_history = {}
                 
                 # For each chat, get messages from chat_messages table
                 for chat_id, title, username, office_code in chat_rows:
-                    cur.execute("""
+                    await cur.execute("""
                         SELECT cm.id, cm.message_index, cm.sender, cm.content, cm.timestamp
                         FROM chat_messages cm
                         WHERE cm.user_id = %s AND cm.chat_id = %s
                         ORDER BY cm.message_index;
                     """, (user_id, chat_id))
                     
-                    message_rows = cur.fetchall()
+                    message_rows = await cur.fetchall()
                     messages = []
                     
                     # Format each message
@@ -847,13 +830,13 @@ async def admin_get(user_id: Optional[str] = None, current_admin: dict = Depends
                         
                         # If bot message, check for sources
                         if sender == 'bot':
-                            cur.execute("""
+                            await cur.execute("""
                                 SELECT title, content, url
                                 FROM message_sources
                                 WHERE message_id = %s;
                             """, (msg_id,))
                             
-                            source_rows = cur.fetchall()
+                            source_rows = await cur.fetchall()
                             if source_rows:
                                 sources_data = []
                                 for src_title, src_content, src_url in source_rows:
@@ -874,24 +857,19 @@ async def admin_get(user_id: Optional[str] = None, current_admin: dict = Depends
                     }
                 
                 return {"user_id": user_id, "chat_history": user_chat_history}
-        except psycopg2.Error as e:
+        except DatabaseError as e:
             print(f"[ERROR] Database error in admin_get: {e}")
             raise HTTPException(status_code=500, detail=f"Database error: {e}")
-        finally:
-            conn.close()
     else:
         # Retrieve all user accounts from PostgreSQL.
-        conn = connect_db()
-        if conn is None:
-            raise HTTPException(status_code=500, detail="Database connection failed")
         try:
-            with conn.cursor() as cur:
-                cur.execute("""
+            async with db.transaction() as cur:
+                await cur.execute("""
                     SELECT user_id, username, office_code, is_admin, created_at, disabled
                     FROM users;
                 """)
                 users = []
-                for row in cur.fetchall():
+                for row in await cur.fetchall():
                     user = {
                         "user_id": row[0],
                         "username": row[1],
@@ -902,10 +880,8 @@ async def admin_get(user_id: Optional[str] = None, current_admin: dict = Depends
                     }
                     users.append(user)
                 return {"users": users}
-        except psycopg2.Error as e:
+        except DatabaseError as e:
             raise HTTPException(status_code=500, detail=f"Failed to retrieve user accounts: {e}")
-        finally:
-            conn.close()
 
 
 # --- Admin POST Endpoint ---
@@ -927,15 +903,11 @@ async def admin_post(action_data: AdminAction, current_admin: dict = Depends(get
     This refactored version uses PostgreSQL to update user records and minimizes data loss
     by performing targeted updates.
     """
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Verify the target user exists.
-            cur.execute("SELECT is_admin FROM users WHERE user_id = %s;", (action_data.target_user_id,))
-            user_row = cur.fetchone()
+            await cur.execute("SELECT is_admin FROM users WHERE user_id = %s;", (action_data.target_user_id,))
+            user_row = await cur.fetchone()
             if user_row is None:
                 raise HTTPException(status_code=404, detail="User not found")
             
@@ -947,12 +919,12 @@ async def admin_post(action_data: AdminAction, current_admin: dict = Depends(get
             
             # Perform the appropriate action.
             if action_data.action == "disable":
-                cur.execute(
+                await cur.execute(
                     "UPDATE users SET disabled = %s WHERE user_id = %s;",
                     (True, action_data.target_user_id)
                 )
             elif action_data.action == "enable":
-                cur.execute(
+                await cur.execute(
                     "UPDATE users SET disabled = %s WHERE user_id = %s;",
                     (False, action_data.target_user_id)
                 )
@@ -960,30 +932,30 @@ async def admin_post(action_data: AdminAction, current_admin: dict = Depends(get
                 if not action_data.office_code:
                     raise HTTPException(status_code=400, detail="Office code is required for reassignment")
                 # Check if the office_code exists in the offices table first
-                cur.execute("SELECT office_id FROM offices WHERE office_code = %s;", (action_data.office_code,))
-                if cur.fetchone() is None:
+                await cur.execute("SELECT office_id FROM offices WHERE office_code = %s;", (action_data.office_code,))
+                if await cur.fetchone() is None:
                      raise HTTPException(status_code=400, detail="Invalid office code provided for reassignment")
-                cur.execute(
+                await cur.execute(
                     "UPDATE users SET office_code = %s WHERE user_id = %s;",
                     (action_data.office_code, action_data.target_user_id)
                 )
             elif action_data.action == "toggle_admin": # Added handler for toggle_admin
-                cur.execute(
+                await cur.execute(
                     "UPDATE users SET is_admin = NOT is_admin WHERE user_id = %s;",
                     (action_data.target_user_id,)
                 )
             else:
                 raise HTTPException(status_code=400, detail="Invalid action. Use 'disable', 'enable', 'reassign', or 'toggle_admin'.")
             
-            conn.commit()
-            print(f"[DEBUG] Action '{action_data.action}' completed successfully for user {action_data.target_user_id}")
+        # Every action changes fields carried in cached sessions and signed tokens
+        # (disabled, office_code, is_admin), so the user must re-authenticate.
+        session_cache.invalidate_user(action_data.target_user_id)
+        token_signer.revoke_user(action_data.target_user_id)
+        print(f"[DEBUG] Action '{action_data.action}' completed successfully for user {action_data.target_user_id}")
         
         return {"message": f"Action '{action_data.action}' completed successfully for user {action_data.target_user_id}"}
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
-    finally:
-        conn.close()
 
 
 @app.post("/api/admin/create_user")
@@ -1000,21 +972,17 @@ async def admin_create_user(request: Request, current_admin: dict = Depends(get_
     if not username or not password or not office_code:
         raise HTTPException(status_code=400, detail="Username, password, and office code are required")
 
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Check that the provided office code exists.
-            cur.execute("SELECT office_id FROM offices WHERE office_code = %s;", (office_code,))
-            office_row = cur.fetchone()
+            await cur.execute("SELECT office_id FROM offices WHERE office_code = %s;", (office_code,))
+            office_row = await cur.fetchone()
             if not office_row:
                 raise HTTPException(status_code=400, detail="Invalid office code")
             
             # Ensure the username is unique.
-            cur.execute("SELECT 1 FROM users WHERE username = %s;", (username,))
-            if cur.fetchone():
+            await cur.execute("SELECT 1 FROM users WHERE username = %s;", (username,))
+            if await cur.fetchone():
                 raise HTTPException(status_code=400, detail="Username already exists")
             
             # Hash the password and prepare other fields.
@@ -1023,17 +991,13 @@ async def admin_create_user(request: Request, current_admin: dict = Depends(get_
             created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
             # Insert the new user into the database.
-            cur.execute("""
+            await cur.execute("""
                 INSERT INTO users (user_id, username, password_hash, office_code, created_at, is_admin, disabled)
                 VALUES (%s, %s, %s, %s, %s, %s, %s);
             """, (user_id, username, hashed_password, office_code, created_at, False, False))
-            conn.commit()
             print(f"[DEBUG] New user created: {user_id}")
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Failed to create user: {e}")
-    finally:
-        conn.close()
     
     return JSONResponse(content={"message": "User created successfully"}, status_code=201)
 
@@ -1052,36 +1016,70 @@ async def admin_change_password(request: Request, current_admin: dict = Depends(
         raise HTTPException(status_code=400, detail="User ID and new password are required")
 
     # Get the target user to ensure they exist
-    target_user = get_user_info(target_user_id)
+    target_user = await get_user_info(target_user_id)
     if not target_user:
         raise HTTPException(status_code=404, detail="User not found")
         
     # Connect to the database
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Hash the new password
             hashed_password = hashpw(new_password.encode('utf-8'), gensalt()).decode('utf-8')
             
             # Update the password in the database
-            cur.execute("""
+            await cur.execute("""
                 UPDATE users 
                 SET password_hash = %s
                 WHERE user_id = %s;
             """, (hashed_password, target_user_id))
             
-            conn.commit()
             print(f"Password updated for user: {target_user_id}")
             
-            return JSONResponse(content={"message": "Password changed successfully"}, status_code=200)
+        # Force any cached sessions of this user back through the database check.
+        session_cache.invalidate_user(target_user_id)
+        token_signer.revoke_user(target_user_id)
+        return JSONResponse(content={"message": "Password changed successfully"}, status_code=200)
     except Exception as e:
         print(f"Error changing password: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to change password: {str(e)}")
-    finally:
-        conn.close()
+
+# --- Admin Metrics Endpoint ---
+@app.get("/api/admin/metrics")
+async def admin_metrics(current_admin: dict = Depends(get_current_admin_user)):
+    """
+    Runtime metrics for capacity monitoring:
+      - db_pool: connection pool size, checked-out connections, saturation and queued requests.
+      - session_cache: get_current_user cache size and hit/miss counters.
+      - session_tokens: token mode and revocation list size.
+      - models: loaded embedding/cross-encoder models and their resident memory.
+      - rerank: cross-encoder micro-batching queue depth and batch sizes.
+      - embedding_cache: query-embedding cache size, memory and hit rate.
+      - retrieval_cache: cached retrieval results, hit rate and corpus versions.
+      - vector_snapshots: loaded snapshot per dataset (RETRIEVER_BACKEND=mmap only).
+      - dedup: chunks collapsed as nested or identical duplicates before reranking.
+      - mmr: documents selected by MMR and their mean pairwise similarity before/after.
+      - candidate_policy: candidates dropped by the adaptive cutoff and rerank pairs skipped by the cascade.
+      - neo4j: KG lookup count, errors, mean latency, graph version and lookup cache, with the pool settings.
+    """
+    snapshots = {
+        dataset: config["retriever"].stats()
+        for dataset, config in DATASET_RETRIEVAL.items()
+        if isinstance(config["retriever"], MMapRetriever)
+    }
+    return {
+        "db_pool": db.stats(),
+        "session_cache": session_cache.stats(),
+        "session_tokens": token_signer.stats(),
+        "models": model_registry.stats(),
+        "rerank": rerank_service.stats(),
+        "embedding_cache": embedding_function.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "vector_snapshots": snapshots,
+        "dedup": deduplicator.stats(),
+        "mmr": mmr_selector.stats(),
+        "candidate_policy": candidate_policy.stats(),
+        "neo4j": graph_db.stats()
+    }
 
 # ------------------------------------------------------------------
 # LLM Retrieval 
@@ -1104,18 +1102,13 @@ async def async_rerank_documents(query, documents, top_n=5):
         list: List of (score, document) tuples sorted by score
     """
     try:
-        # Extract content for reranking
-        passages = [doc.page_content for doc in documents]
-        
-        # Create query-passage pairs for reranking
-        pairs = [[query, passage] for passage in passages]
+        # Score through the shared micro-batching queue (one predict for all in-flight chats).
+        # The cascade scores a prefix first and skips the tail when its top_n are clearly relevant.
+        scored_results = await candidate_policy.arerank(query, documents, rerank_service.score_pairs, top_n)
         
-        # Use asyncio to run cross-encoder in a thread pool
-        scores = await asyncio.to_thread(cross_encoder.predict, pairs)
-        
-        # Sort documents by score
-        scored_results = list(zip(scores, documents))
-        scored_results.sort(key=lambda x: x[0], reverse=True)
+        # Keep the score on the document for cached results
+        for score, doc in scored_results:
+            doc.metadata["rerank_score"] = float(score)
         
         # Return top N results
         return scored_results[:top_n]
@@ -1137,7 +1130,9 @@ async def async_get_relevant_documents(retriever, query, k=30):
         list: List of retrieved documents
     """
     try:
-        # Run the retriever in a thread pool
+        # Retrievers with an async path use the shared pool; others run in a thread pool
+        if hasattr(retriever, "aget_relevant_documents"):
+            return await retriever.aget_relevant_documents(query)
         return await asyncio.to_thread(
             lambda: retriever.get_relevant_documents(query)
         )
@@ -1145,137 +1140,134 @@ async def async_get_relevant_documents(retriever, query, k=30):
         print(f"[ERROR] Exception in document retrieval: {e}")
         return []
 
-# Initialize embedding function and vectorstores
-embedding_function = customembedding("mixedbread-ai/mxbai-embed-large-v1")
+async def reranked_pgvector_retrieval(retriever, user_message, re_rank_top=5):
+    """
+    pgvector search followed by cross-encoder reranking, without Neo4j.
+
+    With two-phase retrieval the search returns ids and rerank snippets only,
+    and full content is fetched for the top re_rank_top documents. Before reranking, the
+    candidates are cut at a clear distance break and nested duplicates are dropped; MMR
+    (when enabled) picks the final documents.
+
+    Returns:
+        Tuple[str, List[Document], int]: The context, the top documents and a KG node count of 0.
+    """
+    if retriever.two_phase:
+        query_embedding = await retriever.aembed_query(user_message)
+        raw_docs = await retriever.asearch_by_vector(query_embedding, query_text=user_message, candidates_only=True)
+    else:
+        raw_docs = await retriever.aget_relevant_documents(user_message)
+    print(f"[DEBUG] Retrieved {len(raw_docs)} docs from '{retriever.table_name}' before reranking.")
+    if not raw_docs:
+        return "", [], 0
+    raw_docs = deduplicator.dedupe(candidate_policy.shrink(raw_docs, re_rank_top))
+    scored_results = await async_rerank_documents(
+        user_message, raw_docs, top_n=mmr_selector.pool_size(re_rank_top)
+    )
+    docs = await mmr_selector.aselect(
+        retriever, [doc for score, doc in scored_results], re_rank_top,
+        scores=[float(score) for score, doc in scored_results]
+    )
+    if retriever.two_phase:
+        docs = await retriever.afetch_documents(docs)
+    return "\n\n".join([doc.page_content for doc in docs]), docs, 0
+
+async def cached_dataset_retrieval(user_message, dataset, k=30, re_rank_top=5):
+    """
+    Retrieve and rerank documents for a dataset as configured in DATASET_RETRIEVAL,
+    through the shared retrieval cache so /api/chat and /api/sources compute each
+    (query, dataset) once per corpus version.
+
+    Datasets with use_kg run async_cypher_retriever (Neo4j + pgvector); the others
+    query pgvector alone, in vector or hybrid (vector + full-text) mode.
+
+    Returns:
+        Tuple[str, List[Document], int]: The context, the top documents and the KG node count.
+    """
+    config = DATASET_RETRIEVAL[dataset]
+    retriever = config["retriever"].as_retriever(search_kwargs={
+        "k": k, "search_mode": config["search_mode"], "quantization": config["quantization"]
+    })
+    print(f"[DEBUG] Using dataset: '{dataset}' with PostgreSQL table '{retriever.table_name}' "
+          f"({config['search_mode']} search, {config['quantization']} first stage, "
+          f"Neo4j {'on' if config['use_kg'] else 'off'})")
+
+    if config["use_kg"]:
+        compute = lambda: async_cypher_retriever(
+            user_message,
+            kg=graph_db,
+            vector_retriever=retriever,
+            cross_encoder=rerank_service,
+            k=k,
+            re_rank_top=re_rank_top
+        )
+    else:
+        compute = lambda: reranked_pgvector_retrieval(retriever, user_message, re_rank_top)
+
+    # Mode and KG use are part of the key so changing the configuration never serves stale results.
+    cache_dataset = (f"{dataset}:{config['search_mode']}:{config['quantization']}:"
+                     f"{'kg' if config['use_kg'] else 'pg'}")
+    return await retrieval_cache.get_or_compute(
+        user_message, cache_dataset, retriever.table_name, k, re_rank_top, compute
+    )
+
+# Initialize embedding function and vectorstores. Query embeddings are cached so the
+# retrievers, topic-change detection, metrics and /api/sources share one computation.
+embedding_function = CachedEmbedding(model_registry.embedding())
 
 # Initialize pgvector extension 
-def initialize_pgvector():
+async def initialize_pgvector():
     """
     Initialize the pgvector extension in PostgreSQL.
-    This should be called during application startup.
+    This is called from the application lifespan once the pool is open.
     """
-    conn = connect_db()
-    if not conn:
-        print("[ERROR] Failed to connect to the database to initialize pgvector")
-        return False
-    
     try:
-        cursor = conn.cursor()
-        # Create pgvector extension if it doesn't exist
-        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
-        
-        # Verify the tables exist
-        for table_name in ["document_embeddings_combined", "document_embeddings_gs", "document_embeddings_airforce"]:
-            cursor.execute(f"""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = %s
-                )
-            """, (table_name,))
-            
-            table_exists = cursor.fetchone()[0]
-            if not table_exists:
-                print(f"[WARNING] Table {table_name} does not exist. You may need to run json2pgvector.py first.")
+        async with db.transaction() as cur:
+            # Create pgvector extension if it doesn't exist
+            await cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            
+            # Load counters bumped by json2pgvector; they invalidate the retrieval cache
+            await cur.execute(CORPUS_VERSIONS_DDL)
+            
+            # Verify the tables read by the configured retrievers exist
+            for table_name in sorted({config["retriever"].table_name for config in DATASET_RETRIEVAL.values()}):
+                await cur.execute("""
+                    SELECT EXISTS (
+                        SELECT FROM information_schema.tables 
+                        WHERE table_name = %s
+                    )
+                """, (table_name,))
+                
+                table_exists = (await cur.fetchone())[0]
+                if not table_exists:
+                    if table_name == UNIFIED_TABLE:
+                        print(f"[WARNING] Table {table_name} does not exist. Run: python unified_embeddings.py migrate")
+                    else:
+                        print(f"[WARNING] Table {table_name} does not exist. You may need to run json2pgvector.py first.")
+                    continue
+                
+                # Warn when the indexes backing the KG hash filter are missing (built offline)
+                await check_hash_indexes(cur, table_name)
+                
+                # Warn when the table lacks a vector index matching the retriever's distance
+                await check_vector_indexes(cur, table_name, sorted({
+                    config["quantization"] for config in DATASET_RETRIEVAL.values()
+                    if config["retriever"].table_name == table_name
+                }))
+                
+                # Query vectors must be normalized the same way as the stored ones
+                await check_embedding_normalization(cur, table_name, model_registry.embedding().normalize)
+                
+                # Hybrid datasets need the content_tsv column and its GIN index
+                if any(config["search_mode"] == "hybrid" and config["retriever"].table_name == table_name
+                       for config in DATASET_RETRIEVAL.values()):
+                    await check_lexical_column(cur, table_name)
         
-        conn.commit()
         print("[INFO] Successfully initialized pgvector extension")
         return True
     except Exception as e:
-        conn.rollback()
         print(f"[ERROR] Failed to initialize pgvector: {e}")
         return False
-    finally:
-        cursor.close()
-        conn.close()
-
-# Initialize pgvector on application startup
-initialize_pgvector()
-
-# Define PGVectorRetriever class
-class PGVectorRetriever:
-    def __init__(self, embedding_function, table_name="document_embeddings_combined", db_connection=None):
-        self.embedding_function = embedding_function
-        self.table_name = table_name
-        self.db_connection = db_connection
-        
-    def connect_db(self):
-        if self.db_connection is None or self.db_connection.closed:
-            self.db_connection = connect_db()
-        return self.db_connection
-    
-    def as_retriever(self, search_kwargs=None):
-        if search_kwargs is None:
-            search_kwargs = {"k": 50}
-        self.search_kwargs = search_kwargs
-        return self
-    
-    def get_relevant_documents(self, query):
-        # Get the embedding for the query
-        query_embedding = self.embedding_function.embed_query(query)
-        
-        # Convert the embedding to a format suitable for PostgreSQL
-        if isinstance(query_embedding, np.ndarray):
-            query_embedding = query_embedding.tolist()
-        
-        print(f"[DEBUG] PGVectorRetriever: Querying PostgreSQL table '{self.table_name}' for similar documents")
-        
-        # Connect to the database
-        conn = self.connect_db()
-        if conn is None:
-            print("Database connection failed in PGVectorRetriever")
-            return []
-        
-        try:
-            cursor = conn.cursor()
-            # Query the database for similar embeddings
-            cursor.execute(f"""
-                SELECT id, content, embedding <-> %s::vector AS distance, 
-                       document_title, hash_document, type, category, pdf_path,
-                       chapter_title, section_title, section_number, subsection_title
-                FROM {self.table_name}
-                ORDER BY distance
-                LIMIT %s
-            """, (json.dumps(query_embedding), self.search_kwargs.get("k", 50)))
-            
-            results = cursor.fetchall()
-            print(f"[DEBUG] PGVectorRetriever: Retrieved {len(results)} documents from '{self.table_name}'")
-            
-            # Convert the results to Document objects
-            documents = []
-            for row in results:
-                doc_id, content, distance, doc_title, hash_doc, doc_type, category, pdf_path, chapter_title, section_title, section_number, subsection_title = row
-                
-                # Create metadata dictionary
-                metadata = {
-                    "id": doc_id,
-                    "distance": distance,
-                    "document_title": doc_title,
-                    "hash_document": hash_doc,
-                    "type": doc_type,
-                    "category": category,
-                    "pdf_path": pdf_path,
-                    "chapter_title": chapter_title,
-                    "section_title": section_title,
-                    "section_number": section_number,
-                    "subsection_title": subsection_title
-                }
-                
-                # Filter out None values
-                metadata = {k: v for k, v in metadata.items() if v is not None}
-                
-                # Create a Document object
-                from langchain.schema import Document
-                document = Document(page_content=content, metadata=metadata)
-                documents.append(document)
-            
-            return documents
-        
-        except Exception as e:
-            print(f"Error in PGVectorRetriever: {e}")
-            return []
-        finally:
-            if conn:
-                conn.close()
 
 # Comment out ChromaDB retriever for reference
 # custom_retriever = Chroma(
@@ -1284,24 +1276,66 @@ class PGVectorRetriever:
 #     collection_name="kg2"
 # )
 
-# Use PGVector retriever instead
-custom_retriever = PGVectorRetriever(
-    embedding_function=embedding_function,
-    table_name="document_embeddings_combined"  # Use the combined table as default
-)
+# EMBEDDINGS_LAYOUT=unified reads every dataset from one table (see unified_embeddings.py);
+# the default keeps one table per dataset.
+EMBEDDINGS_LAYOUT = os.environ.get("EMBEDDINGS_LAYOUT", "tables").lower()
 
-# Additional retrievers for specific datasets
-airforce_retriever = PGVectorRetriever(
-    embedding_function=embedding_function,
-    table_name="document_embeddings_airforce"
-)
+# RETRIEVER_BACKEND=mmap answers searches in-process from memory-mapped snapshots of the
+# same tables (see mmap_retriever.py) instead of querying pgvector.
+RETRIEVER_BACKEND = os.environ.get("RETRIEVER_BACKEND", "pgvector").lower()
 
-gs_retriever = PGVectorRetriever(
-    embedding_function=embedding_function,
-    table_name="document_embeddings_gs"
-)
 
-cross_encoder = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+def _make_retriever(table_name, dataset=None):
+    if RETRIEVER_BACKEND == "mmap":
+        return MMapRetriever(embedding_function=embedding_function, table_name=table_name, dataset=dataset)
+    return PGVectorRetriever(embedding_function=embedding_function, table_name=table_name, dataset=dataset)
+
+
+if EMBEDDINGS_LAYOUT == "unified":
+    # "combined" searches every row with the whole-table index; the others use their partial index.
+    custom_retriever = _make_retriever(UNIFIED_TABLE)
+    airforce_retriever = _make_retriever(UNIFIED_TABLE, dataset="airforce")
+    gs_retriever = _make_retriever(UNIFIED_TABLE, dataset="gs")
+else:
+    # Use PGVector retriever instead
+    custom_retriever = _make_retriever("document_embeddings_combined")  # Use the combined table as default
+
+    # Additional retrievers for specific datasets
+    airforce_retriever = _make_retriever("document_embeddings_airforce")
+    gs_retriever = _make_retriever("document_embeddings_gs")
+
+# Per-dataset retrieval configuration. search_mode "hybrid" fuses vector and full-text
+# rankings inside Postgres (requires `python pgvector_indexes.py lexical`); use_kg=False
+# takes Neo4j out of the request path for that dataset.
+RETRIEVAL_SEARCH_MODE = os.environ.get("RETRIEVAL_SEARCH_MODE", "vector").lower()
+
+
+def _dataset_retrieval_config(retriever, env_prefix):
+    return {
+        "retriever": retriever,
+        "search_mode": os.environ.get(f"{env_prefix}_SEARCH_MODE", RETRIEVAL_SEARCH_MODE).lower(),
+        # First-stage vector representation; reduced ones are rescored at full precision.
+        "quantization": os.environ.get(f"{env_prefix}_QUANTIZATION", VECTOR_QUANTIZATION).lower(),
+        "use_kg": os.environ.get(f"{env_prefix}_USE_KG", "1").lower() not in ("0", "false", "no"),
+    }
+
+
+DATASET_RETRIEVAL = {
+    "KG": _dataset_retrieval_config(custom_retriever, "KG"),
+    "Air Force": _dataset_retrieval_config(airforce_retriever, "AIRFORCE"),
+    "GS": _dataset_retrieval_config(gs_retriever, "GS"),
+}
+for _dataset, _config in DATASET_RETRIEVAL.items():
+    if _config["search_mode"] not in SEARCH_MODES:
+        raise ValueError(f"Search mode for dataset '{_dataset}' must be one of {SEARCH_MODES}, "
+                         f"got '{_config['search_mode']}'")
+    if _config["quantization"] not in QUANTIZATIONS:
+        raise ValueError(f"Quantization for dataset '{_dataset}' must be one of {QUANTIZATIONS}, "
+                         f"got '{_config['quantization']}'")
+
+cross_encoder = model_registry.cross_encoder()
+# Coalesces rerank requests from concurrent chats; started/stopped by the lifespan handler.
+rerank_service = RerankService(cross_encoder)
 graph_db = Hybrid(uri="neo4j://62.11.241.239:7687", user="neo4j", password="password")
 
 
@@ -1319,16 +1353,21 @@ def load_llm(model_name: str, temperature: float):
     )
 
 
+def cosine_similarities(vector, matrix):
+    """Cosine similarity between one vector and each row of a matrix."""
+    vector = np.asarray(vector, dtype=np.float32)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    return (matrix @ vector) / np.maximum(norms, 1e-12)
+
 async def async_is_topic_change(user_query, recent_chat_history, embedding_function):
-    loop = asyncio.get_event_loop()
-    query_embedding = await loop.run_in_executor(None, embedding_function.embed_query, user_query)
-    for entry in recent_chat_history:
-        entry_text = f"User: {entry['user']}\nBot: {entry['bot']}"
-        entry_embedding = await loop.run_in_executor(None, embedding_function.embed_query, entry_text)
-        similarity = (await loop.run_in_executor(None, lambda: __import__("sklearn.metrics.pairwise").metrics.pairwise.cosine_similarity([query_embedding], [entry_embedding])))[0][0]
-        if similarity > SIMILARITY_THRESHOLD:
-            return False
-    return True
+    if not recent_chat_history:
+        return True
+    texts = [user_query] + [f"User: {entry['user']}\nBot: {entry['bot']}" for entry in recent_chat_history]
+    # Embed the query and all history entries in a single batched call.
+    embeddings = await asyncio.to_thread(embedding_function.embed_batch, texts)
+    similarities = cosine_similarities(embeddings[0], embeddings[1:])
+    return not bool((similarities > SIMILARITY_THRESHOLD).any())
 
 # ------------------------------------------------------------------
 # Chat Endpoints
@@ -1340,25 +1379,17 @@ async def set_chat_title(user_id: str, chat_id: str, title: str):
     If the session does not exist, create a new record with an empty history.
     Works with the new schema without a history column.
     """
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in set_chat_title")
-        return
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
+        async with db.transaction() as cur:
+            await cur.execute("""
                 INSERT INTO user_chats (user_id, chat_id, title)
                 VALUES (%s, %s, %s)
                 ON CONFLICT (user_id, chat_id) DO UPDATE
                 SET title = EXCLUDED.title;
             """, (user_id, chat_id, title))
-            conn.commit()
             print(f"[DEBUG] Set chat title for user_id: {user_id}, chat_id: {chat_id} to '{title}'")
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"Database error in set_chat_title: {e}")
-    finally:
-        conn.close()
 
 
 async def create_or_get_chat_session(user_id: str, chat_id: str, title: str, username: str, office_code: str):
@@ -1375,40 +1406,35 @@ async def create_or_get_chat_session(user_id: str, chat_id: str, title: str, use
             "messages": <list of messages>
         }
     """
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in create_or_get_chat_session")
-        return {}
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Insert a new record if one doesn't exist; otherwise, do nothing.
-            cur.execute("""
+            await cur.execute("""
                 INSERT INTO user_chats (user_id, chat_id, title, username, office_code)
                 VALUES (%s, %s, %s, %s, %s)
                 ON CONFLICT (user_id, chat_id) DO NOTHING;
             """, (user_id, chat_id, title, username, office_code))
-            conn.commit()
             
             # Retrieve the chat session record
-            cur.execute("""
+            await cur.execute("""
                 SELECT chat_id, title, username, office_code
                 FROM user_chats
                 WHERE user_id = %s AND chat_id = %s;
             """, (user_id, chat_id))
-            row = cur.fetchone()
+            row = await cur.fetchone()
             
             if row:
                 chat_id, title, username, office_code = row
                 
                 # Now get messages for this chat
-                cur.execute("""
+                await cur.execute("""
                     SELECT cm.id, cm.sender, cm.content, cm.timestamp
                     FROM chat_messages cm
                     WHERE cm.user_id = %s AND cm.chat_id = %s
                     ORDER BY cm.message_index;
                 """, (user_id, chat_id))
                 
-                message_rows = cur.fetchall()
+                message_rows = await cur.fetchall()
                 messages = []
                 
                 # Process each message
@@ -1421,13 +1447,13 @@ async def create_or_get_chat_session(user_id: str, chat_id: str, title: str, use
                     
                     # Check for sources if this is a bot message
                     if sender == 'bot':
-                        cur.execute("""
+                        await cur.execute("""
                             SELECT title, content, url
                             FROM message_sources
                             WHERE message_id = %s;
                         """, (msg_id,))
                         
-                        source_rows = cur.fetchall()
+                        source_rows = await cur.fetchall()
                         if source_rows:
                             message["hasSources"] = True
                             
@@ -1455,12 +1481,9 @@ async def create_or_get_chat_session(user_id: str, chat_id: str, title: str, use
                 return chat_session
             else:
                 return {}
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"Database error in create_or_get_chat_session: {e}")
         return {}
-    finally:
-        conn.close()
 
 
 def generate_chat_id():
@@ -1483,33 +1506,29 @@ def load_personality(personality: str) -> str:
 async def get_chat_histories(current_user: dict = Depends(get_current_user)):
     uid = current_user.get("user_id")
     
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # First get all chat sessions for this user
-            cur.execute("""
+            await cur.execute("""
                 SELECT chat_id, title, username, office_code
                 FROM user_chats
                 WHERE user_id = %s;
             """, (uid,))
-            chat_rows = cur.fetchall()
+            chat_rows = await cur.fetchall()
             
             # Build the user_chats dictionary
             user_chats = {}
             
             for chat_id, title, username, office_code in chat_rows:
                 # For each chat, get all its messages from chat_messages table
-                cur.execute("""
+                await cur.execute("""
                     SELECT cm.id, cm.message_index, cm.sender, cm.content, cm.timestamp
                     FROM chat_messages cm
                     WHERE cm.user_id = %s AND cm.chat_id = %s
                     ORDER BY cm.message_index;
                 """, (uid, chat_id))
                 
-                message_rows = cur.fetchall()
+                message_rows = await cur.fetchall()
                 messages = []
                 
                 # Process each message
@@ -1523,13 +1542,13 @@ async def get_chat_histories(current_user: dict = Depends(get_current_user)):
                     
                     # If this is a bot message, check for associated sources
                     if sender == 'bot':
-                        cur.execute("""
+                        await cur.execute("""
                             SELECT title, content, url
                             FROM message_sources
                             WHERE message_id = %s;
                         """, (msg_id,))
                         
-                        source_rows = cur.fetchall()
+                        source_rows = await cur.fetchall()
                         if source_rows:
                             # Format sources for frontend
                             sources_data = {
@@ -1565,11 +1584,9 @@ async def get_chat_histories(current_user: dict = Depends(get_current_user)):
                 }
             
             return user_chats
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"[ERROR] Database error in get_chat_histories: {e}")
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
-    finally:
-        conn.close()
 
 
 @app.post("/api/chat/histories")
@@ -1581,28 +1598,23 @@ async def create_chat_history(request: Request, current_user: dict = Depends(get
     username = current_user.get("username")
     office_code = current_user.get("office_code")
     
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-        
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Check if chat exists
-            cur.execute(
+            await cur.execute(
                 "SELECT chat_id FROM user_chats WHERE user_id = %s AND chat_id = %s",
                 (user_id, chat_id)
             )
             
-            if cur.fetchone() is None:
+            if await cur.fetchone() is None:
                 # Create new chat record
-                cur.execute(
+                await cur.execute(
                     """
                     INSERT INTO user_chats (user_id, chat_id, title, username, office_code)
                     VALUES (%s, %s, %s, %s, %s);
                     """,
                     (user_id, chat_id, chat_title, username, office_code)
                 )
-                conn.commit()
                 
             # Return basic chat session info
             session = {
@@ -1614,12 +1626,9 @@ async def create_chat_history(request: Request, current_user: dict = Depends(get
             }
             
             return session
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"[ERROR] Database error in create_chat_history: {e}")
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
-    finally:
-        conn.close()
 
 
 # --- New Endpoint to get available personas ---
@@ -1800,82 +1809,30 @@ async def chat_stream(request: Request, current_user: dict = Depends(get_current
             print("[DEBUG] Dataset is 'None', skipping document retrieval.")
             node_count = 0 # Set node_count to 0 when retrieval is skipped
             pass # Explicitly do nothing for retrieval
-        elif dataset_option == "KG": # Changed from if to elif
-            # Use Neo4j with the default combined pgvector retriever
-            print(f"[DEBUG] Using dataset: 'KG' with Neo4j and PostgreSQL table: 'document_embeddings_combined'")
-            context, retrieved_docs, node_count = await async_cypher_retriever(
-                    user_message,
-                    kg=graph_db,
-                    vector_retriever=custom_retriever.as_retriever(search_kwargs={"k": 30}),
-                    cross_encoder=cross_encoder,
-                    k=30,
-                    re_rank_top=5
-                )
-            # node_count is now captured here
-            print(f"[DEBUG] Retrieved {node_count} nodes (hashes) from the knowledge graph.")
-            print("[DEBUG] Top 5 reranked documents passed to the LLM:")
-            for idx, doc in enumerate(retrieved_docs, 1):
-                snippet = doc.page_content[:200].replace("\n", " ")
-                print(f"Document {idx}: {snippet}...")
-        elif dataset_option == "Air Force":
-            # Use Neo4j with the Air Force specific retriever
-            print(f"[DEBUG] Using dataset: 'Air Force' with Neo4j and PostgreSQL table: 'document_embeddings_airforce'")
-            context, retrieved_docs, node_count = await async_cypher_retriever(
-                    user_message,
-                    kg=graph_db,
-                    vector_retriever=airforce_retriever.as_retriever(search_kwargs={"k": 30}),
-                    cross_encoder=cross_encoder,
-                    k=30,
-                    re_rank_top=5
-                )
-            # node_count is now captured here
-            print(f"[DEBUG] Retrieved {node_count} nodes (hashes) from the knowledge graph (AirForce).")
-            print("[DEBUG] Top 5 reranked AirForce documents passed to the LLM:")
-            for idx, doc in enumerate(retrieved_docs, 1):
-                snippet = doc.page_content[:200].replace("\n", " ")
-                print(f"Document {idx}: {snippet}...")
-        elif dataset_option == "GS":
-            # Use Neo4j with the GS specific retriever
-            print(f"[DEBUG] Using dataset: 'GS' with Neo4j and PostgreSQL table: 'document_embeddings_gs'")
-            context, retrieved_docs, node_count = await async_cypher_retriever(
-                    user_message,
-                    kg=graph_db,
-                    vector_retriever=gs_retriever.as_retriever(search_kwargs={"k": 30}),
-                    cross_encoder=cross_encoder,
-                    k=30,
-                    re_rank_top=5
+        elif dataset_option in DATASET_RETRIEVAL:
+            # KG, Air Force and GS: table, search mode and Neo4j use come from DATASET_RETRIEVAL
+            context, retrieved_docs, node_count = await cached_dataset_retrieval(
+                    user_message, dataset_option, k=30, re_rank_top=5
                 )
             # node_count is now captured here
-            print(f"[DEBUG] Retrieved {node_count} nodes (hashes) from the knowledge graph (GS).")
-            print("[DEBUG] Top 5 reranked GS documents passed to the LLM:")
+            print(f"[DEBUG] Retrieved {node_count} nodes (hashes) from the knowledge graph ({dataset_option}).")
+            print(f"[DEBUG] Top {len(retrieved_docs)} reranked {dataset_option} documents passed to the LLM:")
             for idx, doc in enumerate(retrieved_docs, 1):
                 snippet = doc.page_content[:200].replace("\n", " ")
                 print(f"Document {idx}: {snippet}...")
         else: # Handles other cases or unexpected values - use combined as default
             # Use the default combined pgvector retriever without Neo4j
-            print(f"[DEBUG] Using fallback dataset option: '{dataset_option}' - defaulting to PostgreSQL table: 'document_embeddings_combined' without Neo4j")
-            node_count = 0 # Set node_count to 0 as Neo4j wasn't used
-            raw_docs = await loop.run_in_executor(
-                None,
-                lambda: custom_retriever.as_retriever(search_kwargs={"k": 30}).get_relevant_documents(user_message)
+            print(f"[DEBUG] Using fallback dataset option: '{dataset_option}' - defaulting to PostgreSQL table: '{custom_retriever.table_name}' without Neo4j")
+            context, retrieved_docs, node_count = await retrieval_cache.get_or_compute(
+                user_message, "combined", custom_retriever.table_name, 30, 5,
+                lambda: reranked_pgvector_retrieval(custom_retriever.as_retriever(search_kwargs={"k": 30}), user_message, 5)
             )
-            print(f"[DEBUG] Retrieved {len(raw_docs)} docs from combined retriever before reranking.")
-
-            # Rerank the retrieved documents.
-            if raw_docs:
-                 scored_results = await async_rerank_documents(user_message, raw_docs)
-                 retrieved_docs = [doc for score, doc in scored_results[:5]] # Assign reranked docs
-                 context = "\n\n".join([doc.page_content for doc in retrieved_docs])
+            if retrieved_docs:
                  print(f"[DEBUG] Selected top {len(retrieved_docs)} documents after reranking.")
-                 if retrieved_docs:
-                     first_snippet = retrieved_docs[0].page_content[:200].replace("\n", " ")
-                     print(f"[DEBUG] First combined doc snippet: {first_snippet}...")
-                 else:
-                     print("[DEBUG] No documents selected after reranking.")
+                 first_snippet = retrieved_docs[0].page_content[:200].replace("\n", " ")
+                 print(f"[DEBUG] First combined doc snippet: {first_snippet}...")
             else:
                 print("[DEBUG] No documents retrieved from combined retriever.")
-                retrieved_docs = [] # Ensure it's empty if raw_docs was empty
-                context = "" # Ensure context is empty
                 
     except Exception as e:
         print(f"[ERROR] Exception in document retrieval: {e}")
@@ -2015,25 +1972,16 @@ async def chat_stream(request: Request, current_user: dict = Depends(get_current
         try:
             print("[DEBUG /api/chat] Preparing analytics payload...")
             # ... (existing code to get actual_title) ...
-            conn = connect_db()
             actual_title = chat_id  # Default to chat_id if lookup fails
-            if conn:
-                try:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "SELECT title FROM user_chats WHERE user_id = %s AND chat_id = %s;",
-                            (user_id, chat_id)
-                        )
-                        row = cur.fetchone()
-                        if row and row[0]:
-                            actual_title = row[0]
-                except Exception as title_error:
-                    print(f"[ERROR] Error fetching chat title: {title_error}")
-                finally:
-                    if conn:
-                       conn.close()
-            else: 
-                 print("[WARNING] Failed to connect to DB for title lookup")
+            try:
+                row = await db.fetchone(
+                    "SELECT title FROM user_chats WHERE user_id = %s AND chat_id = %s;",
+                    (user_id, chat_id)
+                )
+                if row and row[0]:
+                    actual_title = row[0]
+            except Exception as title_error:
+                print(f"[ERROR] Error fetching chat title: {title_error}")
 
             current_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
             print(f"[DEBUG /api/chat] Value of user_message before AnalyticsInput: {user_message}") 
@@ -2172,20 +2120,17 @@ async def get_sources(request: Request, current_user: dict = Depends(get_current
     try:
         loop = asyncio.get_event_loop()
         if dataset_option == "KG":
-            # Offload the blocking cypher_retriever call to a separate thread via run_in_executor.
-            context, retrieved_docs, node_count = await async_cypher_retriever(
-                    user_message,
-                    kg=graph_db,
-                    vector_retriever=custom_retriever.as_retriever(search_kwargs={"k": 30}),
-                    cross_encoder=cross_encoder,
-                    k=30,
-                    re_rank_top=5
+            # Served from the retrieval cache when /api/chat just answered the same question.
+            context, retrieved_docs, node_count = await cached_dataset_retrieval(
+                    user_message, "KG", k=30, re_rank_top=5
                 )
         else:
             # Since there is no J1 dataset, use the custom retriever for the non-KG branch.
-            retrieved_docs = await loop.run_in_executor(
-                None,
-                lambda: custom_retriever.as_retriever(search_kwargs={"k": 30}).get_relevant_documents(user_message)
+            async def unranked_retrieval():
+                docs = await custom_retriever.as_retriever(search_kwargs={"k": 30}).aget_relevant_documents(user_message)
+                return "", docs, 0
+            _, retrieved_docs, _ = await retrieval_cache.get_or_compute(
+                user_message, "sources", custom_retriever.table_name, 30, None, unranked_retrieval
             )
     except Exception as e:
         print(f"[ERROR] Exception in document retrieval: {e}")
@@ -2308,25 +2253,20 @@ async def get_user_preferences(current_user: dict = Depends(get_current_user)):
     """
     user_id = current_user.get("user_id")
     
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Check if user preferences exist
-            cur.execute("SELECT selected_model, temperature, dataset, persona FROM user_preferences WHERE user_id = %s;", (user_id,))
-            row = cur.fetchone()
+            await cur.execute("SELECT selected_model, temperature, dataset, persona FROM user_preferences WHERE user_id = %s;", (user_id,))
+            row = await cur.fetchone()
             
             if row is None:
                 # Create default preferences if none exist
-                cur.execute("""
+                await cur.execute("""
                     INSERT INTO user_preferences (user_id, selected_model, temperature, dataset, persona)
                     VALUES (%s, %s, %s, %s, %s)
                     RETURNING selected_model, temperature, dataset, persona;
                 """, (user_id, "mistral:latest", 1.0, "KG", "None"))
-                row = cur.fetchone()
-                conn.commit()
+                row = await cur.fetchone()
                 print(f"[DEBUG] Created default preferences for user {user_id}")
             
             preferences = {
@@ -2337,11 +2277,9 @@ async def get_user_preferences(current_user: dict = Depends(get_current_user)):
             }
             
             return preferences
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"[ERROR] Database error in get_user_preferences: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve user preferences: {e}")
-    finally:
-        conn.close()
 
 @app.post("/api/user/preferences")
 async def update_user_preferences(request: Request, current_user: dict = Depends(get_current_user)):
@@ -2374,15 +2312,11 @@ async def update_user_preferences(request: Request, current_user: dict = Depends
     if not update_data:
         raise HTTPException(status_code=400, detail="No valid preference data provided")
     
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
-    
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Check if preferences exist
-            cur.execute("SELECT 1 FROM user_preferences WHERE user_id = %s;", (user_id,))
-            exists = cur.fetchone() is not None
+            await cur.execute("SELECT 1 FROM user_preferences WHERE user_id = %s;", (user_id,))
+            exists = await cur.fetchone() is not None
             
             if exists:
                 # Build update query dynamically
@@ -2401,7 +2335,7 @@ async def update_user_preferences(request: Request, current_user: dict = Depends
                 
                 # Execute update
                 update_query = f"UPDATE user_preferences SET {', '.join(set_clauses)} WHERE user_id = %s;"
-                cur.execute(update_query, tuple(values))
+                await cur.execute(update_query, tuple(values))
             else:
                 # Create new preferences
                 default_values = {
@@ -2415,7 +2349,7 @@ async def update_user_preferences(request: Request, current_user: dict = Depends
                 for key, value in update_data.items():
                     default_values[key] = value
                 
-                cur.execute("""
+                await cur.execute("""
                     INSERT INTO user_preferences 
                     (user_id, selected_model, temperature, dataset, persona, created_at, updated_at)
                     VALUES (%s, %s, %s, %s, %s, %s, %s);
@@ -2429,11 +2363,10 @@ async def update_user_preferences(request: Request, current_user: dict = Depends
                     datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 ))
             
-            conn.commit()
             
             # Return updated preferences
-            cur.execute("SELECT selected_model, temperature, dataset, persona FROM user_preferences WHERE user_id = %s;", (user_id,))
-            row = cur.fetchone()
+            await cur.execute("SELECT selected_model, temperature, dataset, persona FROM user_preferences WHERE user_id = %s;", (user_id,))
+            row = await cur.fetchone()
             
             updated_preferences = {
                 "selected_model": row[0],
@@ -2443,12 +2376,9 @@ async def update_user_preferences(request: Request, current_user: dict = Depends
             }
             
             return updated_preferences
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"[ERROR] Database error in update_user_preferences: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to update user preferences: {e}")
-    finally:
-        conn.close()
 
 # ------------------------------------------------------------------
 # Feedback Endpoints
@@ -2475,15 +2405,10 @@ async def update_analytics_feedback(user_id, chat_id, title, question, feedback_
     """
     print(f"[DEBUG] Updating analytics feedback to '{feedback_type}' for user_id={user_id}, chat_id={chat_id}, question={question}")
     
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in update_analytics_feedback")
-        return False
-
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # First, check if the analytics entry exists
-            cur.execute("""
+            await cur.execute("""
                 SELECT id FROM analytics
                 WHERE 
                     user_id = %s AND 
@@ -2495,13 +2420,13 @@ async def update_analytics_feedback(user_id, chat_id, title, question, feedback_
                 question
             ))
             
-            row = cur.fetchone()
+            row = await cur.fetchone()
             if not row:
                 print(f"[WARNING] No analytics entry found to update feedback for user_id={user_id}, chat_id={chat_id}, question={question}")
                 return False
             
             # Update only the feedback column in the analytics table
-            cur.execute("""
+            await cur.execute("""
                 UPDATE analytics
                 SET feedback = %s
                 WHERE 
@@ -2516,24 +2441,19 @@ async def update_analytics_feedback(user_id, chat_id, title, question, feedback_
             ))
             
             updated_rows = cur.rowcount
-            conn.commit()
             
             print(f"[DEBUG] Analytics table feedback updated successfully: {updated_rows} rows affected")
             return updated_rows > 0
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"[ERROR] Database error in update_analytics_feedback: {e}")
-        print(f"[ERROR] Error details - pgcode: {e.pgcode}, pgerror: {e.pgerror}")
+        print(f"[ERROR] Error details - sqlstate: {e.sqlstate}, message: {e.diag.message_primary}")
         return False
     except Exception as e:
-        conn.rollback()
         print(f"[ERROR] General error in update_analytics_feedback: {e}")
         return False
-    finally:
-        conn.close()
 
 
-def log_feedback(question, answer, feedback_type, sources, elapsed_time, user_id, title, username, office_code, chat_id, node_count=None, 
+async def log_feedback(question, answer, feedback_type, sources, elapsed_time, user_id, title, username, office_code, chat_id, node_count=None, 
                faithfulness=None, answer_relevancy=None, context_relevancy=None, context_precision=None, context_recall=None, harmfulness=None): # Add RAGAS metrics parameters
     if not question or not answer:
         print("Error: Missing question or answer for feedback logging.")
@@ -2579,15 +2499,10 @@ def log_feedback(question, answer, feedback_type, sources, elapsed_time, user_id
     }
     print(f"Feedback Data for Update/Insert: {feedback_data}")
 
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in log_feedback")
-        return
-
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # INSERT into feedback table only - the analytics update is handled separately
-            cur.execute("""
+            await cur.execute("""
                 INSERT INTO feedback 
                 (question, answer, feedback, sources, rouge1, rouge2, rougel, bert_p, bert_r, bert_f1, cosine_similarity, response_time, 
                 user_id, title, username, office_code, chat_id, timestamp, node_count, 
@@ -2620,43 +2535,31 @@ def log_feedback(question, answer, feedback_type, sources, elapsed_time, user_id
                 feedback_data["context_recall"],
                 feedback_data["harmfulness"]
             ))
-            conn.commit()
             print("Feedback logged successfully to feedback table.")
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"Database error in log_feedback: {e}")
-        print(f"Error details - pgcode: {e.pgcode}, pgerror: {e.pgerror}") # Add detailed error logging
+        print(f"Error details - sqlstate: {e.sqlstate}, message: {e.diag.message_primary}") # Add detailed error logging
     except Exception as e:
-        conn.rollback()
         print(f"General error in log_feedback: {e}") # Add detailed error logging
-    finally:
-        conn.close()
 
 
 async def fetch_node_count_for_feedback(user_id, chat_id, question):
     """Helper function to fetch node_count from the analytics table."""
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in fetch_node_count_for_feedback")
-        return None
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Fetch the latest analytics entry matching the criteria
-            cur.execute("""
+            await cur.execute("""
                 SELECT node_count 
                 FROM analytics
                 WHERE user_id = %s AND chat_id = %s AND question = %s
                 ORDER BY timestamp DESC
                 LIMIT 1;
             """, (user_id, chat_id, question))
-            row = cur.fetchone()
+            row = await cur.fetchone()
             return row[0] if row else None
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         print(f"Database error fetching node_count: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
 @app.post("/api/feedback/positive")
 async def positive_feedback(feedback: FeedbackInput, current_user: dict = Depends(get_current_user)):
@@ -2674,7 +2577,7 @@ async def positive_feedback(feedback: FeedbackInput, current_user: dict = Depend
         node_count = await fetch_node_count_for_feedback(user_id, chat_id, question_text)
         
         # Log feedback to the feedback table, including node_count
-        log_feedback(
+        await log_feedback(
             question_text,
             feedback.answer,
             "positive",
@@ -2765,7 +2668,7 @@ async def negative_feedback(feedback: FeedbackInput, current_user: dict = Depend
         node_count = await fetch_node_count_for_feedback(user_id, chat_id, question_text)
 
         # Log feedback to the feedback table
-        log_feedback(
+        await log_feedback(
             question_text,
             feedback.answer,
             "negative",
@@ -2855,7 +2758,7 @@ async def neutral_feedback(feedback: FeedbackInput, current_user: dict = Depends
         node_count = await fetch_node_count_for_feedback(user_id, chat_id, question_text)
 
         # Log feedback to the feedback table
-        log_feedback(
+        await log_feedback(
             question_text,
             feedback.answer,
             "neutral",
@@ -3014,14 +2917,9 @@ async def log_analytics(question, answer, feedback_type, sources, elapsed_time,
     RETURNING id
     """
     
-    conn = connect_db()
-    if conn is None:
-        print("Database connection failed in log_analytics")
-        return
-
     try:
-        with conn.cursor() as cur:
-            cur.execute(query, (
+        async with db.transaction() as cur:
+            await cur.execute(query, (
                 values["question"],
                 values["answer"],
                 values["feedback"],
@@ -3051,8 +2949,7 @@ async def log_analytics(question, answer, feedback_type, sources, elapsed_time,
                 values["harmfulness"]
             ))
             # Get the inserted record ID
-            analytics_id = cur.fetchone()[0]
-            conn.commit()
+            analytics_id = (await cur.fetchone())[0]
             print("Analytics logged successfully to analytics table.")
             
             # Trigger RAGAS evaluation if available and metrics are not already set
@@ -3102,15 +2999,11 @@ async def log_analytics(question, answer, feedback_type, sources, elapsed_time,
                 except Exception as e:
                     print(f"Error preparing RAGAS evaluation: {e}")
             
-    except psycopg2.Error as e:
-        conn.rollback()
+    except DatabaseError as e:
         print(f"Database error while logging analytics: {e}")
-        print(f"Error details - pgcode: {e.pgcode}, pgerror: {e.pgerror}")
+        print(f"Error details - sqlstate: {e.sqlstate}, message: {e.diag.message_primary}")
     except Exception as e:
-        conn.rollback()
         print(f"General error while logging analytics: {e}")
-    finally:
-        conn.close()
 
 
 @app.get("/api/analytics")
@@ -3119,13 +3012,10 @@ async def get_analytics(current_user: dict = Depends(get_current_user)):
     Retrieve all stored analytics records from the PostgreSQL database.
     Now reads directly from the analytics table which includes feedback/metrics.
     """
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Select directly from analytics table, including node_count and RAGAS metrics
-            cur.execute("""
+            await cur.execute("""
                 SELECT 
                     user_id, 
                     title, 
@@ -3157,7 +3047,7 @@ async def get_analytics(current_user: dict = Depends(get_current_user)):
                 FROM analytics
                 ORDER BY timestamp DESC; 
             """)
-            rows = cur.fetchall()
+            rows = await cur.fetchall()
             analytics_records = []
             for row in rows:
                 # Map row columns to dictionary keys
@@ -3192,10 +3082,8 @@ async def get_analytics(current_user: dict = Depends(get_current_user)):
                 }
                 analytics_records.append(record)
             return analytics_records
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
-    finally:
-        conn.close()
 
 
 @app.post("api/UserAnalytics")
@@ -3203,12 +3091,8 @@ def compute_metrics(prediction, reference, embedding_function, elapsed_time):
     rouge = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
     rouge_scores = rouge.score(reference, prediction)
     bert_p, bert_r, bert_f1 = bert_score([prediction], [reference], lang="en", verbose=True)
-    prediction_embedding = embedding_function.embed_query(prediction)
-    reference_embedding = embedding_function.embed_query(reference)
-    # Correctly extract the scalar value using [0][0]
-    cosine_sim_value = (lambda: 
-        __import__("sklearn.metrics.pairwise").metrics.pairwise.cosine_similarity([prediction_embedding], [reference_embedding])
-    )()[0][0]
+    prediction_embedding, reference_embedding = embedding_function.embed_batch([prediction, reference])
+    cosine_sim_value = float(cosine_similarities(prediction_embedding, [reference_embedding])[0])
     metrics = {
         "rouge1": rouge_scores['rouge1'].fmeasure,
         "rouge2": rouge_scores['rouge2'].fmeasure,
@@ -3231,13 +3115,10 @@ async def get_ragas_analytics(current_user: dict = Depends(get_current_user)):
     Retrieve RAGAS metrics directly from the analytics table.
     This endpoint provides access to RAGAS data even without the full RAGAS router.
     """
-    conn = connect_db()
-    if conn is None:
-        raise HTTPException(status_code=500, detail="Database connection failed")
     try:
-        with conn.cursor() as cur:
+        async with db.transaction() as cur:
             # Select records with RAGAS metrics
-            cur.execute("""
+            await cur.execute("""
                 SELECT 
                     user_id, chat_id, question, answer, 
                     faithfulness, answer_relevancy, context_relevancy,
@@ -3252,7 +3133,7 @@ async def get_ragas_analytics(current_user: dict = Depends(get_current_user)):
                    OR harmfulness IS NOT NULL
                 ORDER BY timestamp DESC;
             """)
-            rows = cur.fetchall()
+            rows = await cur.fetchall()
             
             ragas_data = []
             for row in rows:
@@ -3288,8 +3169,6 @@ async def get_ragas_analytics(current_user: dict = Depends(get_current_user)):
     except Exception as e:
         print(f"[ERROR] Database error in get_ragas_analytics: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve RAGAS analytics: {e}")
-    finally:
-        conn.close()
 
 
 # ------------------------------------------------------------------
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+import uuid
+
+from jose import jwt, JWTError
+
+# Placeholder SECRET_KEY shipped in api_app.py; never acceptable for signed tokens.
+DEFAULT_SECRET_KEY = "YOUR_SECRET_KEY"
+
+
+class TokenRevocationList:
+    """
+    In-process revocation list for signed session tokens.
+
+    Two kinds of entries are kept:
+      - individual token ids (jti), added on logout and kept only until the
+        token would have expired anyway;
+      - a per-user "revoked before" timestamp, set when an account is disabled,
+        its password is changed or its claims (office, admin flag) change, which
+        kills every token issued to that user up to that moment.
+
+    The list lives in the API process, so deployments running several workers
+    should keep signed tokens short-lived (SESSION_TOKEN_EXPIRE_MINUTES).
+    """
+
+    def __init__(self):
+        self._revoked_jtis = {}  # jti -> exp (epoch seconds)
+        self._revoked_users = {}  # user_id -> revoked_at (epoch seconds)
+        self._lock = threading.Lock()
+
+    def revoke_token(self, jti, exp):
+        with self._lock:
+            self._revoked_jtis[jti] = exp
+            self._prune(time.time())
+
+    def revoke_user(self, user_id):
+        with self._lock:
+            self._revoked_users[str(user_id)] = time.time()
+
+    def is_revoked(self, claims):
+        with self._lock:
+            if claims.get("jti") in self._revoked_jtis:
+                return True
+            revoked_at = self._revoked_users.get(str(claims.get("sub")))
+            # Strictly before: a token re-issued right after revoke_user (e.g. username change) stays valid.
+            return revoked_at is not None and claims.get("iat", 0) < revoked_at
+
+    def _prune(self, now):
+        expired = [jti for jti, exp in self._revoked_jtis.items() if exp <= now]
+        for jti in expired:
+            del self._revoked_jtis[jti]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "revoked_tokens": len(self._revoked_jtis),
+                "revoked_users": len(self._revoked_users),
+            }
+
+
+class SessionTokenSigner:
+    """
+    Issues and validates signed (JWT) session tokens.
+
+    A signed token carries the claims get_current_user needs (user_id,
+    username, office_code, is_admin), so validating it requires no database
+    round trip. Tokens are short-lived and can still be killed early through
+    the revocation list.
+
+    Configuration (environment variables):
+        SESSION_TOKEN_MODE             "opaque" (default, uuid tokens checked against
+                                       the sessions table) or "signed"
+        SECRET_KEY                     HMAC secret used to sign tokens (required in signed
+                                       mode; the placeholder default is rejected)
+        SESSION_TOKEN_EXPIRE_MINUTES   lifetime of a signed token (default 60)
+    """
+
+    def __init__(self, secret_key, algorithm="HS256", expire_minutes=None, mode=None):
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.expire_minutes = expire_minutes if expire_minutes is not None else int(os.environ.get("SESSION_TOKEN_EXPIRE_MINUTES", 60))
+        self.mode = (mode or os.environ.get("SESSION_TOKEN_MODE", "opaque")).lower()
+        self.revocations = TokenRevocationList()
+        if self.enabled and (not secret_key or secret_key == DEFAULT_SECRET_KEY):
+            # Anyone can sign tokens with a public placeholder key, including is_admin ones.
+            raise RuntimeError("SESSION_TOKEN_MODE=signed requires SECRET_KEY to be set to a private value")
+
+    @property
+    def enabled(self):
+        return self.mode == "signed"
+
+    @staticmethod
+    def looks_signed(token):
+        """A JWT has three dot-separated segments; uuid session tokens have none."""
+        return token is not None and token.count(".") == 2
+
+    def issue(self, user_id, username, office_code, is_admin):
+        """
+        Create a signed token for the given user.
+
+        Returns:
+            tuple: (token, jti, expires_at) where expires_at is epoch seconds.
+        """
+        now = time.time()
+        jti = str(uuid.uuid4())
+        expires_at = int(now + self.expire_minutes * 60)
+        claims = {
+            "sub": str(user_id),
+            "username": username,
+            "office_code": office_code,
+            "is_admin": bool(is_admin),
+            "jti": jti,
+            "iat": now,
+            "exp": expires_at,
+        }
+        token = jwt.encode(claims, self.secret_key, algorithm=self.algorithm)
+        return token, jti, expires_at
+
+    def decode(self, token):
+        """
+        Validate a signed token and return its claims, or None if the signature
+        is invalid, the token has expired or it has been revoked.
+        """
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except JWTError:
+            return None
+        if self.revocations.is_revoked(claims):
+            return None
+        return claims
+
+    @staticmethod
+    def user_info(claims):
+        """Build the same user_info shape get_current_user returns for opaque tokens."""
+        return {
+            "user_id": claims["sub"],
+            "username": claims.get("username"),
+            "office_code": claims.get("office_code"),
+            "is_admin": claims.get("is_admin", False),
+            "created_at": None,
+            "disabled": False,
+        }
+
+    def revoke(self, token):
+        """Revoke a single token (logout). Returns its jti, or None if the token is not valid."""
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except JWTError:
+            return None
+        self.revocations.revoke_token(claims["jti"], claims["exp"])
+        return claims["jti"]
+
+    def revoke_user(self, user_id):
+        self.revocations.revoke_user(user_id)
+
+    def stats(self):
+        stats = {"mode": self.mode, "expire_minutes": self.expire_minutes}
+        stats.update(self.revocations.stats())
+        return stats
@@ -0,0 +1,122 @@
+"""
+Recall and latency of the vector search layouts of one table.
+
+For each layout (full-precision index, halfvec index + rescoring, binary index +
+rescoring), the same queries go through PGVectorRetriever's SQL. Results are
+compared with an exact sequential scan. The script reports recall@k, median and
+p95 latency, and the size of the index each layout uses. Build the indexes
+first, for example:
+
+    python pgvector_indexes.py build --tables document_embeddings_combined --quantization halfvec
+    python pgvector_indexes.py build --tables document_embeddings_combined --quantization binary
+
+Usage:
+    python benchmark_vector_search.py [--table document_embeddings_combined] [--k 30]
+                                      [--samples 100 | --queries questions.txt]
+                                      [--layouts none halfvec binary] [--rescore-factor 4]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from db_utils import connect_db
+from pgvector_indexes import (QUANTIZATIONS, VECTOR_INDEX_QUERY, describe_vector_indexes, distance_operator)
+from pgvector_retriever import PGVectorRetriever
+
+
+def sample_query_embeddings(cursor, table_name, samples):
+    """Stored chunk embeddings used as queries when no question file is given."""
+    cursor.execute(f"SELECT embedding::text FROM {table_name} WHERE embedding IS NOT NULL "
+                   f"ORDER BY random() LIMIT %s", (samples,))
+    return [json.loads(row[0]) for row in cursor.fetchall()]
+
+
+def embed_questions(path):
+    from model_registry import model_registry
+    with open(path, "r", encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    return [vector.tolist() for vector in model_registry.embedding().embed_batch(questions)]
+
+
+def exact_neighbours(cursor, table_name, embedding, k):
+    """Ground truth: the k nearest ids by a full scan with index scans disabled."""
+    cursor.execute("SELECT set_config('enable_indexscan', 'off', true), set_config('enable_bitmapscan', 'off', true)")
+    cursor.execute(f"SELECT id FROM {table_name} ORDER BY embedding {distance_operator()} %s::vector LIMIT %s",
+                   (json.dumps(embedding), k))
+    ids = [row[0] for row in cursor.fetchall()]
+    cursor.connection.rollback()
+    return ids
+
+
+def run_layout(cursor, retriever, embeddings, truths):
+    recalls, latencies = [], []
+    for embedding, truth in zip(embeddings, truths):
+        sql, params = retriever._build_search(None, embedding)
+        start = time.perf_counter()
+        cursor.execute(*retriever._search_settings())
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+        latencies.append((time.perf_counter() - start) * 1000)
+        cursor.connection.rollback()
+        recalls.append(len(set(ids) & set(truth)) / max(1, len(truth)))
+    return {
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark quantized vector search layouts against exact search")
+    parser.add_argument("--table", default="document_embeddings_combined")
+    parser.add_argument("--k", type=int, default=30)
+    parser.add_argument("--samples", type=int, default=100, help="Stored embeddings used as queries")
+    parser.add_argument("--queries", help="File with one question per line (embedded with the API model)")
+    parser.add_argument("--layouts", nargs="+", choices=list(QUANTIZATIONS), default=list(QUANTIZATIONS))
+    parser.add_argument("--rescore-factor", type=int, help="Shortlist size as a multiple of k")
+    parser.add_argument("--ef-search", type=int, help="hnsw.ef_search for the approximate layouts")
+    args = parser.parse_args()
+
+    conn = connect_db()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        embeddings = embed_questions(args.queries) if args.queries else sample_query_embeddings(
+            cursor, args.table, args.samples)
+        conn.rollback()
+        print(f"[INFO] {len(embeddings)} queries against {args.table}, k={args.k}")
+        truths = [exact_neighbours(cursor, args.table, embedding, args.k) for embedding in embeddings]
+
+        cursor.execute(VECTOR_INDEX_QUERY, (args.table,))
+        indexes = describe_vector_indexes(cursor.fetchall())
+        conn.rollback()
+
+        print(f"{'layout':<10} {'index':<48} {'size MB':>8} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+        for layout in args.layouts:
+            matching = [ix for ix in indexes if ix["quantization"] == layout and ix["matches_distance"]]
+            if not matching:
+                print(f"{layout:<10} no {layout} index on {args.table}; skipped "
+                      f"(python pgvector_indexes.py build --tables {args.table} --quantization {layout})")
+                continue
+            search_kwargs = {"k": args.k, "quantization": layout, "two_phase": False}
+            if args.rescore_factor:
+                search_kwargs["rescore_factor"] = args.rescore_factor
+            if args.ef_search:
+                search_kwargs["ef_search"] = args.ef_search
+            retriever = PGVectorRetriever(None, table_name=args.table).as_retriever(search_kwargs=search_kwargs)
+            # One warm-up pass so every layout is measured with its index in cache.
+            run_layout(cursor, retriever, embeddings[:5], truths[:5])
+            result = run_layout(cursor, retriever, embeddings, truths)
+            index = matching[0]
+            print(f"{layout:<10} {index['index_name']:<48} {index['size_mb']:>8} {result['recall']:>10.3f} "
+                  f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
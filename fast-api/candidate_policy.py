@@ -0,0 +1,168 @@
+"""
+Adaptive candidate count and cascaded reranking.
+
+Retrieval returns k=30 candidates and the cross-encoder used to score all of
+them. Two cheaper policies:
+
+  - shrink(): when the vector distances show a clear break (a gap of at least
+    ADAPTIVE_GAP of the distance spread, or distances beyond
+    ADAPTIVE_DISTANCE_RATIO times the best one), candidates past the break are
+    dropped, keeping at least ADAPTIVE_MIN_CANDIDATES. Only applied when the
+    candidates are ordered by distance (vector mode), not to RRF-fused lists.
+  - arerank(): the cross-encoder first scores the best RERANK_CASCADE_PREFIX
+    candidates. When the top_n best of them all score at least
+    RERANK_CASCADE_MIN_SCORE and come from the upper RERANK_CASCADE_DEPTH
+    fraction of the prefix, the rest is not scored.
+
+Pairs saved by each policy are reported under candidate_policy in
+GET /api/admin/metrics.
+"""
+import os
+import threading
+
+ADAPTIVE_CANDIDATES = os.environ.get("ADAPTIVE_CANDIDATES", "1") == "1"
+ADAPTIVE_MIN_CANDIDATES = int(os.environ.get("ADAPTIVE_MIN_CANDIDATES", 10))
+ADAPTIVE_GAP = float(os.environ.get("ADAPTIVE_GAP", 0.3))
+ADAPTIVE_DISTANCE_RATIO = float(os.environ.get("ADAPTIVE_DISTANCE_RATIO", 1.5))
+
+RERANK_CASCADE = os.environ.get("RERANK_CASCADE", "1") == "1"
+RERANK_CASCADE_PREFIX = int(os.environ.get("RERANK_CASCADE_PREFIX", 10))
+RERANK_CASCADE_MIN_SCORE = float(os.environ.get("RERANK_CASCADE_MIN_SCORE", 0.0))
+RERANK_CASCADE_DEPTH = float(os.environ.get("RERANK_CASCADE_DEPTH", 0.7))
+
+
+def distance_cutoff(distances, min_keep, gap=ADAPTIVE_GAP, ratio=ADAPTIVE_DISTANCE_RATIO):
+    """
+    Number of leading candidates to keep given their ascending distances.
+
+    Args:
+        distances (List[float]): Distances of the candidates, nearest first.
+        min_keep (int): Lower bound on the result.
+        gap (float): Minimum jump between neighbours, as a fraction of the whole spread, to cut at.
+        ratio (float): Candidates farther than ratio times the nearest distance are cut
+                       (only for positive distances: cosine and L2).
+
+    Returns:
+        int: How many candidates to keep.
+    """
+    count = len(distances)
+    if count <= min_keep:
+        return count
+    keep = count
+    best, spread = distances[0], distances[-1] - distances[0]
+    if spread > 0:
+        # The widest jump at or past min_keep; everything after it is clearly farther away.
+        jumps = [(distances[i] - distances[i - 1], i) for i in range(min_keep, count)]
+        widest, position = max(jumps)
+        if widest >= gap * spread:
+            keep = position
+    if best > 0 and ratio > 0:
+        within = sum(1 for d in distances if d <= best * ratio)
+        keep = min(keep, max(within, min_keep))
+    return keep
+
+
+class CandidatePolicy:
+    """Shrinks candidate lists and cascades the cross-encoder, counting the pairs it saves."""
+
+    def __init__(self, adaptive=None, cascade=None, min_candidates=None, prefix=None,
+                 min_score=None, depth=None):
+        self.adaptive = ADAPTIVE_CANDIDATES if adaptive is None else adaptive
+        self.cascade = RERANK_CASCADE if cascade is None else cascade
+        self.min_candidates = min_candidates or ADAPTIVE_MIN_CANDIDATES
+        self.prefix = prefix or RERANK_CASCADE_PREFIX
+        self.min_score = RERANK_CASCADE_MIN_SCORE if min_score is None else min_score
+        self.depth = RERANK_CASCADE_DEPTH if depth is None else depth
+        self._lock = threading.Lock()
+        self.shrink_calls = 0
+        self.shrunk = 0
+        self.candidates_in = 0
+        self.candidates_dropped = 0
+        self.rerank_calls = 0
+        self.early_exits = 0
+        self.pairs_total = 0
+        self.pairs_scored = 0
+
+    def shrink(self, documents, re_rank_top=5):
+        """
+        Drop candidates past a clear break in the distance distribution.
+
+        Args:
+            documents (List[Document]): Retrieval results with a "distance" in their metadata.
+            re_rank_top (int): Documents the caller keeps after reranking (lower bound).
+
+        Returns:
+            List[Document]: A prefix of documents.
+        """
+        if not self.adaptive:
+            return documents
+        distances = [doc.metadata.get("distance") for doc in documents]
+        if any(d is None for d in distances) or any(b < a for a, b in zip(distances, distances[1:])):
+            # Not ranked by distance (hybrid RRF, KG documents): keep everything.
+            return documents
+        keep = distance_cutoff(distances, max(self.min_candidates, re_rank_top))
+        with self._lock:
+            self.shrink_calls += 1
+            self.candidates_in += len(documents)
+            self.candidates_dropped += len(documents) - keep
+            if keep < len(documents):
+                self.shrunk += 1
+        if keep < len(documents):
+            print(f"[DEBUG] Adaptive candidates: kept {keep} of {len(documents)} "
+                  f"(distance {distances[0]:.4f} .. {distances[keep - 1]:.4f}, next {distances[keep]:.4f})")
+        return documents[:keep]
+
+    def _can_exit(self, scores, top_n, scored):
+        ranked = sorted(range(scored), key=lambda i: scores[i], reverse=True)[:top_n]
+        if len(ranked) < top_n:
+            return False
+        return min(scores[i] for i in ranked) >= self.min_score and max(ranked) < self.depth * scored
+
+    async def arerank(self, query, documents, score_pairs, top_n=5):
+        """
+        Cross-encoder reranking in two stages.
+
+        Args:
+            query (str): The user query.
+            documents (List[Document]): Candidates in retrieval order.
+            score_pairs: Async callable scoring a list of [query, passage] pairs.
+            top_n (int): Documents the caller keeps; the early exit requires this many good ones.
+
+        Returns:
+            List[Tuple[float, Document]]: The scored documents, best first. After an early exit
+                                          the unscored tail is not included.
+        """
+        pairs = [[query, doc.page_content] for doc in documents]
+        prefix = self.prefix if self.cascade else len(pairs)
+        scores = [float(s) for s in await score_pairs(pairs[:prefix])] if pairs else []
+        exited = len(pairs) > prefix and self._can_exit(scores, top_n, len(scores))
+        if len(pairs) > prefix and not exited:
+            scores += [float(s) for s in await score_pairs(pairs[prefix:])]
+        with self._lock:
+            self.rerank_calls += 1
+            self.pairs_total += len(pairs)
+            self.pairs_scored += len(scores)
+            if exited:
+                self.early_exits += 1
+        if exited:
+            print(f"[DEBUG] Rerank cascade: early exit after {len(scores)} of {len(pairs)} pairs")
+        return sorted(zip(scores, documents), key=lambda x: x[0], reverse=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "adaptive": self.adaptive,
+                "cascade": self.cascade,
+                "shrink_calls": self.shrink_calls,
+                "shrunk": self.shrunk,
+                "candidates_in": self.candidates_in,
+                "candidates_dropped": self.candidates_dropped,
+                "rerank_calls": self.rerank_calls,
+                "early_exits": self.early_exits,
+                "pairs_total": self.pairs_total,
+                "pairs_scored": self.pairs_scored,
+                "pairs_saved": self.pairs_total - self.pairs_scored + self.candidates_dropped,
+            }
+
+
+candidate_policy = CandidatePolicy()
@@ -0,0 +1,113 @@
+"""
+Check chunk dedup on two-phase candidates against dedup on the full texts.
+
+With two-phase retrieval, dedup runs on phase-one candidates whose text is a
+RERANK_SNIPPET_CHARS prefix, using the full-content fingerprints selected in
+SQL (see ChunkDeduplicator.candidate_columns). For each query this script
+runs PGVectorRetriever's phase-one SQL, dedupes the candidates as the API does,
+then fetches the full rows of the same candidates and dedupes those with the
+Python fingerprints. It reports how often both keep the same chunks, and the
+same for the snippets alone (no SQL fingerprints), which misses nested children.
+
+Stored chunk embeddings are used as queries unless a question file is given.
+
+Usage:
+    python check_dedup.py [--table document_embeddings_combined] [--k 50]
+                          [--samples 50 | --queries questions.txt]
+"""
+import argparse
+import time
+
+from langchain.schema import Document
+
+from db_utils import connect_db
+from dedup import ChunkDeduplicator, deduplicator
+from pgvector_retriever import PGVectorRetriever
+from benchmark_vector_search import sample_query_embeddings, embed_questions
+
+
+def phase_one(cursor, retriever, embedding):
+    sql, params = retriever._build_search(None, embedding, candidates_only=True)
+    cursor.execute(*retriever._search_settings())
+    start = time.perf_counter()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    elapsed = time.perf_counter() - start
+    cursor.connection.rollback()
+    return retriever._candidate_rows_to_documents(rows), elapsed
+
+
+def full_documents(cursor, retriever, candidates):
+    """The candidates' full rows, in candidate order."""
+    ids = [doc.metadata["id"] for doc in candidates]
+    cursor.execute(f"SELECT {retriever._FETCH_COLUMNS} FROM {retriever.table_name} WHERE id = ANY(%s)", (ids,))
+    by_id = {doc.metadata["id"]: doc for doc in retriever._rows_to_documents(cursor.fetchall())}
+    cursor.connection.rollback()
+    return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+
+
+def clone(documents, drop=()):
+    """Copies with their own metadata dicts, since dedupe pops and adds metadata keys."""
+    return [Document(page_content=doc.page_content,
+                     metadata={key: value for key, value in doc.metadata.items() if key not in drop})
+            for doc in documents]
+
+
+def kept_ids(documents):
+    return [doc.metadata["id"] for doc in ChunkDeduplicator(enabled=True).dedupe(documents)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check dedup of two-phase candidates against full-text dedup")
+    parser.add_argument("--table", default="document_embeddings_combined")
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=50, help="Stored embeddings used as queries")
+    parser.add_argument("--queries", help="File with one question per line (embedded with the API model)")
+    args = parser.parse_args()
+
+    conn = connect_db()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    # Phase-one SQL selects the fingerprints only while dedup is enabled.
+    deduplicator.enabled = True
+    retriever = PGVectorRetriever(None, table_name=args.table).as_retriever({"k": args.k, "two_phase": True})
+    totals = {"queries": 0, "candidates": 0, "full": 0, "fingerprint": 0, "snippet": 0,
+              "fingerprint_same": 0, "snippet_same": 0, "seconds": 0.0}
+    try:
+        embeddings = embed_questions(args.queries) if args.queries else sample_query_embeddings(
+            cursor, args.table, args.samples)
+        conn.rollback()
+        for embedding in embeddings:
+            candidates, elapsed = phase_one(cursor, retriever, embedding)
+            if not candidates:
+                continue
+            full = kept_ids(full_documents(cursor, retriever, candidates))
+            fingerprinted = kept_ids(clone(candidates))
+            snippets = kept_ids(clone(candidates, drop=("shingles", "content_md5")))
+            totals["queries"] += 1
+            totals["candidates"] += len(candidates)
+            totals["full"] += len(candidates) - len(full)
+            totals["fingerprint"] += len(candidates) - len(fingerprinted)
+            totals["snippet"] += len(candidates) - len(snippets)
+            totals["fingerprint_same"] += fingerprinted == full
+            totals["snippet_same"] += snippets == full
+            totals["seconds"] += elapsed
+    finally:
+        cursor.close()
+        conn.close()
+
+    queries = totals["queries"]
+    if not queries:
+        print(f"No candidates retrieved from {args.table}")
+        return
+    print(f"{args.table}: {queries} queries, {totals['candidates']} candidates, "
+          f"phase one {totals['seconds'] / queries * 1000:.1f} ms/query (with fingerprints)")
+    print(f"{'dedup input':<28} {'collapsed':>10} {'same as full text':>18}")
+    print(f"{'full text (reference)':<28} {totals['full']:>10} {queries:>18}")
+    print(f"{'snippets + SQL fingerprints':<28} {totals['fingerprint']:>10} {totals['fingerprint_same']:>18}")
+    print(f"{'snippets only':<28} {totals['snippet']:>10} {totals['snippet_same']:>18}")
+
+
+if __name__ == "__main__":
+    main()
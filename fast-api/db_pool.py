@@ -0,0 +1,170 @@
+import os
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.types.string import TextLoader
+from psycopg_pool import AsyncConnectionPool
+
+# Re-exported so handlers can catch database failures without importing psycopg directly.
+DatabaseError = psycopg.Error
+
+
+def _int_env(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def build_conninfo():
+    """
+    Build the libpq connection string from the same DB_* environment variables
+    that db_utils.connect_db() uses.
+    """
+    return make_conninfo(
+        host=os.environ.get("DB_HOST", "127.0.0.1"),
+        port=os.environ.get("DB_PORT", 5432),
+        user=os.environ.get("DB_USER", "postgres"),
+        password=os.environ.get("DB_PASSWORD", "admin"),
+        dbname=os.environ.get("DB_NAME", "postgres"),
+        sslmode=os.environ.get("DB_SSLMODE", "require"),
+    )
+
+
+class Database:
+    """
+    Small repository layer over a psycopg3 AsyncConnectionPool.
+
+    The pool is created closed and opened from the FastAPI lifespan handler, so
+    TLS handshakes happen once per pooled connection instead of once per query.
+    Statements executed more than `prepare_threshold` times on a connection are
+    prepared server-side (psycopg's statement cache), keeping up to
+    `prepared_max` statements per connection.
+
+    Configuration (environment variables):
+        DB_POOL_MIN_SIZE       minimum number of open connections (default 2)
+        DB_POOL_MAX_SIZE       maximum number of open connections (default 10)
+        DB_POOL_TIMEOUT        seconds to wait for a free connection (default 30)
+        DB_PREPARE_THRESHOLD   executions before a statement is prepared (default 5,
+                               set to -1 to disable, e.g. behind pgbouncer)
+        DB_PREPARED_MAX        prepared statements kept per connection (default 100)
+    """
+
+    def __init__(self, min_size=None, max_size=None, timeout=None,
+                 prepare_threshold=None, prepared_max=None):
+        self.min_size = min_size if min_size is not None else _int_env("DB_POOL_MIN_SIZE", 2)
+        self.max_size = max_size if max_size is not None else _int_env("DB_POOL_MAX_SIZE", 10)
+        self.timeout = timeout if timeout is not None else _int_env("DB_POOL_TIMEOUT", 30)
+        if prepare_threshold is None:
+            prepare_threshold = _int_env("DB_PREPARE_THRESHOLD", 5)
+        # psycopg uses None to disable server-side prepared statements.
+        self.prepare_threshold = None if prepare_threshold < 0 else prepare_threshold
+        self.prepared_max = prepared_max if prepared_max is not None else _int_env("DB_PREPARED_MAX", 100)
+        self.pool = None
+
+    async def _configure(self, conn):
+        # psycopg2 returned uuid columns as plain strings; keep that behaviour so
+        # user_id values stay JSON serializable and comparable to header values.
+        conn.adapters.register_loader("uuid", TextLoader)
+        conn.prepared_max = self.prepared_max
+
+    async def open(self):
+        """Create and open the pool. Safe to call more than once."""
+        if self.pool is not None:
+            return
+        self.pool = AsyncConnectionPool(
+            build_conninfo(),
+            min_size=self.min_size,
+            max_size=self.max_size,
+            timeout=self.timeout,
+            kwargs={"prepare_threshold": self.prepare_threshold},
+            configure=self._configure,
+            open=False,
+            name="j1-api",
+        )
+        await self.pool.open(wait=True)
+        print(f"[INFO] Database pool opened (min_size={self.min_size}, max_size={self.max_size})")
+
+    async def close(self):
+        if self.pool is None:
+            return
+        await self.pool.close()
+        self.pool = None
+        print("[INFO] Database pool closed")
+
+    def _require_pool(self):
+        if self.pool is None:
+            raise DatabaseError("Database pool is not open")
+        return self.pool
+
+    @asynccontextmanager
+    async def connection(self):
+        """Borrow a pooled connection; the block is committed on success and rolled back on error."""
+        async with self._require_pool().connection() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Yield a cursor whose statements run in a single transaction.
+        Use this when several statements must succeed or fail together.
+        """
+        async with self._require_pool().connection() as conn:
+            async with conn.cursor() as cur:
+                yield cur
+
+    async def fetchone(self, query, params=None):
+        async with self.transaction() as cur:
+            await cur.execute(query, params)
+            return await cur.fetchone()
+
+    async def fetchall(self, query, params=None):
+        async with self.transaction() as cur:
+            await cur.execute(query, params)
+            return await cur.fetchall()
+
+    async def fetchval(self, query, params=None):
+        row = await self.fetchone(query, params)
+        return row[0] if row else None
+
+    async def execute(self, query, params=None):
+        """Execute a statement and return the number of affected rows."""
+        async with self.transaction() as cur:
+            await cur.execute(query, params)
+            return cur.rowcount
+
+    def stats(self):
+        """
+        Pool saturation metrics. `saturation` is the fraction of max_size
+        currently checked out; `requests_waiting` > 0 means callers are queued.
+        """
+        if self.pool is None:
+            return {"open": False, "pool_min": self.min_size, "pool_max": self.max_size}
+        raw = self.pool.get_stats()
+        pool_size = raw.get("pool_size", 0)
+        available = raw.get("pool_available", 0)
+        in_use = pool_size - available
+        return {
+            "open": True,
+            "pool_min": raw.get("pool_min", self.min_size),
+            "pool_max": raw.get("pool_max", self.max_size),
+            "pool_size": pool_size,
+            "pool_available": available,
+            "in_use": in_use,
+            "saturation": round(in_use / self.max_size, 3) if self.max_size else 0.0,
+            "requests_waiting": raw.get("requests_waiting", 0),
+            "requests_num": raw.get("requests_num", 0),
+            "requests_queued": raw.get("requests_queued", 0),
+            "requests_wait_ms": raw.get("requests_wait_ms", 0),
+            "requests_errors": raw.get("requests_errors", 0),
+            "connections_num": raw.get("connections_num", 0),
+            "connections_errors": raw.get("connections_errors", 0),
+            "connections_lost": raw.get("connections_lost", 0),
+            "prepare_threshold": self.prepare_threshold,
+            "prepared_max": self.prepared_max,
+        }
+
+
+# Process-wide instance, opened and closed by the application lifespan.
+db = Database()
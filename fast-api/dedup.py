@@ -0,0 +1,185 @@
+"""
+Collapse nested duplicates among retrieved chunks before reranking.
+
+json2pgvector embeds document, chapter, section and subsection nodes, and a
+parent's content often contains its children's text. A top-k search therefore
+returns the same passage at several levels, and the cross-encoder scores each
+copy. ChunkDeduplicator keeps one chunk per passage:
+
+  - a pair is related when one chunk's own hash (hash_<type>) appears in the
+    other's ancestry columns, i.e. one is the other's parent or ancestor;
+  - a related pair is collapsed when the shorter chunk's word shingles are
+    contained in the longer one's at DEDUP_CONTAINMENT or more;
+  - chunks with identical shingle sets are collapsed whatever their ancestry
+    (e.g. the same node loaded under two composite ids).
+
+Documents are visited in retrieval order, so the better-ranked chunk of each
+pair is kept. Ids of the collapsed chunks are listed in its "collapsed_ids"
+metadata.
+
+Two-phase candidates only carry a RERANK_SNIPPET_CHARS prefix of their text,
+which misses most of a parent's children. For them, PGVectorRetriever selects
+candidate_columns(): md5 of the full content for the identical test, and the
+full content's shingle hashes sampled to one in DEDUP_SAMPLE (the same sample
+for every chunk, so containment is preserved) for the nested test. dedupe()
+uses those instead of page_content and removes them from the metadata.
+`python check_dedup.py` compares both paths on a table.
+"""
+import os
+import threading
+import zlib
+
+from embedding_cache import normalize_text
+from pgvector_indexes import HASH_COLUMNS
+
+DEDUP_ENABLED = os.environ.get("RETRIEVAL_DEDUP", "1") == "1"
+DEDUP_CONTAINMENT = float(os.environ.get("DEDUP_CONTAINMENT", 0.8))
+DEDUP_SHINGLE_SIZE = int(os.environ.get("DEDUP_SHINGLE_SIZE", 5))
+# Phase-one fingerprints keep the shingles whose hash is divisible by this.
+DEDUP_SAMPLE = int(os.environ.get("DEDUP_SAMPLE", 4))
+
+# Hierarchy depth of each node type; lower is closer to the document root.
+LEVELS = {level: depth for depth, level in enumerate(HASH_COLUMNS)}
+
+
+def fingerprint(text, shingle_size=DEDUP_SHINGLE_SIZE):
+    """Set of CRC32 hashes of the word shingles of text (case and whitespace insensitive)."""
+    words = normalize_text(text or "").lower().split()
+    if len(words) <= shingle_size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))} if words else set()
+    return {
+        zlib.crc32(" ".join(words[i:i + shingle_size]).encode("utf-8"))
+        for i in range(len(words) - shingle_size + 1)
+    }
+
+
+def fingerprint_sql(column="content", shingle_size=DEDUP_SHINGLE_SIZE, sample=DEDUP_SAMPLE):
+    """
+    SQL expression for the sampled shingle hashes of a text column (int[]).
+    Hashes differ from fingerprint(), so only compare them with each other.
+    """
+    return f"""ARRAY(
+        SELECT DISTINCT h FROM (
+            SELECT hashtext(array_to_string(w[i:i + {shingle_size - 1}], ' ')) AS h
+            FROM regexp_split_to_array(lower(btrim({column})), '\\s+') AS w,
+                 generate_series(1, greatest(cardinality(w) - {shingle_size - 1}, 1)) AS i
+        ) shingles WHERE mod(h, {max(1, sample)}) = 0
+    )"""
+
+
+def _own_hash(doc):
+    column = HASH_COLUMNS.get(doc.metadata.get("type"))
+    return doc.metadata.get(column) if column else None
+
+
+def is_ancestor(parent, child):
+    """True when parent is a higher-level node whose hash appears in child's ancestry."""
+    parent_type, child_type = parent.metadata.get("type"), child.metadata.get("type")
+    if parent_type not in LEVELS or child_type not in LEVELS or LEVELS[parent_type] >= LEVELS[child_type]:
+        return False
+    parent_hash = _own_hash(parent)
+    return bool(parent_hash) and child.metadata.get(HASH_COLUMNS[parent_type]) == parent_hash
+
+
+def containment(inner, outer):
+    """Fraction of inner's shingles that are also in outer."""
+    if not inner:
+        return 0.0
+    return len(inner & outer) / len(inner)
+
+
+class ChunkDeduplicator:
+    """Drops retrieved chunks whose text is nested in (or equal to) a better-ranked one."""
+
+    def __init__(self, enabled=None, threshold=None, shingle_size=None):
+        self.enabled = DEDUP_ENABLED if enabled is None else enabled
+        self.threshold = DEDUP_CONTAINMENT if threshold is None else threshold
+        self.shingle_size = shingle_size or DEDUP_SHINGLE_SIZE
+        self.sample = DEDUP_SAMPLE
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.documents_in = 0
+        self.collapsed_nested = 0
+        self.collapsed_identical = 0
+
+    def candidate_columns(self):
+        """Extra SELECT columns for two-phase candidates ("" when dedup is disabled)."""
+        if not self.enabled:
+            return ""
+        return (f", md5(content) AS content_md5, "
+                f"{fingerprint_sql('content', self.shingle_size, self.sample)} AS shingles")
+
+    def _fingerprint(self, doc):
+        """(shingle set, identity key) of a document; the SQL fingerprints when present."""
+        shingles = doc.metadata.pop("shingles", None)
+        content_md5 = doc.metadata.pop("content_md5", None)
+        if shingles is not None:
+            return set(shingles), content_md5
+        prints = fingerprint(doc.page_content, self.shingle_size)
+        return prints, prints
+
+    def _duplicate_of(self, doc, prints, key, kept, kept_prints, kept_keys):
+        for index, (other, other_prints, other_key) in enumerate(zip(kept, kept_prints, kept_keys)):
+            if key and key == other_key:
+                return index, "identical"
+            if is_ancestor(other, doc) or is_ancestor(doc, other):
+                inner, outer = (prints, other_prints) if len(prints) <= len(other_prints) else (other_prints, prints)
+                if containment(inner, outer) >= self.threshold:
+                    return index, "nested"
+        return None, None
+
+    def dedupe(self, documents):
+        """
+        Remove nested and identical duplicates from a ranked list of documents.
+
+        Args:
+            documents (List[Document]): Retrieval results, best first.
+
+        Returns:
+            List[Document]: The kept documents in their original order.
+        """
+        if not self.enabled or len(documents) < 2:
+            for doc in documents:
+                doc.metadata.pop("shingles", None)
+                doc.metadata.pop("content_md5", None)
+            return documents
+        kept, kept_prints, kept_keys = [], [], []
+        nested = identical = 0
+        for doc in documents:
+            prints, key = self._fingerprint(doc)
+            index, reason = self._duplicate_of(doc, prints, key, kept, kept_prints, kept_keys)
+            if index is None:
+                kept.append(doc)
+                kept_prints.append(prints)
+                kept_keys.append(key)
+                continue
+            kept[index].metadata.setdefault("collapsed_ids", []).append(doc.metadata.get("id"))
+            if reason == "identical":
+                identical += 1
+            else:
+                nested += 1
+        with self._lock:
+            self.calls += 1
+            self.documents_in += len(documents)
+            self.collapsed_nested += nested
+            self.collapsed_identical += identical
+        if nested or identical:
+            print(f"[DEBUG] Dedup: {len(documents)} -> {len(kept)} chunks "
+                  f"({nested} nested, {identical} identical)")
+        return kept
+
+    def stats(self):
+        with self._lock:
+            collapsed = self.collapsed_nested + self.collapsed_identical
+            return {
+                "enabled": self.enabled,
+                "threshold": self.threshold,
+                "calls": self.calls,
+                "documents_in": self.documents_in,
+                "collapsed_nested": self.collapsed_nested,
+                "collapsed_identical": self.collapsed_identical,
+                "collapse_rate": collapsed / self.documents_in if self.documents_in else 0.0,
+            }
+
+
+deduplicator = ChunkDeduplicator()
@@ -1,25 +1,118 @@
-from chromadb.utils import embedding_functions
+import os
+
+import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 
+
+def resolve_device(device=None):
+    """
+    Pick the device to run the embedding model on.
+
+    Args:
+        device (str): "auto", "cpu", "cuda" or a specific device such as "cuda:1".
+                      Defaults to the EMBEDDING_DEVICE environment variable ("auto").
+
+    Returns:
+        str: "cuda" when auto-detection finds a GPU, otherwise "cpu", or the explicit device.
+    """
+    device = (device or os.environ.get("EMBEDDING_DEVICE", "auto")).lower()
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        print(f"[WARNING] EMBEDDING_DEVICE={device} requested but CUDA is not available; using cpu")
+        return "cpu"
+    return device
+
+
 class customembedding:
-    def __init__(self, model_name):
-        self.model = SentenceTransformer(model_name, device='cuda')  # Use GPU
+    """
+    Sentence-transformers embedding engine used by the API and the splitter scripts.
+
+    Runs on GPU or CPU, embeds lists of texts in batches and returns float32
+    numpy vectors, optionally L2-normalized. Optional reduced precision:
+    "fp16" halves the model weights (best on GPU), "int8" applies dynamic
+    int8 quantization to the Linear layers (CPU only).
+
+    Configuration (environment variables, overridden by constructor arguments):
+        EMBEDDING_DEVICE       auto (default), cpu or cuda
+        EMBEDDING_BATCH_SIZE   texts per forward pass (default 32)
+        EMBEDDING_PRECISION    fp32 (default), fp16 or int8
+        EMBEDDING_NORMALIZE    0 (default) keeps raw model output, as existing tables were
+                               embedded; 1 L2-normalizes (re-embed every table first)
+    """
+
+    def __init__(self, model_name, device=None, batch_size=None, precision=None, normalize=None):
+        self.model_name = model_name
+        self.device = resolve_device(device)
+        self.batch_size = batch_size or int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+        self.precision = (precision or os.environ.get("EMBEDDING_PRECISION", "fp32")).lower()
+        if normalize is None:
+            normalize = os.environ.get("EMBEDDING_NORMALIZE", "0").lower() in ("1", "true", "yes")
+        self.normalize = normalize
+
+        self.model = SentenceTransformer(model_name, device=self.device)
+        self._apply_precision()
+        print(f"[INFO] Embedding model '{model_name}' on {self.device} ({self.precision}, batch_size={self.batch_size})")
+
+    def _apply_precision(self):
+        if self.precision == "fp16":
+            self.model.half()
+        elif self.precision == "int8":
+            if self.device != "cpu":
+                print("[WARNING] int8 embedding precision is only supported on cpu; using fp32")
+                self.precision = "fp32"
+                return
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif self.precision != "fp32":
+            print(f"[WARNING] Unknown EMBEDDING_PRECISION '{self.precision}'; using fp32")
+            self.precision = "fp32"
 
-    def __call__(self, input: str) -> list:
+    def embed_batch(self, texts, batch_size=None) -> np.ndarray:
         """
-        Embeds a single input string.
+        Embeds a list of texts in batches.
+
+        Inputs are grouped by length before batching (SentenceTransformer.encode
+        sorts by length and restores the input order), so short queries are not
+        padded to the length of long documents.
+
+        Args:
+        - texts (list): A list of strings.
+        - batch_size (int): Texts per forward pass; defaults to the engine's batch size.
+
+        Returns:
+        - np.ndarray: A (len(texts), dim) float32 array in input order.
         """
-        embedding = self.model.encode(input, device='cuda')  # Explicit GPU usage
-        return embedding.tolist()
-    
+        if not texts:
+            dim = self.model.get_sentence_embedding_dimension()
+            return np.empty((0, dim), dtype=np.float32)
+        with torch.inference_mode():
+            embeddings = self.model.encode(
+                texts,
+                batch_size=batch_size or self.batch_size,
+                device=self.device,
+                convert_to_numpy=True,
+                normalize_embeddings=self.normalize,
+                show_progress_bar=False,
+            )
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def __call__(self, input) -> list:
+        """
+        Embeds a single input string, or a list of strings (Chroma's embedding function interface).
+        """
+        if isinstance(input, list):
+            return self.embed_documents(input)
+        return self.embed_batch([input])[0].tolist()
+
     def embed_query(self, query: str) -> list:
         """
         Embeds the given query string into a vector.
         """
         if not isinstance(query, str):
             raise ValueError("Query must be a string.")
-        return self.__call__(query)
-    
+        return self.embed_batch([query])[0].tolist()
+
     def embed_documents(self, documents: list) -> list:
         """
         Embeds a list of documents into vectors.
@@ -34,5 +127,4 @@ class customembedding:
             raise ValueError("Documents must be a list of strings.")
         if not all(isinstance(doc, str) for doc in documents):
             raise ValueError("All documents must be strings.")
-        return self.model.encode(documents, device='cuda').tolist()
-
+        return self.embed_batch(documents).tolist()
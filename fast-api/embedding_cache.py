@@ -0,0 +1,92 @@
+import os
+import sys
+import unicodedata
+
+import numpy as np
+
+from cache_utils import TTLCache
+
+
+def normalize_text(text):
+    """
+    Cache key normalization: Unicode NFC and collapsed whitespace. The tokenizer
+    splits on whitespace, so texts differing only in spacing embed identically.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def _entry_size(key, vector):
+    return vector.nbytes + sys.getsizeof(key[1])
+
+
+class CachedEmbedding:
+    """
+    Query-embedding cache in front of a customembedding engine.
+
+    Vectors are cached per (model name, normalized text) in a thread-safe LRU
+    with a TTL and a memory budget, so the same user message embedded by
+    retrieval, topic-change detection, metrics and /api/sources is computed
+    once. Misses within one embed_batch call are embedded together in a single
+    batch. Other attributes are delegated to the wrapped engine.
+
+    Configuration (environment variables):
+        EMBEDDING_CACHE_TTL         seconds a vector is kept (default 3600, 0 disables)
+        EMBEDDING_CACHE_MAX_MB      memory budget for cached vectors (default 64)
+        EMBEDDING_CACHE_MAX_ENTRIES maximum cached vectors (default 50000)
+    """
+
+    def __init__(self, engine, ttl=None, max_mb=None, max_entries=None):
+        self.engine = engine
+        ttl = ttl if ttl is not None else int(os.environ.get("EMBEDDING_CACHE_TTL", 3600))
+        max_mb = max_mb if max_mb is not None else float(os.environ.get("EMBEDDING_CACHE_MAX_MB", 64))
+        max_entries = max_entries if max_entries is not None else int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 50000))
+        self.cache = TTLCache("embedding", ttl=ttl, max_entries=max_entries,
+                              max_bytes=int(max_mb * 1024 * 1024), sizeof=_entry_size)
+
+    def __getattr__(self, name):
+        # Only called for attributes not defined here (model, model_name, device, ...).
+        if name == "engine":
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+    def embed_batch(self, texts, batch_size=None) -> np.ndarray:
+        """
+        Same contract as customembedding.embed_batch, served from the cache where possible.
+        """
+        keys = [(self.engine.model_name, normalize_text(text)) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            # Embed each distinct missing text once, in one batch.
+            miss_keys = list(missing)
+            computed = self.engine.embed_batch([key[1] for key in miss_keys], batch_size=batch_size)
+            for key, vector in zip(miss_keys, computed):
+                vector = np.array(vector, dtype=np.float32)
+                vector.setflags(write=False)
+                self.cache.set(key, vector)
+                for i in missing[key]:
+                    vectors[i] = vector
+        if not vectors:
+            return self.engine.embed_batch([])
+        return np.stack(vectors)
+
+    def __call__(self, input) -> list:
+        if isinstance(input, list):
+            return self.embed_documents(input)
+        return self.embed_batch([input])[0].tolist()
+
+    def embed_query(self, query: str) -> list:
+        if not isinstance(query, str):
+            raise ValueError("Query must be a string.")
+        return self.embed_batch([query])[0].tolist()
+
+    def embed_documents(self, documents: list) -> list:
+        return self.engine.embed_documents(documents)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["model_name"] = self.engine.model_name
+        return stats
@@ -1,76 +1,302 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase, Query, READ_ACCESS
 from reranker import rerank_documents
 from langchain.docstore.document import Document
 import asyncio
-from embedd_class import customembedding
-import asyncio
+from model_registry import model_registry
 import contextvars
+import os
 import threading
+import time
 from retriever import CustomChromaRetriever
+from dedup import deduplicator
+from mmr import mmr_selector
+from candidate_policy import candidate_policy
+from lucene_query import build_lucene_query
+from cache_utils import TTLCache
+
+
+
+# Shared embedding model handle (loaded once per process by the registry)
+embedding_function = model_registry.embedding()
 
+# Per-stage time budgets (seconds) for async_cypher_retriever.
+KG_STAGE_TIMEOUT = float(os.environ.get("HYBRID_KG_TIMEOUT", 5))
+VECTOR_STAGE_TIMEOUT = float(os.environ.get("HYBRID_VECTOR_TIMEOUT", 10))
+RERANK_STAGE_TIMEOUT = float(os.environ.get("HYBRID_RERANK_TIMEOUT", 10))
 
+# Neo4j driver connection pool (shared settings for the sync and async drivers).
+NEO4J_MAX_POOL_SIZE = int(os.environ.get("NEO4J_MAX_POOL_SIZE", 50))
+NEO4J_ACQUISITION_TIMEOUT = float(os.environ.get("NEO4J_ACQUISITION_TIMEOUT", 5))
+NEO4J_CONNECTION_TIMEOUT = float(os.environ.get("NEO4J_CONNECTION_TIMEOUT", 5))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.environ.get("NEO4J_MAX_CONNECTION_LIFETIME", 3600))
+# Server-side transaction timeout, so Neo4j stops a lookup the API has already given up on.
+NEO4J_QUERY_TIMEOUT = float(os.environ.get("NEO4J_QUERY_TIMEOUT", KG_STAGE_TIMEOUT))
+# Maximum KG nodes returned per lookup (the best-scoring ones).
+KG_RESULT_LIMIT = int(os.environ.get("KG_RESULT_LIMIT", 25))
+# Node score cut-offs. Lucene scores depend on the query shape (boosts, phrase clause)
+# and the question length, so the main cut-off is relative to the best node of the
+# lookup; KG_MIN_SCORE is an absolute floor on top of it (0: none).
+KG_MIN_SCORE = float(os.environ.get("KG_MIN_SCORE", 0))
+KG_RELATIVE_MIN_SCORE = float(os.environ.get("KG_RELATIVE_MIN_SCORE", 0.3))
 
-# Load the embedding function if needed elsewhere in your system
-embedding_function = customembedding("mixedbread-ai/mxbai-embed-large-v1")
+# KG lookup cache. Entries are stamped with the GraphMeta version that
+# KnowledgeGraph.process_json bumps after every ingestion.
+KG_CACHE_TTL = float(os.environ.get("KG_CACHE_TTL", 600))
+KG_CACHE_MAX_ENTRIES = int(os.environ.get("KG_CACHE_MAX_ENTRIES", 2000))
+KG_VERSION_TTL = float(os.environ.get("KG_VERSION_TTL", 30))
+
+GRAPH_VERSION_QUERY = "MATCH (m:GraphMeta {name: 'graph'}) RETURN m.version AS version"
+
+KG_FULLTEXT_QUERY = """
+    CALL db.index.fulltext.queryNodes("combinedIndex", $search_string, {limit: $limit}) YIELD node, score
+    WHERE score > $min_score
+    RETURN node.hash AS hash, node.title AS title, node.content AS content, score
+    ORDER BY score DESC
+    LIMIT $limit
+"""
+
+def _record_to_document(data):
+    return Document(
+        page_content=data["content"],
+        metadata={
+            "hash": data["hash"],
+            "title": data["title"],
+            "score": data["score"]
+        }
+    )
 
 class Hybrid:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    def __init__(self, uri, user, password, result_limit=None, query_timeout=None, min_score=None,
+                 relative_min_score=None):
+        pool_config = {
+            "max_connection_pool_size": NEO4J_MAX_POOL_SIZE,
+            "connection_acquisition_timeout": NEO4J_ACQUISITION_TIMEOUT,
+            "connection_timeout": NEO4J_CONNECTION_TIMEOUT,
+            "max_connection_lifetime": NEO4J_MAX_CONNECTION_LIFETIME,
+        }
+        self.driver = GraphDatabase.driver(uri, auth=(user, password), **pool_config)
+        # Async driver used by async_cypher_retriever so the KG lookup runs on the event loop
+        self.async_driver = AsyncGraphDatabase.driver(uri, auth=(user, password), **pool_config)
+        self.result_limit = result_limit or KG_RESULT_LIMIT
+        self.query_timeout = query_timeout or NEO4J_QUERY_TIMEOUT
+        self.min_score = KG_MIN_SCORE if min_score is None else min_score
+        self.relative_min_score = KG_RELATIVE_MIN_SCORE if relative_min_score is None else relative_min_score
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.errors = 0
+        self.empty_queries = 0
+        self.total_ms = 0.0
+        self.lucene_ms = 0.0
+        # (graph version, Lucene query, min_score, relative cut-off, limit) -> result rows
+        self.cache = TTLCache("kg_lookups", ttl=KG_CACHE_TTL, max_entries=KG_CACHE_MAX_ENTRIES)
+        self.graph_version = None
+        self._version_checked_at = 0.0
 
     def close(self):
         self.driver.close()
 
-    def query_kg_for_documents(self, user_query, min_score=5):
+    async def averify(self):
+        """Open the async pool at startup; a failure is logged and lookups retry lazily."""
+        try:
+            await self.async_driver.verify_connectivity()
+            print("[INFO] Neo4j async driver connected")
+        except Exception as e:
+            print(f"[WARNING] Neo4j is not reachable yet: {e}")
+
+    async def aclose(self):
+        await self.async_driver.close()
+
+    def _query(self):
+        return Query(KG_FULLTEXT_QUERY, timeout=self.query_timeout)
+
+    def _record(self, start, failed=False, search_string=None, summary=None, count=0):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # result_available_after: server time until the first record, i.e. the Lucene search.
+        lucene_ms = getattr(summary, "result_available_after", None) or 0
+        with self._lock:
+            self.queries += 1
+            self.errors += int(failed)
+            self.total_ms += elapsed_ms
+            self.lucene_ms += lucene_ms
+        if not failed:
+            print(f"[DEBUG] KG full-text lookup: {count} nodes, Lucene {lucene_ms} ms, "
+                  f"total {elapsed_ms:.1f} ms for {search_string!r}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_pool_size": NEO4J_MAX_POOL_SIZE,
+                "query_timeout_s": self.query_timeout,
+                "result_limit": self.result_limit,
+                "min_score": self.min_score,
+                "relative_min_score": self.relative_min_score,
+                "queries": self.queries,
+                "errors": self.errors,
+                "empty_queries": self.empty_queries,
+                "avg_ms": self.total_ms / self.queries if self.queries else 0.0,
+                "avg_lucene_ms": self.lucene_ms / self.queries if self.queries else 0.0,
+                "graph_version": self.graph_version,
+                "cache": self.cache.stats(),
+            }
+
+    def _version_due(self):
+        return time.monotonic() - self._version_checked_at > KG_VERSION_TTL
+
+    def _set_graph_version(self, version):
+        self._version_checked_at = time.monotonic()
+        version = version or 0
+        if version != self.graph_version:
+            if self.graph_version is not None:
+                print(f"[INFO] Knowledge graph version {self.graph_version} -> {version}, clearing KG lookup cache")
+                self.cache.clear()
+            self.graph_version = version
+
+    def _version_failed(self, e):
+        # Keep serving with the last known version; retry after KG_VERSION_TTL.
+        self._version_checked_at = time.monotonic()
+        print(f"[WARNING] Could not read the knowledge graph version: {e}")
+
+    def _refresh_graph_version(self):
+        if not self._version_due():
+            return
+        try:
+            with self.driver.session(default_access_mode=READ_ACCESS) as session:
+                record = session.run(Query(GRAPH_VERSION_QUERY, timeout=self.query_timeout)).single()
+            self._set_graph_version(record["version"] if record else 0)
+        except Exception as e:
+            self._version_failed(e)
+
+    async def _arefresh_graph_version(self):
+        if not self._version_due():
+            return
+        try:
+            async with self.async_driver.session(default_access_mode=READ_ACCESS) as session:
+                result = await session.run(Query(GRAPH_VERSION_QUERY, timeout=self.query_timeout))
+                record = await result.single()
+            self._set_graph_version(record["version"] if record else 0)
+        except Exception as e:
+            self._version_failed(e)
+
+    def _cache_key(self, search_string, min_score):
+        return (self.graph_version, search_string, float(min_score), self.relative_min_score, self.result_limit)
+
+    def _relative_cut(self, rows):
+        """Keep the nodes scoring at least relative_min_score times the best one (rows are best first)."""
+        if not rows or self.relative_min_score <= 0:
+            return rows
+        cutoff = rows[0]["score"] * self.relative_min_score
+        return [row for row in rows if row["score"] >= cutoff]
+
+    def _cached(self, key):
+        rows = self.cache.get(key)
+        if rows is None:
+            return None
+        print(f"[DEBUG] KG lookup cache hit: {len(rows)} nodes for {key[1]!r}")
+        # Fresh Documents per hit: callers add to their metadata.
+        return [_record_to_document(row) for row in rows]
+
+    def _search_string(self, user_query):
+        """Lucene query for user_query, or "" (counted) when it has no searchable terms."""
+        search_string = build_lucene_query(user_query)
+        if not search_string:
+            with self._lock:
+                self.empty_queries += 1
+            print(f"[DEBUG] KG full-text lookup skipped: no searchable terms in {user_query!r}")
+        return search_string
+
+    def query_kg_for_documents(self, user_query, min_score=None):
         """
         Query the knowledge graph using a full-text cypher query to retrieve
         relevant documents. Assumes that a full-text index named "combinedIndex"
-        exists on the node properties [title, content].
+        exists on the node properties [title, content]. The Lucene query is built
+        by lucene_query.build_lucene_query. Nodes scoring below
+        KG_RELATIVE_MIN_SCORE times the best node are dropped. Results are cached
+        per Lucene query and min_score until the graph version changes (or
+        KG_CACHE_TTL expires).
 
         Args:
             user_query (str): The user's input query.
-            min_score (float): Minimum score threshold to filter results.
+            min_score (float): Absolute score floor (default KG_MIN_SCORE).
 
         Returns:
             List[Document]: A list of Document objects with metadata.
         """
-        search_string = "*" + user_query + "*~"  # e.g., "*feedback*~"
-        with self.driver.session() as session:
-            result = session.run(
-                """
-                CALL db.index.fulltext.queryNodes("combinedIndex", $search_string) YIELD node, score
-                WHERE score > $min_score
-                RETURN node.hash AS hash, node.title AS title, node.content AS content, score
-                """,
-                search_string=search_string,
-                min_score=min_score
-            )
-            documents = []
-            for record in result:
-                data = record.data()
-                doc = Document(
-                    page_content=data["content"],
-                    metadata={
-                        "hash": data["hash"],
-                        "title": data["title"],
-                        "score": data["score"]
-                    }
+        search_string = self._search_string(user_query)
+        if not search_string:
+            return []
+        min_score = self.min_score if min_score is None else min_score
+        self._refresh_graph_version()
+        key = self._cache_key(search_string, min_score)
+        documents = self._cached(key)
+        if documents is not None:
+            return documents
+        start = time.perf_counter()
+        try:
+            with self.driver.session(default_access_mode=READ_ACCESS, fetch_size=self.result_limit) as session:
+                result = session.run(
+                    self._query(),
+                    search_string=search_string,
+                    min_score=min_score,
+                    limit=self.result_limit
                 )
-                documents.append(doc)
+                rows = [record.data() for record in result]
+                summary = result.consume()
+        except Exception:
+            self._record(start, failed=True)
+            raise
+        self._record(start, search_string=search_string, summary=summary, count=len(rows))
+        rows = self._relative_cut(rows)
+        self.cache.set(key, rows)
+        return [_record_to_document(row) for row in rows]
+
+    async def aquery_kg_for_documents(self, user_query, min_score=None):
+        """
+        Async variant of query_kg_for_documents using the async Neo4j driver.
+        The session borrows a pooled connection instead of an executor thread.
+        """
+        search_string = self._search_string(user_query)
+        if not search_string:
+            return []
+        min_score = self.min_score if min_score is None else min_score
+        await self._arefresh_graph_version()
+        key = self._cache_key(search_string, min_score)
+        documents = self._cached(key)
+        if documents is not None:
             return documents
+        start = time.perf_counter()
+        try:
+            async with self.async_driver.session(default_access_mode=READ_ACCESS,
+                                                 fetch_size=self.result_limit) as session:
+                result = await session.run(
+                    self._query(),
+                    search_string=search_string,
+                    min_score=min_score,
+                    limit=self.result_limit
+                )
+                rows = [record.data() async for record in result]
+                summary = await result.consume()
+        except Exception:
+            self._record(start, failed=True)
+            raise
+        self._record(start, search_string=search_string, summary=summary, count=len(rows))
+        rows = self._relative_cut(rows)
+        self.cache.set(key, rows)
+        return [_record_to_document(row) for row in rows]
 
 def cypher_retriever(user_query, kg, vector_retriever, cross_encoder, k=30, re_rank_top=5):
     """
     Retrieves documents by:
       1. Querying Neo4j for relevant document hashes (using a cypher query).
-      2. Building a filter condition to match these hashes in the vectorstore.
-      3. Retrieving the matching documents from the vectorstore.
-      4. Reranking the documents using a cross-encoder.
+      2. Retrieving the nearest vectorstore documents among those hashes (filtered in SQL).
+      3. Falling back to an unfiltered vector search when the filter matches nothing.
+      4. Collapsing parent/child chunks with the same text, then reranking with a cross-encoder.
       5. Additionally, including content directly from top 5 Neo4j nodes.
       
     Args:
         user_query (str): The user query.
         kg (Hybrid): An instance of your Hybrid class.
-        vector_retriever: A Chroma retriever instance.
+        vector_retriever: A PGVectorRetriever (hash filter pushed into SQL) or another retriever
+                          with get_relevant_documents(query).
         cross_encoder: A cross-encoder model for reranking.
         k (int): Number of documents to retrieve from the vectorstore.
         re_rank_top (int): Number of top documents to return after reranking.
@@ -89,32 +315,23 @@ def cypher_retriever(user_query, kg, vector_retriever, cross_encoder, k=30, re_r
     print(f"[DEBUG] Retrieved {node_count} nodes from KG")
     
     # Get the hashes for filtering PGVector
-    relevant_hashes = [doc.metadata["hash"] for doc in kg_documents]
+    relevant_hashes = [doc.metadata["hash"] for doc in kg_documents if doc.metadata.get("hash")]
     print(f"[DEBUG] Using {len(relevant_hashes)} hashes for filtering: {relevant_hashes}")
     
     # Extract the top 5 Neo4j documents directly for inclusion in the context
     top_neo4j_docs = kg_documents[:5] if len(kg_documents) > 0 else []
     print(f"[DEBUG] Using content from {len(top_neo4j_docs)} Neo4j nodes directly in context")
     
-    # Step 2: Build the filter condition for the vectorstore.
-    filter_condition = {"hash": {"$in": relevant_hashes}} if relevant_hashes else None
-    print(f"[DEBUG] Filter condition: {filter_condition}")
-    
-    # Step 3: Retrieve documents from the vectorstore using the filter.
-    docs = vector_retriever.get_relevant_documents(user_query)
-    print(f"[DEBUG] Retrieved {len(docs)} documents from vector store after filtering.")
-
-    # If there are KG hashes, manually filter the retrieved vectorstore docs.
-    if filter_condition is not None:
-        filtered_docs = [doc for doc in docs if doc.metadata.get("hash") in relevant_hashes]
-        if filtered_docs:
-            docs = filtered_docs
-            print(f"[DEBUG] Using filtered docs based on KG hashes; count: {len(filtered_docs)}")
-        else:
-            docs = docs
-            print(f"[DEBUG] Filtered docs empty, falling back to all unfiltered vectorstore docs.")
-    else:
-        docs = docs
+    # Steps 2-3: Retrieve the nearest documents among the KG-selected nodes. The hash filter is
+    # applied in the pgvector SQL query (any of the document/chapter/section/subsection hashes).
+    docs = []
+    if relevant_hashes and hasattr(vector_retriever, "table_name"):
+        docs = vector_retriever.get_relevant_documents(user_query, filter_hashes=relevant_hashes)
+        print(f"[DEBUG] Retrieved {len(docs)} documents from vector store among KG hashes.")
+    if not docs:
+        # No KG hashes (or none of them present in this table): fall back to unfiltered search.
+        docs = vector_retriever.get_relevant_documents(user_query)
+        print(f"[DEBUG] Filtered docs empty, falling back to all unfiltered vectorstore docs.")
 
     print(f"[DEBUG] Retrieved {len(docs)} documents from vector store after filtering/fallback.")
     
@@ -122,11 +339,25 @@ def cypher_retriever(user_query, kg, vector_retriever, cross_encoder, k=30, re_r
     if len(docs) > k:
         docs = docs[:k]
     
-    # Step 4: Rerank the retrieved documents using the cross-encoder.
-    scored_results = rerank_documents(user_query, docs)
+    # Step 4: Cut at a clear distance break, drop nested duplicates, then rerank with the cross-encoder.
+    docs = deduplicator.dedupe(candidate_policy.shrink(docs, re_rank_top))
+    scored_results = rerank_documents(user_query, docs, cross_encoder=cross_encoder)
     top_results = [doc for score, doc in scored_results[:re_rank_top]]
     
     # Step 5: Combine context from both Neo4j nodes directly and PGVector retrieval
+    context, all_top_results = combine_kg_and_vector_results(top_neo4j_docs, top_results)
+    
+    return context, all_top_results, node_count
+
+
+def combine_kg_and_vector_results(top_neo4j_docs, top_results):
+    """
+    Build the LLM context and the sources list from the top Neo4j nodes and the
+    reranked PGVector documents.
+
+    Returns:
+        Tuple[str, List[Document]]: The combined context and the documents for sources display.
+    """
     # Add content from Neo4j nodes
     neo4j_context = "\n\n".join([f"[Neo4j Node] {doc.page_content}" for doc in top_neo4j_docs])
     
@@ -149,9 +380,122 @@ def cypher_retriever(user_query, kg, vector_retriever, cross_encoder, k=30, re_r
     
     print(f"[DEBUG] Final context includes {len(top_neo4j_docs)} Neo4j nodes and {len(top_results)} PGVector documents")
     
-    return context, all_top_results, node_count
+    return context, all_top_results
+
+
+async def _with_timeout(stage, coro, timeout, default):
+    """Await coro within timeout seconds; on timeout or error log it and return default."""
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(coro, timeout)
+        print(f"[DEBUG] async_cypher_retriever: {stage} finished in {time.perf_counter() - start:.3f}s")
+        return result
+    except asyncio.TimeoutError:
+        print(f"[WARNING] async_cypher_retriever: {stage} exceeded {timeout}s, continuing without it")
+    except Exception as e:
+        print(f"[ERROR] async_cypher_retriever: {stage} failed: {e}")
+    return default
+
+
+async def _async_kg_documents(kg, user_query):
+    if hasattr(kg, "aquery_kg_for_documents"):
+        return await kg.aquery_kg_for_documents(user_query)
+    return await asyncio.to_thread(kg.query_kg_for_documents, user_query)
+
+
+async def _async_rerank(user_query, docs, cross_encoder, top_n):
+    async def score_pairs(pairs):
+        if hasattr(cross_encoder, "score_pairs"):
+            return await cross_encoder.score_pairs(pairs)
+        return await asyncio.to_thread(cross_encoder.predict, pairs)
+    return await candidate_policy.arerank(user_query, docs, score_pairs, top_n)
+
+
+async def async_cypher_retriever(user_query, kg, vector_retriever, cross_encoder, k=30, re_rank_top=5):
+    """
+    Async hybrid retrieval with the same inputs and outputs as cypher_retriever.
+
+    The Neo4j full-text lookup (async driver) runs concurrently with the query
+    embedding. When both finish, the KG hashes drive a filtered pgvector search
+    (async pool) that reuses the embedding. An unfiltered search is only issued
+    when the KG returns nothing, times out or its hashes match no rows, so a
+    request normally costs one vector search. Each stage has its own timeout (HYBRID_KG_TIMEOUT,
+    HYBRID_VECTOR_TIMEOUT, HYBRID_RERANK_TIMEOUT) so a slow Neo4j or database
+    degrades the answer instead of stalling the chat.
+
+    When the retriever uses two-phase retrieval, the searches return only ids
+    and rerank snippets; full content is fetched for the final documents only.
+    Before reranking, the candidates are cut at a clear distance break
+    (candidate_policy.py) and chunks nested in a better-ranked parent or child
+    are dropped (dedup.py). The cross-encoder may stop after a prefix of the
+    candidates, and with MMR_ENABLED=1 the final documents are picked from the
+    reranked pool by MMR (mmr.py).
+
+    Returns:
+        Tuple[str, List[Document], int]: The concatenated context, the top documents and the KG node count.
+    """
+    if not hasattr(vector_retriever, "asearch_by_vector"):
+        # Retrievers without an async search path keep the threaded sequential implementation.
+        ctx = contextvars.copy_context()
+        return await asyncio.to_thread(ctx.run, cypher_retriever, user_query, kg, vector_retriever, cross_encoder, k, re_rank_top)
 
+    print(f"[DEBUG] async_cypher_retriever: Using PGVector retriever with table '{vector_retriever.table_name}'")
+    two_phase = getattr(vector_retriever, "two_phase", False)
 
-async def async_cypher_retriever(*args, **kwargs):
-    ctx = contextvars.copy_context()
-    return await asyncio.to_thread(ctx.run, cypher_retriever, *args, **kwargs)
+    # Steps 1-2 concurrently: KG lookup || query embedding.
+    kg_documents, query_embedding = await asyncio.gather(
+        _with_timeout("KG query", _async_kg_documents(kg, user_query), KG_STAGE_TIMEOUT, []),
+        _with_timeout("query embedding", vector_retriever.aembed_query(user_query), VECTOR_STAGE_TIMEOUT, None),
+    )
+    node_count = len(kg_documents)
+    print(f"[DEBUG] Retrieved {node_count} nodes from KG")
+
+    relevant_hashes = [doc.metadata["hash"] for doc in kg_documents if doc.metadata.get("hash")]
+    top_neo4j_docs = kg_documents[:5]
+
+    # Step 3: Top-k among the KG-selected nodes, reusing the query embedding.
+    docs = []
+    if relevant_hashes and query_embedding is not None:
+        docs = await _with_timeout(
+            "filtered vector search",
+            vector_retriever.asearch_by_vector(
+                query_embedding, filter_hashes=relevant_hashes, query_text=user_query, candidates_only=two_phase
+            ),
+            VECTOR_STAGE_TIMEOUT,
+            [],
+        )
+        print(f"[DEBUG] Retrieved {len(docs)} documents from vector store among {len(relevant_hashes)} KG hashes.")
+    if not docs and query_embedding is not None:
+        # No KG hashes (or none of them present in this table): fall back to unfiltered search.
+        docs = await _with_timeout(
+            "vector search",
+            vector_retriever.asearch_by_vector(query_embedding, query_text=user_query, candidates_only=two_phase),
+            VECTOR_STAGE_TIMEOUT,
+            [],
+        )
+        print(f"[DEBUG] Using {len(docs)} unfiltered vectorstore docs.")
+    docs = deduplicator.dedupe(candidate_policy.shrink(docs[:k], re_rank_top))
+
+    # Step 4: Rerank; on timeout keep the vector-search order.
+    pool_size = mmr_selector.pool_size(re_rank_top)
+    scored_results = await _with_timeout(
+        "rerank", _async_rerank(user_query, docs, cross_encoder, pool_size), RERANK_STAGE_TIMEOUT, None
+    )
+    if scored_results is None:
+        top_results = docs[:pool_size]
+    else:
+        top_results = []
+        for score, doc in scored_results[:pool_size]:
+            doc.metadata["rerank_score"] = float(score)
+            top_results.append(doc)
+    top_results = await mmr_selector.aselect(vector_retriever, top_results, re_rank_top)
+
+    if two_phase and top_results:
+        # Phase two: full content and metadata for the winners only.
+        top_results = await _with_timeout(
+            "content fetch", vector_retriever.afetch_documents(top_results), VECTOR_STAGE_TIMEOUT, top_results
+        )
+
+    # Step 5: Combine context from Neo4j nodes and PGVector retrieval.
+    context, all_top_results = combine_kg_and_vector_results(top_neo4j_docs, top_results)
+    return context, all_top_results, node_count
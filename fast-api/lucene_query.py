@@ -0,0 +1,85 @@
+"""
+Lucene query strings for the Neo4j "combinedIndex" full-text search.
+
+The KG lookup used to send "*" + question + "*~": a leading-wildcard fuzzy
+query over the whole sentence, one of the most expensive Lucene query shapes.
+build_lucene_query() instead:
+
+  - tokenizes the question and drops stopwords and duplicate terms;
+  - escapes Lucene special characters in every term;
+  - matches each term exactly with a boost, plus fuzzily (~KG_FUZZY_EDITS)
+    when it is long enough and not a number or code such as "36-2903";
+  - adds the remaining terms as a boosted sloppy phrase, so passages using
+    the question's wording rank first;
+  - keeps at most KG_QUERY_MAX_TERMS terms.
+"""
+import os
+import re
+
+KG_QUERY_MAX_TERMS = int(os.environ.get("KG_QUERY_MAX_TERMS", 12))
+KG_FUZZY_MIN_LENGTH = int(os.environ.get("KG_FUZZY_MIN_LENGTH", 5))
+KG_FUZZY_EDITS = int(os.environ.get("KG_FUZZY_EDITS", 1))
+KG_TERM_BOOST = float(os.environ.get("KG_TERM_BOOST", 2.0))
+KG_PHRASE_BOOST = float(os.environ.get("KG_PHRASE_BOOST", 3.0))
+KG_PHRASE_SLOP = int(os.environ.get("KG_PHRASE_SLOP", 4))
+
+# Characters with a meaning in Lucene's classic query syntax.
+LUCENE_SPECIAL = re.compile(r'([+\-!(){}\[\]^"~*?:\\/&|])')
+TOKEN = re.compile(r"[A-Za-z0-9]+(?:[-./][A-Za-z0-9]+)*")
+
+STOPWORDS = frozenset("""
+    a about above after again against all am an and any are as at be because been before being below
+    between both but by can could did do does doing down during each few for from further had has have
+    having he her here hers herself him himself his how i if in into is it its itself just me more most
+    my myself no nor not now of off on once only or other our ours ourselves out over own same she should
+    so some such than that the their theirs them themselves then there these they this those through to
+    too under until up very was we were what when where which while who whom why will with would you your
+    yours yourself yourselves tell explain describe give list please regarding according
+""".split())
+
+
+def escape_term(term):
+    """Backslash-escape Lucene special characters."""
+    return LUCENE_SPECIAL.sub(r"\\\1", term)
+
+
+def query_terms(user_query, max_terms=KG_QUERY_MAX_TERMS):
+    """Distinct non-stopword tokens of the question, in order, lower-cased."""
+    terms = []
+    for token in TOKEN.findall(user_query or ""):
+        term = token.lower()
+        if term in STOPWORDS or term in terms or (len(term) == 1 and not term.isdigit()):
+            continue
+        terms.append(term)
+        if len(terms) >= max_terms:
+            break
+    return terms
+
+
+def _term_clause(term):
+    escaped = escape_term(term)
+    fuzzy = (KG_FUZZY_EDITS > 0 and len(term) >= KG_FUZZY_MIN_LENGTH and term.isalpha())
+    if not fuzzy:
+        return f"{escaped}^{KG_TERM_BOOST:g}"
+    return f"({escaped}^{KG_TERM_BOOST:g} OR {escaped}~{KG_FUZZY_EDITS})"
+
+
+def build_lucene_query(user_query, max_terms=KG_QUERY_MAX_TERMS):
+    """
+    Build the full-text search string for a user question.
+
+    Args:
+        user_query (str): The user's question.
+        max_terms (int): Maximum number of terms kept.
+
+    Returns:
+        str: The Lucene query, or "" when the question has no searchable terms.
+    """
+    terms = query_terms(user_query, max_terms)
+    if not terms:
+        return ""
+    clauses = [_term_clause(term) for term in terms]
+    if len(terms) > 1:
+        phrase = " ".join(escape_term(term) for term in terms)
+        clauses.append(f'"{phrase}"~{KG_PHRASE_SLOP}^{KG_PHRASE_BOOST:g}')
+    return " OR ".join(clauses)
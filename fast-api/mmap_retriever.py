@@ -0,0 +1,397 @@
+"""
+In-process exact vector search over a memory-mapped snapshot of an embeddings table.
+
+The corpus fits in RAM. This backend therefore answers queries with one
+matrix-vector product over a memory-mapped embedding matrix, with no Postgres
+round trip. A snapshot directory looks like this:
+
+    <VECTOR_SNAPSHOT_DIR>/<table_name>/
+        manifest.json              {"current": "<version>", "table": ..., "dtype": ..., "rows": ...}
+        <version>/embeddings.npy   float32 or float16 matrix, one row per chunk
+        <version>/content.bin      chunk texts, UTF-8, concatenated
+        <version>/content_offsets.npy  int64 start of each row's text in content.bin (rows + 1)
+        <version>/columns.json     metadata columns (id, hashes, titles, datasets)
+
+The matrix and the texts are memory-mapped, so API workers share them
+through the page cache instead of each holding its own copy of the corpus.
+
+Writing a snapshot creates a new version directory, then atomically replaces
+manifest.json. Running retrievers notice the new manifest within
+MMAP_RELOAD_INTERVAL seconds and swap to it without a restart.
+
+Usage:
+    python mmap_retriever.py snapshot [--tables t1 t2 ...] [--dtype float32|float16] [--out DIR]
+    python mmap_retriever.py info     [--tables ...] [--out DIR]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from db_utils import connect_db
+from pgvector_indexes import DEFAULT_TABLES, VECTOR_DISTANCE
+from pgvector_retriever import PGVectorRetriever, HASH_COLUMNS
+from retrieval_cache import bump_corpus_version
+
+VECTOR_SNAPSHOT_DIR = os.environ.get("VECTOR_SNAPSHOT_DIR", "/data/vector_snapshots")
+MMAP_RELOAD_INTERVAL = float(os.environ.get("MMAP_RELOAD_INTERVAL", 30))
+# Snapshot versions kept on disk per table (the current one included).
+MMAP_KEEP_VERSIONS = int(os.environ.get("MMAP_KEEP_VERSIONS", 2))
+# float16 matrices are converted to float32 in blocks of this many rows for the product.
+MMAP_BLOCK_ROWS = 65536
+
+# Same order as PGVectorRetriever._rows_to_documents expects after (id, content, distance).
+METADATA_COLUMNS = [
+    "document_title", "hash_document", "type", "category", "pdf_path",
+    "chapter_title", "section_title", "section_number", "subsection_title",
+    "hash_chapter", "hash_section", "hash_subsection",
+]
+
+
+class VectorSnapshot:
+    """
+    One loaded snapshot version: the memory-mapped matrix and texts, its metadata
+    columns, squared row norms, per-dataset row masks and a hash -> rows inverted
+    index per KG level.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.matrix = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        with open(os.path.join(path, "columns.json"), "r", encoding="utf-8") as f:
+            self.columns = json.load(f)
+        self.rows = self.matrix.shape[0]
+        self.content_offsets = np.load(os.path.join(path, "content_offsets.npy"), mmap_mode="r")
+        # np.memmap cannot map an empty file (a corpus of empty texts).
+        content_path = os.path.join(path, "content.bin")
+        self.content_blob = (np.memmap(content_path, dtype=np.uint8, mode="r")
+                             if os.path.getsize(content_path) else np.zeros(0, dtype=np.uint8))
+        self.norms = self._squared_norms()
+
+        self.dataset_masks = {}
+        for row, datasets in enumerate(self.columns.get("datasets") or []):
+            for dataset in datasets or []:
+                mask = self.dataset_masks.setdefault(dataset, np.zeros(self.rows, dtype=bool))
+                mask[row] = True
+
+        self.id_rows = {doc_id: row for row, doc_id in enumerate(self.columns["id"])}
+
+        self.hash_rows = {}
+        for level, column in HASH_COLUMNS.items():
+            index = {}
+            for row, value in enumerate(self.columns.get(column) or []):
+                if value:
+                    index.setdefault(value, []).append(row)
+            self.hash_rows[level] = {value: np.array(rows, dtype=np.int64) for value, rows in index.items()}
+
+    def _blocks(self, rows=None):
+        """Yield (row offset, float32 block) over the matrix or the selected rows."""
+        source = self.matrix if rows is None else self.matrix[rows]
+        if source.dtype == np.float32:
+            yield 0, source
+            return
+        for start in range(0, source.shape[0], MMAP_BLOCK_ROWS):
+            yield start, np.asarray(source[start:start + MMAP_BLOCK_ROWS], dtype=np.float32)
+
+    def _squared_norms(self):
+        norms = np.empty(self.rows, dtype=np.float32)
+        for start, block in self._blocks():
+            norms[start:start + block.shape[0]] = np.einsum("ij,ij->i", block, block)
+        return norms
+
+    def mask(self, dataset=None, filter_hashes=None, hash_levels=None):
+        """
+        Row indices allowed by the dataset and KG hash filters, or None when unfiltered.
+        Mirrors the SQL conditions of PGVectorRetriever.
+        """
+        selected = None
+        if dataset:
+            selected = self.dataset_masks.get(dataset, np.zeros(self.rows, dtype=bool))
+        if filter_hashes:
+            hash_mask = np.zeros(self.rows, dtype=bool)
+            for level in (hash_levels or HASH_COLUMNS):
+                index = self.hash_rows[level]
+                for value in filter_hashes:
+                    rows = index.get(value)
+                    if rows is not None:
+                        hash_mask[rows] = True
+            selected = hash_mask if selected is None else selected & hash_mask
+        return None if selected is None else np.flatnonzero(selected)
+
+    def search(self, query_embedding, k, rows=None):
+        """
+        Exact top-k by VECTOR_DISTANCE (same values as pgvector's operators).
+
+        Returns:
+            List[Tuple[int, float]]: (row, distance) pairs, nearest first.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        count = self.rows if rows is None else len(rows)
+        if count == 0:
+            return []
+        dots = np.empty(count, dtype=np.float32)
+        for start, block in self._blocks(rows):
+            dots[start:start + block.shape[0]] = block @ query
+        norms = self.norms if rows is None else self.norms[rows]
+
+        if VECTOR_DISTANCE == "l2":
+            distances = np.sqrt(np.maximum(norms - 2.0 * dots + float(query @ query), 0.0))
+        elif VECTOR_DISTANCE == "cosine":
+            distances = 1.0 - dots / np.maximum(np.sqrt(norms) * float(np.linalg.norm(query)), 1e-12)
+        else:  # "ip": pgvector's <#> is the negative inner product
+            distances = -dots
+
+        k = min(int(k), count)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        positions = top if rows is None else rows[top]
+        return [(int(row), float(distances[i])) for row, i in zip(positions, top)]
+
+    def content(self, index):
+        start, stop = int(self.content_offsets[index]), int(self.content_offsets[index + 1])
+        return bytes(self.content_blob[start:stop]).decode("utf-8")
+
+    def row(self, index, distance):
+        """One result in the column order of PGVectorRetriever._rows_to_documents."""
+        return tuple(
+            [self.columns["id"][index], self.content(index), distance]
+            + [self.columns[column][index] for column in METADATA_COLUMNS]
+        )
+
+
+class SnapshotStore:
+    """
+    The current snapshot of one table. The manifest is checked at most every
+    MMAP_RELOAD_INTERVAL seconds. When it names a new version, that version is
+    loaded and swapped in. Searches already running keep the previous one.
+    """
+
+    def __init__(self, directory, reload_interval=None):
+        self.directory = directory
+        self.reload_interval = reload_interval if reload_interval is not None else MMAP_RELOAD_INTERVAL
+        self.snapshot = None
+        self.version = None
+        self.loaded_at = None
+        self.swaps = 0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _manifest(self):
+        with open(os.path.join(self.directory, "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def get(self):
+        if self.snapshot is None or time.monotonic() - self._checked_at > self.reload_interval:
+            with self._lock:
+                if self.snapshot is None or time.monotonic() - self._checked_at > self.reload_interval:
+                    self._reload()
+        return self.snapshot
+
+    def _reload(self):
+        self._checked_at = time.monotonic()
+        try:
+            version = self._manifest()["current"]
+        except (OSError, ValueError, KeyError) as e:
+            if self.snapshot is None:
+                raise RuntimeError(f"No vector snapshot in {self.directory}: {e}")
+            print(f"[WARNING] Could not read snapshot manifest in {self.directory}, keeping version {self.version}: {e}")
+            return
+        if version == self.version:
+            return
+        start = time.perf_counter()
+        snapshot = VectorSnapshot(os.path.join(self.directory, version))
+        self.snapshot, self.version, self.loaded_at = snapshot, version, time.time()
+        self.swaps += 1
+        print(f"[INFO] Loaded vector snapshot {self.directory}/{version} ({snapshot.rows} rows, "
+              f"{snapshot.matrix.dtype}) in {time.perf_counter() - start:.2f}s")
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "directory": self.directory,
+            "version": self.version,
+            "rows": snapshot.rows if snapshot else 0,
+            "dtype": str(snapshot.matrix.dtype) if snapshot else None,
+            "matrix_mb": round(snapshot.matrix.nbytes / (1024 * 1024), 1) if snapshot else 0,
+            "content_mb": round(snapshot.content_blob.nbytes / (1024 * 1024), 1) if snapshot else 0,
+            "swaps": self.swaps,
+        }
+
+
+class MMapRetriever(PGVectorRetriever):
+    """
+    Drop-in replacement for PGVectorRetriever that searches a memory-mapped
+    snapshot of the table. Search is exact, so no index or ef_search tuning is
+    needed. Only vector search is supported: hybrid mode falls back to vector
+    ranking. Full content is in memory, so two-phase retrieval is not used.
+    """
+
+    def __init__(self, embedding_function, table_name="document_embeddings_combined", snapshot_dir=None,
+                 dataset=None, search_mode="vector"):
+        super().__init__(embedding_function, table_name=table_name, search_mode=search_mode, dataset=dataset)
+        self.store = SnapshotStore(snapshot_dir or os.path.join(VECTOR_SNAPSHOT_DIR, table_name))
+
+    @property
+    def two_phase(self):
+        return False
+
+    def _search(self, query_embedding, filter_hashes=None, hash_levels=None):
+        snapshot = self.store.get()
+        rows = snapshot.mask(self.dataset, filter_hashes, hash_levels)
+        hits = snapshot.search(query_embedding, self.k, rows)
+        return self._rows_to_documents([snapshot.row(index, distance) for index, distance in hits])
+
+    def get_relevant_documents(self, query, filter_hashes=None, hash_levels=None):
+        print(f"[DEBUG] MMapRetriever: Searching snapshot of {self._describe(filter_hashes)}")
+        try:
+            documents = self._search(self._embed(query), filter_hashes, hash_levels)
+        except Exception as e:
+            print(f"Error in MMapRetriever: {e}")
+            return []
+        print(f"[DEBUG] MMapRetriever: Retrieved {len(documents)} documents from '{self.table_name}' snapshot")
+        return documents
+
+    async def asearch_by_vector(self, query_embedding, filter_hashes=None, hash_levels=None, query_text=None,
+                                candidates_only=False):
+        """Same contract as PGVectorRetriever.asearch_by_vector; full documents are always returned."""
+        print(f"[DEBUG] MMapRetriever: Searching snapshot of {self._describe(filter_hashes)} (async)")
+        try:
+            # NumPy releases the GIL during the product, so other requests keep running.
+            documents = await asyncio.to_thread(self._search, query_embedding, filter_hashes, hash_levels)
+        except Exception as e:
+            print(f"Error in MMapRetriever: {e}")
+            return []
+        print(f"[DEBUG] MMapRetriever: Retrieved {len(documents)} documents from '{self.table_name}' snapshot")
+        return documents
+
+    async def afetch_documents(self, candidates):
+        return candidates
+
+    async def afetch_embeddings(self, documents):
+        snapshot = self.store.get()
+        rows = [snapshot.id_rows.get(doc.metadata.get("id")) for doc in documents]
+        return [None if row is None else np.asarray(snapshot.matrix[row], dtype=np.float32) for row in rows]
+
+    def stats(self):
+        return self.store.stats()
+
+
+def write_snapshot(table_name, out_dir=None, dtype="float32"):
+    """
+    Export a table into a new snapshot version and make it current.
+
+    The row count and the streamed rows are read in one REPEATABLE READ
+    transaction, so a concurrent load cannot make them disagree.
+
+    Returns:
+        str: The new version name, or None on failure.
+    """
+    directory = out_dir or os.path.join(VECTOR_SNAPSHOT_DIR, table_name)
+    conn = connect_db()
+    if conn is None:
+        print(f"[ERROR] Cannot snapshot {table_name}: database connection failed")
+        return None
+    cursor = conn.cursor()
+    try:
+        # Count and stream from the same snapshot of the table.
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table_name,))
+        has_datasets = "datasets" in {row[0] for row in cursor.fetchall()}
+        cursor.execute(f"SELECT count(*), max(vector_dims(embedding)) FROM {table_name} WHERE embedding IS NOT NULL")
+        rows, dims = cursor.fetchone()
+        if not rows:
+            print(f"[ERROR] Table {table_name} has no embeddings to snapshot")
+            return None
+
+        version = time.strftime("%Y%m%d%H%M%S")
+        path = os.path.join(directory, version)
+        os.makedirs(path, exist_ok=True)
+        matrix = np.lib.format.open_memmap(os.path.join(path, "embeddings.npy"), mode="w+",
+                                           dtype=np.dtype(dtype), shape=(rows, dims))
+        names = ["id"] + METADATA_COLUMNS + (["datasets"] if has_datasets else [])
+        columns = {name: [] for name in names}
+        offsets = np.lib.format.open_memmap(os.path.join(path, "content_offsets.npy"), mode="w+",
+                                            dtype=np.int64, shape=(rows + 1,))
+        offsets[0] = 0
+
+        # Server-side cursor so the table is streamed rather than loaded at once.
+        stream = conn.cursor(name=f"snapshot_{table_name}")
+        stream.itersize = 2000
+        stream.execute(f"SELECT embedding::real[], content, {', '.join(names)} FROM {table_name} "
+                       f"WHERE embedding IS NOT NULL ORDER BY id")
+        start = time.perf_counter()
+        written = 0
+        with open(os.path.join(path, "content.bin"), "wb") as content_file:
+            for index, record in enumerate(stream):
+                matrix[index] = record[0]
+                text = (record[1] or "").encode("utf-8")
+                content_file.write(text)
+                offsets[index + 1] = offsets[index] + len(text)
+                for name, value in zip(names, record[2:]):
+                    columns[name].append(value)
+                written = index + 1
+        stream.close()
+        conn.commit()
+        if written != rows:
+            raise RuntimeError(f"streamed {written} rows, expected {rows}")
+        matrix.flush()
+        offsets.flush()
+        del matrix, offsets
+
+        with open(os.path.join(path, "columns.json"), "w", encoding="utf-8") as f:
+            json.dump(columns, f)
+        manifest = {"current": version, "table": table_name, "dtype": dtype, "rows": rows, "dims": dims,
+                    "distance": VECTOR_DISTANCE}
+        tmp = os.path.join(directory, "manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(directory, "manifest.json"))
+        print(f"[INFO] Wrote snapshot {path} ({rows} x {dims} {dtype}) in {time.perf_counter() - start:.1f}s")
+
+        # Drop API retrieval results cached against the previous snapshot.
+        bump_corpus_version(cursor, table_name)
+        conn.commit()
+
+        _prune_versions(directory, version)
+        return version
+    except Exception as e:
+        print(f"[ERROR] Failed to snapshot {table_name}: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _prune_versions(directory, current):
+    versions = sorted(name for name in os.listdir(directory)
+                      if os.path.isdir(os.path.join(directory, name)) and name != current)
+    for name in versions[:max(0, len(versions) - (MMAP_KEEP_VERSIONS - 1))]:
+        # Processes still mapping an old version keep their pages until they swap.
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage memory-mapped vector snapshots")
+    parser.add_argument("command", choices=["snapshot", "info"])
+    parser.add_argument("--tables", nargs="+", default=DEFAULT_TABLES, help="Tables to snapshot or inspect")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                        help="Matrix precision; float16 halves memory")
+    parser.add_argument("--out", help="Snapshot root directory (default: VECTOR_SNAPSHOT_DIR)")
+    args = parser.parse_args()
+
+    for table in args.tables:
+        directory = os.path.join(args.out or VECTOR_SNAPSHOT_DIR, table)
+        if args.command == "snapshot":
+            write_snapshot(table, directory, dtype=args.dtype)
+        else:
+            store = SnapshotStore(directory)
+            try:
+                store.get()
+                print(json.dumps(store.stats(), indent=2))
+            except RuntimeError as e:
+                print(f"{table}: {e}")
@@ -0,0 +1,155 @@
+"""
+Maximal marginal relevance over reranked documents.
+
+The top reranked chunks are often neighbouring sections of one document that
+say the same thing. When MMR_ENABLED=1, the reranker keeps a pool of
+MMR_POOL documents and MMRSelector picks the final ones greedily by
+
+    MMR_LAMBDA * relevance - (1 - MMR_LAMBDA) * max similarity to the picked ones
+
+where relevance is the min-max normalized rerank score and similarity is the
+cosine between stored chunk embeddings. The embeddings are read back from the
+retriever (pgvector by primary key, or the in-memory snapshot); nothing is
+re-embedded. With MMR_TOP_N below re_rank_top, fewer chunks reach the prompt.
+"""
+import os
+import threading
+
+import numpy as np
+
+MMR_ENABLED = os.environ.get("MMR_ENABLED", "0") == "1"
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", 0.7))
+MMR_POOL = int(os.environ.get("MMR_POOL", 10))
+MMR_TOP_N = int(os.environ.get("MMR_TOP_N", 0))
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def mmr_select(embeddings, relevance, top_n, lambda_mult=MMR_LAMBDA):
+    """
+    Greedy MMR selection.
+
+    Args:
+        embeddings (np.ndarray): (n, d) candidate embeddings.
+        relevance (np.ndarray): (n,) relevance scores, higher is better (any scale).
+        top_n (int): Number of candidates to select.
+        lambda_mult (float): 1.0 ranks by relevance only, 0.0 by diversity only.
+
+    Returns:
+        List[int]: Indices of the selected candidates, in selection order.
+    """
+    vectors = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    relevance = np.asarray(relevance, dtype=np.float32)
+    spread = float(relevance.max() - relevance.min())
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+
+    count = len(relevance)
+    available = np.ones(count, dtype=bool)
+    max_similarity = np.zeros(count, dtype=np.float32)
+    selected = []
+    for step in range(min(top_n, count)):
+        scores = relevance if step == 0 else lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        scores = np.where(available, scores, -np.inf)
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        available[chosen] = False
+        max_similarity = similarity[chosen] if step == 0 else np.maximum(max_similarity, similarity[chosen])
+    return selected
+
+
+def mean_redundancy(embeddings):
+    """Mean pairwise cosine similarity of a set of embeddings (0 for fewer than two)."""
+    if len(embeddings) < 2:
+        return 0.0
+    vectors = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    count = len(vectors)
+    return float((similarity.sum() - np.trace(similarity)) / (count * (count - 1)))
+
+
+class MMRSelector:
+    """Picks diverse documents from a reranked pool and tracks the redundancy it removes."""
+
+    def __init__(self, enabled=None, lambda_mult=None, pool=None, top_n=None):
+        self.enabled = MMR_ENABLED if enabled is None else enabled
+        self.lambda_mult = MMR_LAMBDA if lambda_mult is None else lambda_mult
+        self.pool = pool or MMR_POOL
+        self.top_n = MMR_TOP_N if top_n is None else top_n
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.skipped = 0
+        self.documents_in = 0
+        self.documents_out = 0
+        self.redundancy_before = 0.0
+        self.redundancy_after = 0.0
+
+    def pool_size(self, re_rank_top):
+        """Number of reranked documents to keep for selection."""
+        return max(re_rank_top, self.pool) if self.enabled else re_rank_top
+
+    def output_size(self, re_rank_top):
+        return min(self.top_n, re_rank_top) if self.top_n > 0 else re_rank_top
+
+    async def aselect(self, retriever, documents, re_rank_top, scores=None):
+        """
+        Choose the final documents from a reranked pool.
+
+        Args:
+            retriever: The retriever that produced the documents (provides afetch_embeddings).
+            documents (List[Document]): Reranked documents, best first.
+            re_rank_top (int): Number of documents the caller would keep without MMR.
+            scores (List[float]): Rerank scores of the documents; defaults to their
+                                  rerank_score metadata, then to their rank.
+
+        Returns:
+            List[Document]: The selected documents, in selection order.
+        """
+        top_n = self.output_size(re_rank_top)
+        if not self.enabled or len(documents) <= top_n or not hasattr(retriever, "afetch_embeddings"):
+            return documents[:top_n]
+        embeddings = await retriever.afetch_embeddings(documents)
+        if embeddings is None or any(embedding is None for embedding in embeddings):
+            with self._lock:
+                self.skipped += 1
+            return documents[:top_n]
+
+        if scores is None:
+            scores = [doc.metadata.get("rerank_score") for doc in documents]
+        if any(score is None for score in scores) or len(set(scores)) == 1:
+            # No usable rerank scores (e.g. the reranker failed): relevance follows retrieval order.
+            scores = [-rank for rank in range(len(documents))]
+        matrix = np.vstack(embeddings)
+        selected = mmr_select(matrix, scores, top_n, self.lambda_mult)
+
+        before, after = mean_redundancy(matrix[:top_n]), mean_redundancy(matrix[selected])
+        with self._lock:
+            self.calls += 1
+            self.documents_in += len(documents)
+            self.documents_out += len(selected)
+            self.redundancy_before += before
+            self.redundancy_after += after
+        print(f"[DEBUG] MMR: {len(selected)} of {len(documents)} documents, "
+              f"mean similarity {before:.3f} -> {after:.3f}")
+        return [documents[i] for i in selected]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "lambda": self.lambda_mult,
+                "pool": self.pool,
+                "top_n": self.top_n,
+                "calls": self.calls,
+                "skipped": self.skipped,
+                "documents_in": self.documents_in,
+                "documents_out": self.documents_out,
+                "mean_redundancy_top": self.redundancy_before / self.calls if self.calls else 0.0,
+                "mean_redundancy_mmr": self.redundancy_after / self.calls if self.calls else 0.0,
+            }
+
+
+mmr_selector = MMRSelector()
@@ -0,0 +1,101 @@
+import threading
+import time
+
+from sentence_transformers import CrossEncoder
+
+from embedd_class import customembedding
+
+DEFAULT_EMBEDDING_MODEL = "mixedbread-ai/mxbai-embed-large-v1"
+DEFAULT_CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+def _torch_module(model):
+    """Return the underlying torch module of a loaded model wrapper, if any."""
+    if isinstance(model, customembedding):
+        return model.model
+    if isinstance(model, CrossEncoder):
+        return model.model
+    return model
+
+
+def _resident_bytes(module):
+    """Bytes held by a torch module's parameters and buffers."""
+    try:
+        total = sum(p.numel() * p.element_size() for p in module.parameters())
+        total += sum(b.numel() * b.element_size() for b in module.buffers())
+        return total
+    except AttributeError:
+        return None
+
+
+def _device(module):
+    try:
+        return str(next(module.parameters()).device)
+    except (AttributeError, StopIteration):
+        return None
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of loaded models.
+
+    Each (kind, model_name) pair is loaded exactly once per process and the
+    same handle is returned to every caller, so api_app, hybrid and reranker
+    share one copy of the embedding model and of the cross-encoder.
+    """
+
+    def __init__(self):
+        self._models = {}  # (kind, model_name) -> model
+        self._load_seconds = {}
+        self._lock = threading.Lock()
+
+    def _get_or_load(self, kind, model_name, loader):
+        key = (kind, model_name)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            # Another thread may have finished loading while we waited for the lock.
+            model = self._models.get(key)
+            if model is None:
+                print(f"[INFO] Loading {kind} model '{model_name}'")
+                start = time.perf_counter()
+                model = loader(model_name)
+                self._load_seconds[key] = round(time.perf_counter() - start, 2)
+                self._models[key] = model
+                print(f"[INFO] Loaded {kind} model '{model_name}' in {self._load_seconds[key]}s")
+            return model
+
+    def embedding(self, model_name=DEFAULT_EMBEDDING_MODEL):
+        """Shared customembedding instance for the given sentence-transformers model."""
+        return self._get_or_load("embedding", model_name, customembedding)
+
+    def cross_encoder(self, model_name=DEFAULT_CROSS_ENCODER_MODEL):
+        """Shared CrossEncoder instance for the given model."""
+        return self._get_or_load("cross_encoder", model_name, CrossEncoder)
+
+    def stats(self):
+        """Per-model load time, device and resident parameter memory."""
+        with self._lock:
+            items = list(self._models.items())
+        models = []
+        total_bytes = 0
+        for (kind, model_name), model in items:
+            module = _torch_module(model)
+            resident = _resident_bytes(module)
+            total_bytes += resident or 0
+            models.append({
+                "kind": kind,
+                "model_name": model_name,
+                "device": _device(module),
+                "resident_mb": round(resident / (1024 * 1024), 1) if resident is not None else None,
+                "load_seconds": self._load_seconds.get((kind, model_name)),
+            })
+        return {
+            "models": models,
+            "total_resident_mb": round(total_bytes / (1024 * 1024), 1),
+        }
+
+
+# Process-wide instance shared by every module that needs a model.
+model_registry = ModelRegistry()
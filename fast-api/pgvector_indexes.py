@@ -0,0 +1,585 @@
+"""
+Vector index management for the document_embeddings_* tables.
+
+Usage:
+    python pgvector_indexes.py status  [--tables t1 t2 ...]
+    python pgvector_indexes.py build   [--tables ...] [--method hnsw|ivfflat] [--rebuild]
+                                       [--m 16] [--ef-construction 64] [--lists N]
+                                       [--with-primary-key] [--datasets gs airforce]
+                                       [--quantization none|halfvec|binary|matryoshka]
+    python pgvector_indexes.py lexical [--tables ...]
+    python pgvector_indexes.py hashes  [--tables ...]
+
+Indexes must be built after the table is loaded: ivfflat trains its list
+centroids on the rows present at CREATE INDEX time, and HNSW builds much
+faster in one pass than through incremental inserts. The operator class is
+chosen from VECTOR_DISTANCE so the index matches the distance operator used by
+PGVectorRetriever. The `lexical` command adds the generated content_tsv column
+and GIN index used by PGVectorRetriever's hybrid (vector + full-text) mode.
+`--datasets` builds partial indexes over the rows of one dataset of the
+unified table (see unified_embeddings.py) instead of the whole-table index.
+`--quantization` indexes a halfvec or binary_quantize() expression of the
+embedding instead of the full vector (pgvector >= 0.7); the table keeps the
+float32 vectors, which PGVectorRetriever uses to rescore the shortlist.
+`--quantization matryoshka` adds the truncated embedding_short column (the
+first VECTOR_SHORT_DIMENSIONS dimensions, re-normalized) and indexes it.
+`hashes` (also run by `build`) creates the B-tree indexes on the hash columns
+behind PGVectorRetriever's knowledge-graph filter, with CREATE INDEX
+CONCURRENTLY so the table stays writable while they build.
+"""
+import argparse
+import math
+import os
+import re
+import time
+
+from db_utils import connect_db
+
+DEFAULT_TABLES = ["document_embeddings_combined", "document_embeddings_gs", "document_embeddings_airforce"]
+
+# distance name -> (SQL operator used in ORDER BY, operator class for the index)
+DISTANCE_OPERATORS = {
+    "l2": ("<->", "vector_l2_ops"),
+    "cosine": ("<=>", "vector_cosine_ops"),
+    "ip": ("<#>", "vector_ip_ops"),
+}
+
+# Distance used by PGVectorRetriever and by the indexes built here.
+VECTOR_DISTANCE = os.environ.get("VECTOR_DISTANCE", "l2").lower()
+if VECTOR_DISTANCE not in DISTANCE_OPERATORS:
+    raise ValueError(f"VECTOR_DISTANCE must be one of {sorted(DISTANCE_OPERATORS)}, got '{VECTOR_DISTANCE}'")
+
+# First-stage index representation: "none" (full vector), "halfvec" (float16),
+# "binary" (binary_quantize, Hamming distance) or "matryoshka" (the truncated
+# embedding_short column). Reduced first stages are rescored against the stored
+# full float32 vectors.
+QUANTIZATIONS = ("none", "halfvec", "binary", "matryoshka")
+VECTOR_QUANTIZATION = os.environ.get("VECTOR_QUANTIZATION", "none").lower()
+if VECTOR_QUANTIZATION not in QUANTIZATIONS:
+    raise ValueError(f"VECTOR_QUANTIZATION must be one of {QUANTIZATIONS}, got '{VECTOR_QUANTIZATION}'")
+# Embedding dimensions; the quantized casts need them (mxbai-embed-large-v1: 1024).
+VECTOR_DIMENSIONS = int(os.environ.get("VECTOR_DIMENSIONS", 1024))
+# Leading dimensions kept in embedding_short (mxbai-embed-large-v1 is Matryoshka-trained).
+VECTOR_SHORT_DIMENSIONS = int(os.environ.get("VECTOR_SHORT_DIMENSIONS", 256))
+
+# Knowledge-graph node levels and the pgvector column holding each level's hash.
+HASH_COLUMNS = {
+    "document": "hash_document",
+    "chapter": "hash_chapter",
+    "section": "hash_section",
+    "subsection": "hash_subsection",
+}
+
+# Text search configuration used for content_tsv and for parsing queries in hybrid mode.
+LEXICAL_TS_CONFIG = os.environ.get("LEXICAL_TS_CONFIG", "english")
+
+# Per-request search tuning defaults (overridable through search_kwargs).
+DEFAULT_EF_SEARCH = int(os.environ.get("VECTOR_EF_SEARCH", 40))
+DEFAULT_IVFFLAT_PROBES = int(os.environ["VECTOR_IVFFLAT_PROBES"]) if os.environ.get("VECTOR_IVFFLAT_PROBES") else None
+
+
+def distance_operator(distance=None):
+    return DISTANCE_OPERATORS[distance or VECTOR_DISTANCE][0]
+
+
+def operator_class(distance=None, quantization="none"):
+    if quantization == "binary":
+        return "bit_hamming_ops"
+    opclass = DISTANCE_OPERATORS[distance or VECTOR_DISTANCE][1]
+    if quantization == "halfvec":
+        return opclass.replace("vector_", "halfvec_", 1)
+    return opclass
+
+
+def quantization_of(opclass, definition=""):
+    """Quantization an index belongs to, from its operator class and definition."""
+    if "embedding_short" in definition:
+        return "matryoshka"
+    if opclass.startswith("bit_"):
+        return "binary"
+    if opclass.startswith("halfvec_"):
+        return "halfvec"
+    return "none"
+
+
+def indexed_expression(quantization="none"):
+    """Indexed expression of the embedding column for a quantization."""
+    if quantization == "halfvec":
+        return f"(embedding::halfvec({VECTOR_DIMENSIONS}))"
+    if quantization == "binary":
+        return f"(binary_quantize(embedding)::bit({VECTOR_DIMENSIONS}))"
+    if quantization == "matryoshka":
+        return "embedding_short"
+    return "embedding"
+
+
+def first_stage_distance(quantization="none", distance=None):
+    """
+    Distance expression ordering the first-stage scan, with one %s for the query
+    vector literal. It repeats indexed_expression exactly so the planner uses the index.
+    """
+    if quantization == "halfvec":
+        return f"{indexed_expression('halfvec')} {distance_operator(distance)} %s::halfvec({VECTOR_DIMENSIONS})"
+    if quantization == "binary":
+        return f"{indexed_expression('binary')} <~> binary_quantize(%s::vector)"
+    if quantization == "matryoshka":
+        return (f"embedding_short {distance_operator(distance)} "
+                f"l2_normalize(subvector(%s::vector, 1, {VECTOR_SHORT_DIMENSIONS}))::vector({VECTOR_SHORT_DIMENSIONS})")
+    return f"embedding {distance_operator(distance)} %s::vector"
+
+
+def short_embedding_statements(table_name):
+    """
+    DDL for the Matryoshka first stage: embedding_short is generated from the
+    full embedding, so every insert path (json2pgvector, migrations) fills it.
+    Adding it to a loaded table rewrites the table once.
+    """
+    dims = VECTOR_SHORT_DIMENSIONS
+    return [
+        f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS embedding_short vector({dims}) "
+        f"GENERATED ALWAYS AS (l2_normalize(subvector(embedding, 1, {dims}))::vector({dims})) STORED",
+    ]
+
+
+def dataset_predicate(dataset):
+    """
+    Row filter for one dataset of the unified table. The dataset name is inlined
+    (not bound) so the planner can match it against the partial index predicate.
+    """
+    if not re.fullmatch(r"[a-z0-9_]+", dataset or ""):
+        raise ValueError(f"Invalid dataset name '{dataset}'")
+    return f"datasets @> ARRAY['{dataset}']::text[]"
+
+
+def index_name(table_name, dataset=None, quantization="none"):
+    suffix = "" if quantization == "none" else f"_{quantization}"
+    if dataset:
+        return f"{table_name}_{dataset}_embedding{suffix}_idx"
+    return f"{table_name}_embedding{suffix}_idx"
+
+
+def ivfflat_lists(row_count):
+    """pgvector's guidance: rows/1000 lists up to 1M rows, sqrt(rows) beyond."""
+    if row_count <= 1_000_000:
+        return max(10, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+def create_index_sql(table_name, method="hnsw", distance=None, m=16, ef_construction=64, lists=100, dataset=None,
+                     quantization="none"):
+    """CREATE INDEX statement for the embedding column of table_name (partial when dataset is given)."""
+    opclass = operator_class(distance, quantization)
+    if method == "hnsw":
+        options = f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+    elif method == "ivfflat":
+        options = f"WITH (lists = {int(lists)})"
+    else:
+        raise ValueError(f"Unknown index method '{method}', expected 'hnsw' or 'ivfflat'")
+    predicate = f" WHERE {dataset_predicate(dataset)}" if dataset else ""
+    return (f"CREATE INDEX IF NOT EXISTS {index_name(table_name, dataset, quantization)} "
+            f"ON {table_name} USING {method} ({indexed_expression(quantization)} {opclass}) {options}{predicate}")
+
+
+def search_settings(k, ef_search=None, probes=None):
+    """
+    Transaction-local planner settings for one vector search.
+
+    hnsw.ef_search is raised to at least k, otherwise an HNSW scan returns fewer
+    than k rows. Settings for an index type the table does not use are ignored
+    by PostgreSQL.
+
+    Returns:
+        Tuple[str, list]: A SELECT set_config(...) statement and its parameters, or ("", []).
+    """
+    ef_search = max(int(ef_search or DEFAULT_EF_SEARCH), int(k))
+    probes = probes or DEFAULT_IVFFLAT_PROBES
+    calls = ["set_config('hnsw.ef_search', %s, true)"]
+    params = [str(ef_search)]
+    if probes:
+        calls.append("set_config('ivfflat.probes', %s, true)")
+        params.append(str(int(probes)))
+    return "SELECT " + ", ".join(calls), params
+
+
+def lexical_statements(table_name):
+    """
+    DDL for the full-text side of hybrid search: a stored generated tsvector over
+    content and its GIN index. Adding the column rewrites the table once.
+    """
+    return [
+        f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('{LEXICAL_TS_CONFIG}', coalesce(content, ''))) STORED",
+        f"CREATE INDEX IF NOT EXISTS {table_name}_content_tsv_idx ON {table_name} USING gin (content_tsv)",
+    ]
+
+
+def hash_index_statements(table_name):
+    """
+    CREATE INDEX statements for the hash columns used by the KG hash filter.
+    CONCURRENTLY cannot run inside a transaction; see build_hash_indexes.
+    """
+    return [
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table_name}_{column}_idx ON {table_name} ({column})"
+        for column in HASH_COLUMNS.values()
+    ]
+
+
+# Hash columns that lead a valid index of the table.
+HASH_INDEX_QUERY = """
+    SELECT DISTINCT a.attname
+    FROM pg_index x
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0]
+    WHERE t.relname = %s AND x.indisvalid AND a.attname::text = ANY(%s)
+"""
+
+# Indexes left invalid by an interrupted CREATE INDEX CONCURRENTLY.
+INVALID_INDEX_QUERY = """
+    SELECT i.relname
+    FROM pg_index x
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE t.relname = %s AND NOT x.indisvalid
+"""
+
+
+LEXICAL_COLUMN_QUERY = """
+    SELECT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = %s AND column_name = 'content_tsv'
+    )
+"""
+
+
+VECTOR_INDEX_QUERY = """
+    SELECT i.relname AS index_name, am.amname AS method, opc.opcname AS opclass,
+           pg_relation_size(i.oid) AS size_bytes, pg_get_indexdef(i.oid) AS definition
+    FROM pg_index x
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_am am ON am.oid = i.relam
+    JOIN pg_opclass opc ON opc.oid = x.indclass[0]
+    WHERE t.relname = %s AND am.amname IN ('hnsw', 'ivfflat')
+"""
+
+PRIMARY_KEY_QUERY = """
+    SELECT EXISTS (
+        SELECT 1 FROM pg_index x JOIN pg_class t ON t.oid = x.indrelid
+        WHERE t.relname = %s AND x.indisprimary
+    )
+"""
+
+
+def describe_vector_indexes(rows):
+    """Summarize VECTOR_INDEX_QUERY rows and flag indexes the retriever cannot use."""
+    indexes = []
+    for name, method, opclass, size_bytes, definition in rows:
+        quantization = quantization_of(opclass, definition)
+        indexes.append({
+            "index_name": name,
+            "method": method,
+            "opclass": opclass,
+            "quantization": quantization,
+            "size_mb": round(size_bytes / (1024 * 1024), 1),
+            "matches_distance": opclass == operator_class(quantization=quantization),
+        })
+    return indexes
+
+
+async def check_vector_indexes(cur, table_name, quantizations=None):
+    """
+    Startup check run from initialize_pgvector: warn when a table has no usable
+    vector index for VECTOR_DISTANCE and each first stage the datasets reading it
+    use (default: VECTOR_QUANTIZATION), or no primary key. Never builds indexes, as
+    that can take minutes on a loaded table; use `python pgvector_indexes.py build`.
+    """
+    await cur.execute(VECTOR_INDEX_QUERY, (table_name,))
+    indexes = describe_vector_indexes(await cur.fetchall())
+    usable = []
+    for quantization in (quantizations or [VECTOR_QUANTIZATION]):
+        matching = [ix for ix in indexes if ix["matches_distance"] and ix["quantization"] == quantization]
+        if not matching:
+            found = ", ".join(f"{ix['index_name']} ({ix['method']}/{ix['opclass']})" for ix in indexes) or "none"
+            print(f"[WARNING] Table {table_name} has no {quantization} {operator_class(quantization=quantization)} "
+                  f"vector index (found: {found}); searches will scan the whole table. Run: python "
+                  f"pgvector_indexes.py build --tables {table_name} --quantization {quantization}")
+        usable.extend(matching)
+    await cur.execute(PRIMARY_KEY_QUERY, (table_name,))
+    if not (await cur.fetchone())[0]:
+        print(f"[WARNING] Table {table_name} has no primary key. Run: python pgvector_indexes.py build "
+              f"--tables {table_name} --with-primary-key")
+    return usable
+
+
+async def check_hash_indexes(cur, table_name):
+    """
+    Startup check for the indexes behind the KG hash filter. Without them every
+    filtered search scans the table. Never builds them; use `python pgvector_indexes.py hashes`.
+    """
+    columns = list(HASH_COLUMNS.values())
+    await cur.execute(HASH_INDEX_QUERY, (table_name, columns))
+    indexed = {row[0] for row in await cur.fetchall()}
+    missing = [column for column in columns if column not in indexed]
+    if missing:
+        print(f"[WARNING] Table {table_name} has no index on {', '.join(missing)}; KG-filtered searches "
+              f"will scan the table. Run: python pgvector_indexes.py hashes --tables {table_name}")
+    return not missing
+
+
+async def check_lexical_column(cur, table_name):
+    """Startup check for tables configured for hybrid search."""
+    await cur.execute(LEXICAL_COLUMN_QUERY, (table_name,))
+    present = (await cur.fetchone())[0]
+    if not present:
+        print(f"[WARNING] Table {table_name} is configured for hybrid search but has no content_tsv column; "
+              f"hybrid queries will fail. Run: python pgvector_indexes.py lexical --tables {table_name}")
+    return present
+
+
+async def check_embedding_normalization(cur, table_name, normalize):
+    """
+    Startup check that stored vectors were produced with the same EMBEDDING_NORMALIZE
+    setting as query vectors; a mismatch silently changes L2 and inner-product rankings.
+    """
+    await cur.execute(f"""
+        SELECT avg(abs(vector_norm(embedding) - 1)) FROM (
+            SELECT embedding FROM {table_name} WHERE embedding IS NOT NULL LIMIT 50
+        ) sample
+    """)
+    deviation = (await cur.fetchone())[0]
+    if deviation is None:
+        return True
+    stored_normalized = deviation < 1e-3
+    if stored_normalized != bool(normalize):
+        print(f"[WARNING] Table {table_name} holds {'normalized' if stored_normalized else 'unnormalized'} "
+              f"embeddings but EMBEDDING_NORMALIZE={int(bool(normalize))}; rankings will be off. Set "
+              f"EMBEDDING_NORMALIZE={int(stored_normalized)} or re-embed the table with json2pgvector.py.")
+        return False
+    return True
+
+
+def build_lexical_index(table_name):
+    """Add content_tsv and its GIN index to a table. Returns True on success."""
+    conn = connect_db()
+    if conn is None:
+        print(f"[ERROR] Cannot add lexical index to {table_name}: database connection failed")
+        return False
+    cursor = conn.cursor()
+    try:
+        start = time.perf_counter()
+        for statement in lexical_statements(table_name):
+            print(f"[INFO] {statement}")
+            cursor.execute(statement)
+        cursor.execute(f"ANALYZE {table_name}")
+        conn.commit()
+        print(f"[INFO] Lexical index ready on {table_name} in {time.perf_counter() - start:.1f}s")
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] Failed to add lexical index to {table_name}: {e}")
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def build_hash_indexes(table_name):
+    """
+    Create the KG hash filter indexes of a table with CREATE INDEX CONCURRENTLY,
+    which needs an autocommit connection. Invalid leftovers of an interrupted
+    concurrent build are dropped first, since IF NOT EXISTS would keep them.
+
+    Returns:
+        bool: True on success.
+    """
+    conn = connect_db()
+    if conn is None:
+        print(f"[ERROR] Cannot build hash indexes for {table_name}: database connection failed")
+        return False
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        start = time.perf_counter()
+        names = {f"{table_name}_{column}_idx" for column in HASH_COLUMNS.values()}
+        cursor.execute(INVALID_INDEX_QUERY, (table_name,))
+        for (name,) in cursor.fetchall():
+            if name in names:
+                print(f"[INFO] Dropping invalid index {name}")
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        for statement in hash_index_statements(table_name):
+            print(f"[INFO] {statement}")
+            cursor.execute(statement)
+        print(f"[INFO] Hash indexes ready on {table_name} in {time.perf_counter() - start:.1f}s")
+        return True
+    except Exception as e:
+        print(f"[ERROR] Failed to build hash indexes for {table_name}: {e}")
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def table_status(cursor, table_name):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+    if not cursor.fetchone()[0]:
+        return {"table": table_name, "exists": False}
+    cursor.execute(f"SELECT count(*) FROM {table_name}")
+    row_count = cursor.fetchone()[0]
+    cursor.execute(VECTOR_INDEX_QUERY, (table_name,))
+    indexes = describe_vector_indexes(cursor.fetchall())
+    cursor.execute(PRIMARY_KEY_QUERY, (table_name,))
+    has_primary_key = cursor.fetchone()[0]
+    cursor.execute(LEXICAL_COLUMN_QUERY, (table_name,))
+    has_lexical = cursor.fetchone()[0]
+    cursor.execute(HASH_INDEX_QUERY, (table_name, list(HASH_COLUMNS.values())))
+    hash_indexed = {row[0] for row in cursor.fetchall()}
+    return {
+        "table": table_name,
+        "exists": True,
+        "rows": row_count,
+        "has_primary_key": has_primary_key,
+        "has_lexical": has_lexical,
+        "missing_hash_indexes": [column for column in HASH_COLUMNS.values() if column not in hash_indexed],
+        "vector_indexes": indexes,
+    }
+
+
+def build_vector_index(table_name, method="hnsw", rebuild=False, m=16, ef_construction=64, lists=None,
+                       with_primary_key=False, maintenance_work_mem=None, dataset=None, quantization="none"):
+    """
+    Build (or rebuild) the vector index of a loaded table.
+
+    Args:
+        table_name (str): Table holding an `embedding vector` column.
+        method (str): "hnsw" (default) or "ivfflat".
+        rebuild (bool): Drop the existing embedding index first.
+        m, ef_construction (int): HNSW build parameters.
+        lists (int): ivfflat lists; derived from the row count when omitted.
+        with_primary_key (bool): Add PRIMARY KEY (id) when the table has none.
+        maintenance_work_mem (str): e.g. "2GB"; more memory makes HNSW builds much faster.
+        dataset (str): Build a partial index over this dataset's rows of the unified table.
+        quantization (str): "none", "halfvec", "binary" or "matryoshka" first-stage index
+                            (see VECTOR_QUANTIZATION); "matryoshka" adds embedding_short first.
+
+    Returns:
+        bool: True when the index exists afterwards.
+    """
+    name = index_name(table_name, dataset, quantization)
+    conn = connect_db()
+    if conn is None:
+        print(f"[ERROR] Cannot build vector index for {table_name}: database connection failed")
+        return False
+    cursor = conn.cursor()
+    try:
+        status = table_status(cursor, table_name)
+        if not status["exists"]:
+            print(f"[ERROR] Table {table_name} does not exist")
+            return False
+        if status["rows"] == 0:
+            print(f"[WARNING] Table {table_name} is empty; load it before building the index")
+            return False
+
+        if with_primary_key and not status["has_primary_key"]:
+            print(f"[INFO] Adding primary key (id) to {table_name}")
+            cursor.execute(f"ALTER TABLE {table_name} ADD PRIMARY KEY (id)")
+
+        if rebuild:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        elif any(ix["index_name"] == name for ix in status["vector_indexes"]):
+            print(f"[INFO] {name} already exists; pass --rebuild to recreate it")
+            conn.commit()
+            return True
+
+        row_count = status["rows"]
+        if dataset:
+            cursor.execute(f"SELECT count(*) FROM {table_name} WHERE {dataset_predicate(dataset)}")
+            row_count = cursor.fetchone()[0]
+            if row_count == 0:
+                print(f"[WARNING] Table {table_name} has no rows for dataset '{dataset}'; skipping its index")
+                conn.commit()
+                return False
+
+        if maintenance_work_mem:
+            cursor.execute("SELECT set_config('maintenance_work_mem', %s, true)", (maintenance_work_mem,))
+        if method == "ivfflat" and not lists:
+            lists = ivfflat_lists(row_count)
+        if quantization == "matryoshka":
+            for statement in short_embedding_statements(table_name):
+                print(f"[INFO] {statement}")
+                cursor.execute(statement)
+
+        sql = create_index_sql(table_name, method=method, m=m, ef_construction=ef_construction, lists=lists,
+                               dataset=dataset, quantization=quantization)
+        print(f"[INFO] Building index on {table_name} ({row_count} rows): {sql}")
+        start = time.perf_counter()
+        cursor.execute(sql)
+        cursor.execute(f"ANALYZE {table_name}")
+        conn.commit()
+        print(f"[INFO] Built {name} in {time.perf_counter() - start:.1f}s")
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] Failed to build vector index for {table_name}: {e}")
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def print_status(table_names):
+    conn = connect_db()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        for table_name in table_names:
+            status = table_status(cursor, table_name)
+            if not status["exists"]:
+                print(f"{table_name}: missing")
+                continue
+            print(f"{table_name}: {status['rows']} rows, primary key: {'yes' if status['has_primary_key'] else 'NO'}, "
+                  f"content_tsv: {'yes' if status['has_lexical'] else 'no'}, "
+                  f"hash indexes: {'missing ' + ', '.join(status['missing_hash_indexes']) if status['missing_hash_indexes'] else 'yes'}")
+            if not status["vector_indexes"]:
+                print("  no vector index")
+            for ix in status["vector_indexes"]:
+                flag = "" if ix["matches_distance"] else f"  <-- does not match VECTOR_DISTANCE={VECTOR_DISTANCE}"
+                print(f"  {ix['index_name']}: {ix['method']} {ix['opclass']} {ix['size_mb']} MB{flag}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage pgvector indexes on the document_embeddings_* tables")
+    parser.add_argument("command", choices=["status", "build", "lexical", "hashes"])
+    parser.add_argument("--tables", nargs="+", default=DEFAULT_TABLES, help="Tables to inspect or index")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--rebuild", action="store_true", help="Drop and recreate existing embedding indexes")
+    parser.add_argument("--m", type=int, default=16, help="HNSW max connections per layer")
+    parser.add_argument("--ef-construction", type=int, default=64, help="HNSW build candidate list size")
+    parser.add_argument("--lists", type=int, help="ivfflat lists (default: derived from row count)")
+    parser.add_argument("--with-primary-key", action="store_true", help="Add PRIMARY KEY (id) where missing")
+    parser.add_argument("--maintenance-work-mem", help="maintenance_work_mem for the build, e.g. 2GB")
+    parser.add_argument("--datasets", nargs="+", help="Build partial indexes for these datasets of the unified table")
+    parser.add_argument("--quantization", choices=list(QUANTIZATIONS), default=VECTOR_QUANTIZATION,
+                        help="Index a halfvec or binary-quantized expression instead of the full vector")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print_status(args.tables)
+    elif args.command == "lexical":
+        for table in args.tables:
+            build_lexical_index(table)
+    elif args.command == "hashes":
+        for table in args.tables:
+            build_hash_indexes(table)
+    else:
+        for table in args.tables:
+            build_hash_indexes(table)
+            for dataset in (args.datasets or [None]):
+                build_vector_index(table, method=args.method, rebuild=args.rebuild, m=args.m,
+                                   ef_construction=args.ef_construction, lists=args.lists,
+                                   with_primary_key=args.with_primary_key,
+                                   maintenance_work_mem=args.maintenance_work_mem, dataset=dataset,
+                                   quantization=args.quantization)
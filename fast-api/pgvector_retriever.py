@@ -0,0 +1,435 @@
+import asyncio
+import copy
+import json
+import os
+
+import numpy as np
+from langchain.schema import Document
+
+from db_pool import db
+from db_utils import connect_db
+from dedup import deduplicator
+from pgvector_indexes import (distance_operator, search_settings, dataset_predicate, first_stage_distance,
+                              HASH_COLUMNS, LEXICAL_TS_CONFIG, QUANTIZATIONS, VECTOR_QUANTIZATION)
+
+SEARCH_MODES = ("vector", "hybrid")
+
+# Reciprocal rank fusion constant: score = sum(1 / (RRF_K + rank)) over the vector and lexical rankings.
+RRF_K = int(os.environ.get("RRF_K", 60))
+
+# Two-phase retrieval: candidates carry only id, distance and a snippet long enough for the
+# cross-encoder; full content and metadata are fetched for the reranked winners only.
+TWO_PHASE_RETRIEVAL = os.environ.get("TWO_PHASE_RETRIEVAL", "1").lower() not in ("0", "false", "no")
+RERANK_SNIPPET_CHARS = int(os.environ.get("RERANK_SNIPPET_CHARS", 2000))
+
+# Quantized first stage: shortlist k * VECTOR_RESCORE_FACTOR rows from the halfvec/binary
+# index, then reorder them by full-precision distance.
+VECTOR_RESCORE_FACTOR = int(os.environ.get("VECTOR_RESCORE_FACTOR", 4))
+
+
+def hash_filter_clause(filter_hashes, hash_levels=None):
+    """
+    Build a WHERE condition restricting rows to the given KG node hashes.
+
+    A row matches when any of its hash columns for the selected levels is in
+    filter_hashes, so a KG hit on a chapter selects the chapter row and every
+    section/subsection row beneath it.
+
+    Args:
+        filter_hashes (list): Node hashes returned by the knowledge graph.
+        hash_levels (list): Subset of HASH_COLUMNS keys to match on (default: all levels).
+
+    Returns:
+        Tuple[str, list]: The parenthesized condition (empty when there is nothing to filter)
+                          and its parameters.
+    """
+    if not filter_hashes:
+        return "", []
+    columns = [HASH_COLUMNS[level] for level in (hash_levels or HASH_COLUMNS)]
+    hashes = list(filter_hashes)
+    condition = "(" + " OR ".join(f"{column} = ANY(%s)" for column in columns) + ")"
+    return condition, [hashes] * len(columns)
+
+
+class PGVectorRetriever:
+    """
+    Nearest-neighbour retriever over a document_embeddings_* table.
+
+    search_mode "vector" orders rows by embedding distance. search_mode
+    "hybrid" additionally ranks rows by full-text match on the content_tsv
+    column (see `pgvector_indexes.py lexical`) and fuses both rankings with
+    reciprocal rank fusion in a single SQL statement. The mode can be
+    overridden per request via search_kwargs={"search_mode": ...}.
+
+    On the unified table (see unified_embeddings.py), `dataset` restricts the
+    search to rows tagged with that dataset, which the planner serves from the
+    dataset's partial vector index. dataset=None searches every row.
+
+    With two-phase retrieval (search_kwargs "two_phase", default
+    TWO_PHASE_RETRIEVAL), callers search with candidates_only=True, rerank the
+    snippets and hydrate the winners with afetch_documents.
+
+    With a quantized first stage (search_kwargs "quantization", default
+    VECTOR_QUANTIZATION), the halfvec or binary index produces a shortlist that
+    is rescored against the stored float32 vectors.
+    """
+
+    def __init__(self, embedding_function, table_name="document_embeddings_combined", db_connection=None,
+                 search_mode="vector", dataset=None):
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"search_mode must be one of {SEARCH_MODES}, got '{search_mode}'")
+        self.embedding_function = embedding_function
+        self.table_name = table_name
+        self.db_connection = db_connection
+        self.search_mode = search_mode
+        self.dataset = dataset
+        # Validated once here; inlined into every query so partial indexes match.
+        self._dataset_condition = dataset_predicate(dataset) if dataset else ""
+        self.search_kwargs = {"k": 50}
+
+    def connect_db(self):
+        if self.db_connection is None or self.db_connection.closed:
+            self.db_connection = connect_db()
+        return self.db_connection
+
+    def as_retriever(self, search_kwargs=None):
+        """
+        Return a retriever configured with search_kwargs. A shallow copy is returned so
+        concurrent requests using different k values do not overwrite each other.
+        """
+        if search_kwargs is None:
+            search_kwargs = {"k": 50}
+        retriever = copy.copy(self)
+        retriever.search_kwargs = search_kwargs
+        return retriever
+
+    _METADATA_COLUMNS = """document_title, hash_document, type, category, pdf_path,
+                   chapter_title, section_title, section_number, subsection_title,
+                   hash_chapter, hash_section, hash_subsection"""
+    _COLUMNS = "id, content, embedding {op} %s::vector AS distance, " + _METADATA_COLUMNS
+    # Phase one: just enough to rerank. Phase two: full rows by primary key.
+    _CANDIDATE_COLUMNS = ("id, left(content, %s) AS content, embedding {op} %s::vector AS distance, "
+                          "type, hash_document, hash_chapter, hash_section, hash_subsection")
+    _FETCH_COLUMNS = "id, content, NULL AS distance, " + _METADATA_COLUMNS
+
+    @property
+    def k(self):
+        return self.search_kwargs.get("k", 50)
+
+    @property
+    def mode(self):
+        return self.search_kwargs.get("search_mode", self.search_mode)
+
+    @property
+    def two_phase(self):
+        return self.search_kwargs.get("two_phase", TWO_PHASE_RETRIEVAL)
+
+    @property
+    def quantization(self):
+        quantization = self.search_kwargs.get("quantization", VECTOR_QUANTIZATION)
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {QUANTIZATIONS}, got '{quantization}'")
+        return quantization
+
+    @property
+    def shortlist(self):
+        """Rows taken from the first-stage index before rescoring."""
+        if self.quantization == "none":
+            return self.k
+        return self.k * max(1, int(self.search_kwargs.get("rescore_factor", VECTOR_RESCORE_FACTOR)))
+
+    def _select_columns(self, embedding_literal, candidates_only):
+        """SELECT list and its parameters for full rows or phase-one candidates."""
+        op = distance_operator()
+        if candidates_only:
+            # Full-content fingerprints for dedup, which only sees the snippets otherwise.
+            columns = self._CANDIDATE_COLUMNS.format(op=op) + deduplicator.candidate_columns()
+            return columns, [RERANK_SNIPPET_CHARS, embedding_literal]
+        return self._COLUMNS.format(op=op), [embedding_literal]
+
+    def _vector_search(self, embedding_literal, condition, filter_params, candidates_only=False):
+        columns, column_params = self._select_columns(embedding_literal, candidates_only)
+        if self.quantization != "none":
+            # Shortlist by the quantized index, then rescore by the full-precision distance.
+            sql = f"""
+                SELECT * FROM (
+                    SELECT {columns}
+                    FROM {self.table_name}
+                    {f"WHERE {condition}" if condition else ""}
+                    ORDER BY {first_stage_distance(self.quantization)}
+                    LIMIT %s
+                ) shortlist
+                ORDER BY distance
+                LIMIT %s
+            """
+            return sql, column_params + filter_params + [embedding_literal, self.shortlist, self.k]
+        sql = f"""
+            SELECT {columns}
+            FROM {self.table_name}
+            {f"WHERE {condition}" if condition else ""}
+            ORDER BY distance
+            LIMIT %s
+        """
+        # Parameter order follows the SQL text: SELECT list, hash arrays (WHERE), k (LIMIT).
+        return sql, column_params + filter_params + [self.k]
+
+    def _hybrid_search(self, query_text, embedding_literal, condition, filter_params, candidates_only=False):
+        """
+        Reciprocal rank fusion of the vector ranking and a full-text ranking.
+        Each side contributes its top fetch_k candidates; the lexical query ORs the
+        query's terms so long questions still match partially. With a quantized
+        first stage, the vector ranking uses the quantized distance (RRF only
+        needs ranks); the final distance column is full precision.
+        """
+        columns, column_params = self._select_columns(embedding_literal, candidates_only)
+        fetch_k = max(self.k, int(self.search_kwargs.get("fetch_k", 2 * self.k)))
+        extra = f"AND {condition}" if condition else ""
+        sql = f"""
+            WITH q AS (
+                SELECT to_tsquery('simple', replace(plainto_tsquery('{LEXICAL_TS_CONFIG}', %s)::text, ' & ', ' | ')) AS query
+            ),
+            vector_hits AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+                FROM (
+                    SELECT id, {first_stage_distance(self.quantization)} AS distance
+                    FROM {self.table_name}
+                    {f"WHERE {condition}" if condition else ""}
+                    ORDER BY distance
+                    LIMIT %s
+                ) v
+            ),
+            lexical_hits AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+                FROM (
+                    SELECT id, ts_rank_cd(content_tsv, q.query) AS score
+                    FROM {self.table_name}, q
+                    WHERE content_tsv @@ q.query {extra}
+                    ORDER BY score DESC
+                    LIMIT %s
+                ) l
+            ),
+            fused AS (
+                SELECT id, SUM(1.0 / (%s + rank)) AS rrf_score
+                FROM (SELECT id, rank FROM vector_hits UNION ALL SELECT id, rank FROM lexical_hits) hits
+                GROUP BY id
+            )
+            SELECT {columns}
+            FROM fused JOIN {self.table_name} USING (id)
+            ORDER BY fused.rrf_score DESC
+            LIMIT %s
+        """
+        params = ([query_text, embedding_literal] + filter_params + [fetch_k]
+                  + filter_params + [fetch_k, RRF_K] + column_params + [self.k])
+        return sql, params
+
+    def _build_search(self, query_text, query_embedding, filter_hashes=None, hash_levels=None, candidates_only=False):
+        """Return (sql, params) for the configured search mode."""
+        condition, filter_params = hash_filter_clause(filter_hashes, hash_levels)
+        if self._dataset_condition:
+            condition = f"{self._dataset_condition} AND {condition}" if condition else self._dataset_condition
+        embedding_literal = json.dumps(query_embedding)
+        if self.mode == "hybrid" and query_text:
+            return self._hybrid_search(query_text, embedding_literal, condition, filter_params, candidates_only)
+        return self._vector_search(embedding_literal, condition, filter_params, candidates_only)
+
+    def _search_settings(self):
+        # ef_search / probes may be passed per request through as_retriever(search_kwargs=...).
+        candidates = self.shortlist if self.mode == "vector" else max(self.k, int(self.search_kwargs.get("fetch_k", 2 * self.k)))
+        return search_settings(
+            candidates,
+            ef_search=self.search_kwargs.get("ef_search"),
+            probes=self.search_kwargs.get("probes"),
+        )
+
+    def _describe(self, filter_hashes):
+        mode = f" ({self.mode})" if self.mode != "vector" else ""
+        dataset = f" dataset '{self.dataset}'" if self.dataset else ""
+        among = f" among {len(filter_hashes)} KG hashes" if filter_hashes else ""
+        return f"table '{self.table_name}'{dataset}{mode}{among}"
+
+    def _embed(self, query):
+        # Get the embedding for the query (float32, normalized by the embedding engine)
+        query_embedding = self.embedding_function.embed_batch([query])[0]
+
+        # Convert the embedding to a format suitable for PostgreSQL
+        return query_embedding.tolist()
+
+    def _rows_to_documents(self, results):
+        # Convert the results to Document objects
+        documents = []
+        for row in results:
+            (doc_id, content, distance, doc_title, hash_doc, doc_type, category, pdf_path, chapter_title,
+             section_title, section_number, subsection_title, hash_chapter, hash_section, hash_subsection) = row
+
+            # Create metadata dictionary
+            metadata = {
+                "id": doc_id,
+                "distance": distance,
+                "document_title": doc_title,
+                "hash_document": hash_doc,
+                "type": doc_type,
+                "category": category,
+                "pdf_path": pdf_path,
+                "chapter_title": chapter_title,
+                "section_title": section_title,
+                "section_number": section_number,
+                "subsection_title": subsection_title,
+                "hash_chapter": hash_chapter,
+                "hash_section": hash_section,
+                "hash_subsection": hash_subsection
+            }
+
+            # Filter out None values
+            metadata = {k: v for k, v in metadata.items() if v is not None}
+
+            # Create a Document object
+            document = Document(page_content=content, metadata=metadata)
+            documents.append(document)
+
+        return documents
+
+    def _candidate_rows_to_documents(self, results):
+        # Phase-one rows: id, snippet, distance and the node's type and hash ancestry (used by dedup),
+        # then the full-content fingerprints when dedup is enabled (see ChunkDeduplicator.candidate_columns).
+        documents = []
+        for row in results:
+            doc_id, content, distance, doc_type, hash_doc, hash_chapter, hash_section, hash_subsection = row[:8]
+            metadata = {
+                "id": doc_id,
+                "distance": distance,
+                "type": doc_type,
+                "hash_document": hash_doc,
+                "hash_chapter": hash_chapter,
+                "hash_section": hash_section,
+                "hash_subsection": hash_subsection,
+            }
+            metadata = {k: v for k, v in metadata.items() if v is not None}
+            if len(row) > 8:
+                metadata["content_md5"], metadata["shingles"] = row[8], row[9] or []
+            documents.append(Document(page_content=content or "", metadata=metadata))
+        return documents
+
+    def get_relevant_documents(self, query, filter_hashes=None, hash_levels=None):
+        """
+        Synchronous search used from worker threads (e.g. cypher_retriever).
+        Async callers should use aget_relevant_documents, which borrows a pooled connection.
+
+        Args:
+            query (str): The user query.
+            filter_hashes (list): Optional KG node hashes; only matching rows are searched.
+            hash_levels (list): Hash levels to match filter_hashes against (default: all).
+        """
+        query_embedding = self._embed(query)
+        sql, params = self._build_search(query, query_embedding, filter_hashes, hash_levels)
+
+        print(f"[DEBUG] PGVectorRetriever: Querying PostgreSQL {self._describe(filter_hashes)} for similar documents")
+
+        # Connect to the database
+        conn = self.connect_db()
+        if conn is None:
+            print("Database connection failed in PGVectorRetriever")
+            return []
+
+        try:
+            cursor = conn.cursor()
+            # Apply the index search settings for this transaction only
+            cursor.execute(*self._search_settings())
+            # Query the database for similar embeddings
+            cursor.execute(sql, params)
+
+            results = cursor.fetchall()
+            print(f"[DEBUG] PGVectorRetriever: Retrieved {len(results)} documents from '{self.table_name}'")
+            return self._rows_to_documents(results)
+
+        except Exception as e:
+            print(f"Error in PGVectorRetriever: {e}")
+            return []
+        finally:
+            if conn:
+                conn.close()
+
+    async def aembed_query(self, query):
+        """Compute the query embedding in a worker thread so the event loop is not blocked."""
+        return await asyncio.to_thread(self._embed, query)
+
+    async def asearch_by_vector(self, query_embedding, filter_hashes=None, hash_levels=None, query_text=None,
+                                candidates_only=False):
+        """
+        Run the search for an already computed query embedding on the shared
+        connection pool. Lets callers embed once and issue several searches
+        (e.g. unfiltered and KG-filtered) with the same vector. query_text is
+        required for the lexical half of hybrid mode; without it the search is vector-only.
+        With candidates_only, documents hold only id, distance and a rerank snippet;
+        pass the reranked winners to afetch_documents.
+        """
+        sql, params = self._build_search(query_text, query_embedding, filter_hashes, hash_levels, candidates_only)
+
+        print(f"[DEBUG] PGVectorRetriever: Querying PostgreSQL {self._describe(filter_hashes)} for similar documents (async)")
+
+        try:
+            async with db.transaction() as cur:
+                # Apply the index search settings for this transaction only
+                await cur.execute(*self._search_settings())
+                await cur.execute(sql, params)
+                results = await cur.fetchall()
+            print(f"[DEBUG] PGVectorRetriever: Retrieved {len(results)} {'candidates' if candidates_only else 'documents'} "
+                  f"from '{self.table_name}'")
+            if candidates_only:
+                return self._candidate_rows_to_documents(results)
+            return self._rows_to_documents(results)
+        except Exception as e:
+            print(f"Error in PGVectorRetriever: {e}")
+            return []
+
+    async def afetch_documents(self, candidates):
+        """
+        Phase two: load full content and metadata for the given candidates by
+        primary key. Order, distance, rerank_score and collapsed_ids of the candidates are kept.
+        On failure the candidates are returned unchanged (snippets instead of full text).
+        """
+        ids = [doc.metadata["id"] for doc in candidates if "id" in doc.metadata]
+        if not ids:
+            return candidates
+        sql = f"SELECT {self._FETCH_COLUMNS} FROM {self.table_name} WHERE id = ANY(%s)"
+        try:
+            results = await db.fetchall(sql, (ids,))
+        except Exception as e:
+            print(f"Error in PGVectorRetriever fetching {len(ids)} documents: {e}")
+            return candidates
+        by_id = {doc.metadata["id"]: doc for doc in self._rows_to_documents(results)}
+        documents = []
+        for candidate in candidates:
+            document = by_id.get(candidate.metadata.get("id"))
+            if document is None:
+                documents.append(candidate)
+                continue
+            for key in ("distance", "rerank_score", "collapsed_ids"):
+                if key in candidate.metadata:
+                    document.metadata[key] = candidate.metadata[key]
+            documents.append(document)
+        return documents
+
+    async def afetch_embeddings(self, documents):
+        """
+        Stored embeddings of the given documents, by primary key.
+
+        Returns:
+            List[np.ndarray]: One vector per document (None where missing), or None on failure.
+        """
+        ids = [doc.metadata.get("id") for doc in documents]
+        sql = f"SELECT id, embedding::real[] FROM {self.table_name} WHERE id = ANY(%s)"
+        try:
+            results = await db.fetchall(sql, ([doc_id for doc_id in ids if doc_id is not None],))
+        except Exception as e:
+            print(f"Error in PGVectorRetriever fetching {len(ids)} embeddings: {e}")
+            return None
+        by_id = {doc_id: np.asarray(embedding, dtype=np.float32) for doc_id, embedding in results if embedding}
+        return [by_id.get(doc_id) for doc_id in ids]
+
+    async def aget_relevant_documents(self, query, filter_hashes=None, hash_levels=None):
+        """
+        Async variant of get_relevant_documents that runs the query on the shared
+        connection pool. The embedding is still computed in a worker thread.
+        """
+        query_embedding = await self.aembed_query(query)
+        return await self.asearch_by_vector(query_embedding, filter_hashes, hash_levels, query_text=query)
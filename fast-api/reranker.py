@@ -1,8 +1,14 @@
 # reranker.py
 
-from sentence_transformers import CrossEncoder
+import asyncio
+import os
+import time
 
-def rerank_documents(query, documents, model_name='cross-encoder/ms-marco-MiniLM-L-6-v2'):
+import numpy as np
+
+from model_registry import model_registry, DEFAULT_CROSS_ENCODER_MODEL
+
+def rerank_documents(query, documents, model_name=DEFAULT_CROSS_ENCODER_MODEL, cross_encoder=None):
     """
     Re-rank documents based on relevance to the query using a cross-encoder model.
     
@@ -11,12 +17,16 @@ def rerank_documents(query, documents, model_name='cross-encoder/ms-marco-MiniLM
         documents (list): A list of document objects. Each document should have a 'page_content'
                           attribute or key containing the document text.
         model_name (str): The name of the cross-encoder model to use.
+        cross_encoder (CrossEncoder, optional): An already-loaded cross-encoder, or anything with a
+                          compatible predict() such as a RerankService. When omitted,
+                          the shared instance for model_name is taken from the model registry.
         
     Returns:
         List[Tuple[float, Document]]: A list of tuples (score, document) sorted by score in descending order.
     """
-    # Initialize the cross-encoder
-    cross_encoder = CrossEncoder(model_name)
+    # Reuse the process-wide cross-encoder instead of loading a new one per call
+    if cross_encoder is None:
+        cross_encoder = model_registry.cross_encoder(model_name)
     
     # Create query-document pairs for scoring
     pairs = []
@@ -34,3 +44,182 @@ def rerank_documents(query, documents, model_name='cross-encoder/ms-marco-MiniLM
     # Pair each document with its score and sort by score (highest first)
     scored_docs = sorted(zip(scores, documents), key=lambda x: x[0], reverse=True)
     return scored_docs
+
+
+class RerankService:
+    """
+    In-process micro-batching front end for a cross-encoder.
+
+    Concurrent requests submit (query, passage) pairs to a shared queue. A single
+    worker task drains the queue into batches of up to `max_batch_pairs` pairs,
+    waiting at most `max_wait_ms` for more requests to arrive once the first one
+    is queued, runs one predict call in a worker thread and hands each request
+    its slice of the scores. N concurrent chats therefore cost a few large
+    predict calls instead of N small ones competing for the same cores.
+
+    Configuration (environment variables):
+        RERANK_MAX_BATCH_PAIRS  maximum pairs per predict call (default 128)
+        RERANK_MAX_WAIT_MS      latency budget for filling a batch (default 10)
+    """
+
+    def __init__(self, cross_encoder=None, model_name=DEFAULT_CROSS_ENCODER_MODEL,
+                 max_batch_pairs=None, max_wait_ms=None):
+        self.cross_encoder = cross_encoder if cross_encoder is not None else model_registry.cross_encoder(model_name)
+        self.max_batch_pairs = max_batch_pairs or int(os.environ.get("RERANK_MAX_BATCH_PAIRS", 128))
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.environ.get("RERANK_MAX_WAIT_MS", 10))) / 1000.0
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._carry = None
+        # Metrics
+        self.requests = 0
+        self.batches = 0
+        self.batched_pairs = 0
+        self.max_batch_seen = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+
+    @property
+    def running(self):
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        """Start the batching worker on the running event loop."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+        print(f"[INFO] Rerank service started (max_batch_pairs={self.max_batch_pairs}, max_wait_ms={self.max_wait * 1000:.0f})")
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        # Fail the requests still waiting so their callers do not hang.
+        pending = [self._carry] if self._carry is not None else []
+        self._carry = None
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        self._fail(pending)
+        print(f"[INFO] Rerank service stopped ({len(pending)} queued requests failed)")
+
+    @staticmethod
+    def _fail(items):
+        for _, future, _ in items:
+            if not future.done():
+                future.set_exception(RuntimeError("rerank service stopped"))
+
+    async def score_pairs(self, pairs):
+        """
+        Score a list of [query, passage] pairs through the shared batching queue.
+
+        Returns:
+            list[float]: One score per pair, in input order.
+        """
+        if not pairs:
+            return []
+        if not self.running:
+            scores = await asyncio.to_thread(self.cross_encoder.predict, pairs)
+            return list(scores)
+        future = self._loop.create_future()
+        await self._queue.put((pairs, future, time.perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await future
+
+    async def score(self, query, passages):
+        """Score passages against a single query."""
+        return await self.score_pairs([[query, passage] for passage in passages])
+
+    def predict(self, pairs, **kwargs):
+        """
+        Synchronous, CrossEncoder-compatible entry point for code running in worker
+        threads (e.g. cypher_retriever). Pairs are routed through the batching queue
+        when the service is running on another thread's loop.
+        """
+        if not self.running:
+            return self.cross_encoder.predict(pairs, **kwargs)
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            # Blocking on our own loop would deadlock; score directly instead.
+            return self.cross_encoder.predict(pairs, **kwargs)
+        future = asyncio.run_coroutine_threadsafe(self.score_pairs(pairs), self._loop)
+        return np.asarray(future.result(), dtype=np.float32)
+
+    async def _next_request(self, timeout=None):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        if timeout is None:
+            return await self._queue.get()
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = [await self._next_request()]
+                size = len(batch[0][0])
+                deadline = self._loop.time() + self.max_wait
+                while size < self.max_batch_pairs:
+                    remaining = deadline - self._loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await self._next_request(remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if size + len(item[0]) > self.max_batch_pairs:
+                        # Keep the request for the next batch rather than overshoot the budget.
+                        self._carry = item
+                        break
+                    batch.append(item)
+                    size += len(item[0])
+
+                pairs = [pair for request_pairs, _, _ in batch for pair in request_pairs]
+                try:
+                    scores = await asyncio.to_thread(self.cross_encoder.predict, pairs, batch_size=len(pairs))
+                except Exception as e:
+                    print(f"[ERROR] Rerank batch of {len(pairs)} pairs failed: {e}")
+                    for _, future, _ in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                now = time.perf_counter()
+                self.requests += len(batch)
+                self.batches += 1
+                self.batched_pairs += len(pairs)
+                self.max_batch_seen = max(self.max_batch_seen, len(pairs))
+                offset = 0
+                for request_pairs, future, queued_at in batch:
+                    self.total_wait += now - queued_at
+                    if not future.done():
+                        future.set_result([float(s) for s in scores[offset:offset + len(request_pairs)]])
+                    offset += len(request_pairs)
+        except asyncio.CancelledError:
+            # Requests already taken off the queue for the interrupted batch.
+            self._fail(batch)
+            raise
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_pairs": round(self.batched_pairs / self.batches, 1) if self.batches else 0.0,
+            "max_batch_pairs_seen": self.max_batch_seen,
+            "avg_request_latency_ms": round(self.total_wait / self.requests * 1000, 1) if self.requests else 0.0,
+            "max_batch_pairs": self.max_batch_pairs,
+            "max_wait_ms": self.max_wait * 1000,
+        }
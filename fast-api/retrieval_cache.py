@@ -0,0 +1,138 @@
+import asyncio
+import os
+import time
+
+from cache_utils import TTLCache
+from db_pool import db, DatabaseError
+from embedding_cache import normalize_text
+
+# One row per embeddings table; json2pgvector bumps `version` after every load.
+CORPUS_VERSIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS corpus_versions (
+        table_name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 1,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+"""
+
+BUMP_CORPUS_VERSION_SQL = """
+    INSERT INTO corpus_versions (table_name, version, updated_at)
+    VALUES (%s, 1, now())
+    ON CONFLICT (table_name) DO UPDATE
+    SET version = corpus_versions.version + 1, updated_at = now()
+    RETURNING version
+"""
+
+
+def bump_corpus_version(cursor, table_name):
+    """
+    Increment table_name's row in corpus_versions so API workers drop retrieval
+    results cached against the previous contents. Used by the offline loaders
+    with a psycopg2 cursor; the caller commits.
+
+    Returns:
+        int: The new version.
+    """
+    cursor.execute(CORPUS_VERSIONS_DDL)
+    cursor.execute(BUMP_CORPUS_VERSION_SQL, (table_name,))
+    return cursor.fetchone()[0]
+
+
+class CorpusVersions:
+    """
+    In-process view of the corpus_versions table, refreshed at most every
+    `ttl` seconds. A reload of a table by json2pgvector therefore invalidates
+    cached retrieval results within one refresh interval.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else float(os.environ.get("CORPUS_VERSION_TTL", 30))
+        self._versions = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self, table_name):
+        if time.monotonic() - self._loaded_at > self.ttl:
+            async with self._lock:
+                # Another request may have refreshed while we waited.
+                if time.monotonic() - self._loaded_at > self.ttl:
+                    await self._refresh()
+        return self._versions.get(table_name, 0)
+
+    async def _refresh(self):
+        try:
+            rows = await db.fetchall("SELECT table_name, version FROM corpus_versions")
+            self._versions = {table_name: version for table_name, version in rows}
+        except DatabaseError as e:
+            print(f"[WARNING] Could not read corpus_versions, keeping previous versions: {e}")
+        self._loaded_at = time.monotonic()
+
+
+class RetrievalCache:
+    """
+    Cache of final retrieval results, shared by /api/chat and /api/sources.
+
+    Keyed by (normalized query, dataset, table, k, re_rank_top, corpus version),
+    it stores the (context, reranked documents with their scores, node_count)
+    tuple so a source lookup for a question that was just answered skips
+    Neo4j, embedding, pgvector and the cross-encoder. Concurrent requests for
+    the same key share one in-flight computation.
+
+    Configuration (environment variables):
+        RETRIEVAL_CACHE_TTL          seconds a result is kept (default 600, 0 disables)
+        RETRIEVAL_CACHE_MAX_ENTRIES  maximum cached results (default 2000)
+        CORPUS_VERSION_TTL           seconds between corpus_versions polls (default 30)
+    """
+
+    def __init__(self, ttl=None, max_entries=None, versions=None):
+        ttl = ttl if ttl is not None else int(os.environ.get("RETRIEVAL_CACHE_TTL", 600))
+        max_entries = max_entries if max_entries is not None else int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", 2000))
+        self.cache = TTLCache("retrieval", ttl=ttl, max_entries=max_entries)
+        self.versions = versions or CorpusVersions()
+        self._inflight = {}
+        self.shared_inflight = 0
+
+    async def get_or_compute(self, query, dataset, table_name, k, re_rank_top, compute):
+        """
+        Return the cached result for this retrieval, or await compute() and cache it.
+
+        Args:
+            query (str): The user message.
+            dataset (str): Dataset option selected in the UI.
+            table_name (str): Embeddings table the retrieval reads (selects the corpus version).
+            k (int): Candidates retrieved before reranking.
+            re_rank_top (int): Documents kept after reranking (None when not reranked).
+            compute (callable): Zero-argument coroutine function producing the result.
+        """
+        version = await self.versions.get(table_name)
+        key = (normalize_text(query), dataset, table_name, k, re_rank_top, version)
+        cached = self.cache.get(key)
+        if cached is not None:
+            print(f"[DEBUG] Retrieval cache hit for dataset '{dataset}' (corpus version {version})")
+            return cached
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.shared_inflight += 1
+            return await asyncio.shield(inflight)
+
+        task = asyncio.ensure_future(compute())
+        self._inflight[key] = task
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            self._inflight.pop(key, None)
+        # Do not cache empty results; they usually mean a stage timed out or failed.
+        if result and result[1]:
+            self.cache.set(key, result)
+        return result
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["inflight"] = len(self._inflight)
+        stats["shared_inflight"] = self.shared_inflight
+        stats["corpus_versions"] = dict(self.versions._versions)
+        return stats
+
+
+retrieval_cache = RetrievalCache()
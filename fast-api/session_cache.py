@@ -0,0 +1,74 @@
+import os
+import threading
+from datetime import datetime
+
+from cache_utils import TTLCache
+
+
+class SessionCache:
+    """
+    Cache of session_token -> user_info used by get_current_user.
+
+    Only sessions of enabled users are cached, and an entry never outlives the
+    session's own expires_at. A reverse index from user_id to cached tokens
+    lets admin actions (disable/enable, password change, reassignment) and
+    logout drop every cached session of a user so the next request goes back
+    to PostgreSQL and sees the current account state.
+
+    Configuration (environment variables):
+        SESSION_CACHE_TTL          seconds an entry stays valid (default 60, 0 disables)
+        SESSION_CACHE_MAX_ENTRIES  maximum cached sessions (default 10000)
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        ttl = ttl if ttl is not None else int(os.environ.get("SESSION_CACHE_TTL", 60))
+        max_entries = max_entries if max_entries is not None else int(os.environ.get("SESSION_CACHE_MAX_ENTRIES", 10000))
+        self._cache = TTLCache("session", ttl=ttl, max_entries=max_entries)
+        self._tokens_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_token):
+        user_info = self._cache.get(session_token)
+        # Hand out a copy so request handlers cannot mutate the cached entry.
+        return dict(user_info) if user_info is not None else None
+
+    def put(self, session_token, user_info, expires_at=None):
+        if user_info.get("disabled"):
+            return
+        ttl = self._cache.ttl
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - datetime.now()).total_seconds())
+        if ttl <= 0:
+            return
+        self._cache.set(session_token, dict(user_info), ttl=ttl)
+        with self._lock:
+            user_key = str(user_info["user_id"])
+            # Drop tokens whose entries already expired or were evicted.
+            tokens = {t for t in self._tokens_by_user.get(user_key, ()) if t in self._cache}
+            tokens.add(session_token)
+            self._tokens_by_user[user_key] = tokens
+
+    def invalidate_token(self, session_token):
+        user_info = self._cache.pop(session_token)
+        if user_info is not None:
+            with self._lock:
+                tokens = self._tokens_by_user.get(str(user_info["user_id"]))
+                if tokens is not None:
+                    tokens.discard(session_token)
+                    if not tokens:
+                        del self._tokens_by_user[str(user_info["user_id"])]
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            tokens = self._tokens_by_user.pop(str(user_id), set())
+        for token in tokens:
+            self._cache.pop(token)
+
+    def stats(self):
+        stats = self._cache.stats()
+        with self._lock:
+            stats["users"] = len(self._tokens_by_user)
+        return stats
+
+
+session_cache = SessionCache()
@@ -0,0 +1,220 @@
+"""
+Single embeddings table shared by all datasets.
+
+document_embeddings_combined, _gs, _airforce (and _stratcom) store largely the
+same rows with the same embeddings. The unified table stores each row once,
+with a `datasets text[]` column listing the datasets it belongs to. The
+whole-table vector index serves "combined", and each other dataset gets a
+partial index over its own rows (WHERE datasets @> ARRAY['gs']).
+PGVectorRetriever(..., dataset="gs") adds the same predicate, so the planner
+uses the matching partial index.
+
+Usage:
+    python unified_embeddings.py migrate [--target document_embeddings_all] [--method hnsw|ivfflat]
+                                         [--maintenance-work-mem 2GB] [--drop-legacy]
+    python unified_embeddings.py status  [--target document_embeddings_all]
+
+The API reads the unified table when EMBEDDINGS_LAYOUT=unified.
+"""
+import argparse
+import os
+
+from db_utils import connect_db
+from pgvector_indexes import build_hash_indexes, build_vector_index, dataset_predicate, lexical_statements
+from retrieval_cache import bump_corpus_version
+
+UNIFIED_TABLE = os.environ.get("UNIFIED_EMBEDDINGS_TABLE", "document_embeddings_all")
+
+# Dataset label -> legacy per-dataset table. Migration order matters: when an id
+# exists in several tables, the content and embedding of the first one are kept.
+LEGACY_TABLES = {
+    "combined": "document_embeddings_combined",
+    "gs": "document_embeddings_gs",
+    "airforce": "document_embeddings_airforce",
+    "stratcom": "document_embeddings_stratcom",
+}
+
+# Datasets searched through a partial index; "combined" uses the whole-table index.
+PARTIAL_INDEX_DATASETS = ["gs", "airforce", "stratcom"]
+
+EMBEDDING_COLUMNS = [
+    "id", "content", "embedding", "type", "hash_document", "document_title",
+    "category", "pdf_path", "hash_chapter", "chapter_title", "chapter_number",
+    "hash_section", "section_title", "section_number", "section_page_number",
+    "hash_subsection", "subsection_title", "subsection_number",
+    "subsection_page_number", "composite_id",
+]
+
+
+def unified_table_ddl(table_name=UNIFIED_TABLE):
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            id TEXT PRIMARY KEY,
+            content TEXT,
+            embedding vector(1024),
+            type TEXT,
+            hash_document TEXT,
+            document_title TEXT,
+            category TEXT,
+            pdf_path TEXT,
+            hash_chapter TEXT,
+            chapter_title TEXT,
+            chapter_number TEXT,
+            hash_section TEXT,
+            section_title TEXT,
+            section_number TEXT,
+            section_page_number TEXT,
+            hash_subsection TEXT,
+            subsection_title TEXT,
+            subsection_number TEXT,
+            subsection_page_number TEXT,
+            composite_id TEXT,
+            datasets TEXT[] NOT NULL DEFAULT '{{}}'
+        )
+    """
+
+
+def unified_index_statements(table_name=UNIFIED_TABLE):
+    """
+    Non-vector indexes of the unified table created with it: dataset membership and
+    full text. The KG hash indexes are built concurrently afterwards (build_hash_indexes).
+    """
+    return ([f"CREATE INDEX IF NOT EXISTS {table_name}_datasets_idx ON {table_name} USING gin (datasets)"]
+            + lexical_statements(table_name))
+
+
+def merge_datasets_sql(table_name=UNIFIED_TABLE):
+    """ON CONFLICT assignment adding the incoming row's datasets to the stored row's."""
+    return (f"datasets = ARRAY(SELECT DISTINCT d FROM unnest({table_name}.datasets || EXCLUDED.datasets) d "
+            f"ORDER BY d)")
+
+
+def _table_exists(cursor, table_name):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+    return cursor.fetchone()[0]
+
+
+def migrate(target=UNIFIED_TABLE, method="hnsw", maintenance_work_mem=None, drop_legacy=False):
+    """
+    Copy the legacy per-dataset tables into the unified table, then build its indexes.
+
+    Rows are copied server-side (INSERT ... SELECT). A row whose id is already
+    present only gains the dataset label. Re-running the migration is safe.
+
+    Returns:
+        bool: True when every existing legacy table was copied.
+    """
+    conn = connect_db()
+    if conn is None:
+        print("[ERROR] Cannot migrate: database connection failed")
+        return False
+    cursor = conn.cursor()
+    columns = ", ".join(EMBEDDING_COLUMNS)
+    migrated = []
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cursor.execute(unified_table_ddl(target))
+        conn.commit()
+
+        for dataset, legacy_table in LEGACY_TABLES.items():
+            if not _table_exists(cursor, legacy_table):
+                print(f"[INFO] {legacy_table} does not exist, skipping dataset '{dataset}'")
+                continue
+            cursor.execute(f"""
+                INSERT INTO {target} ({columns}, datasets)
+                SELECT {columns}, ARRAY[%s]::text[] FROM {legacy_table}
+                ON CONFLICT (id) DO UPDATE SET {merge_datasets_sql(target)}
+                WHERE NOT {target}.datasets @> EXCLUDED.datasets
+            """, (dataset,))
+            print(f"[INFO] {legacy_table} -> {target} as '{dataset}': {cursor.rowcount} rows inserted or tagged")
+            conn.commit()
+            migrated.append((dataset, legacy_table))
+
+        for statement in unified_index_statements(target):
+            cursor.execute(statement)
+        bump_corpus_version(cursor, target)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"[ERROR] Migration into {target} failed: {e}")
+        return False
+    finally:
+        cursor.close()
+        conn.close()
+
+    # Hash and vector indexes are built once the table is fully loaded.
+    ok = build_hash_indexes(target)
+    ok = build_vector_index(target, method=method, maintenance_work_mem=maintenance_work_mem) and ok
+    for dataset, _ in migrated:
+        if dataset in PARTIAL_INDEX_DATASETS:
+            ok = build_vector_index(target, method=method, maintenance_work_mem=maintenance_work_mem,
+                                    dataset=dataset) and ok
+
+    if drop_legacy and ok:
+        drop_legacy_tables([legacy_table for _, legacy_table in migrated])
+    elif drop_legacy:
+        print("[WARNING] Index build failed; legacy tables were kept")
+    return ok
+
+
+def drop_legacy_tables(table_names):
+    conn = connect_db()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        for table_name in table_names:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+            print(f"[INFO] Dropped {table_name}")
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def print_status(target=UNIFIED_TABLE):
+    """Row counts per dataset and on-disk size of the unified table versus the legacy tables."""
+    conn = connect_db()
+    if conn is None:
+        return
+    cursor = conn.cursor()
+    try:
+        if not _table_exists(cursor, target):
+            print(f"{target}: missing (run: python unified_embeddings.py migrate)")
+            return
+        cursor.execute(f"SELECT count(*), count(*) FILTER (WHERE cardinality(datasets) > 1) FROM {target}")
+        rows, shared = cursor.fetchone()
+        cursor.execute("SELECT pg_total_relation_size(%s)", (target,))
+        size_mb = cursor.fetchone()[0] / (1024 * 1024)
+        print(f"{target}: {rows} rows ({shared} shared by several datasets), {size_mb:.1f} MB with indexes")
+        for dataset in LEGACY_TABLES:
+            cursor.execute(f"SELECT count(*) FROM {target} WHERE {dataset_predicate(dataset)}")
+            print(f"  {dataset}: {cursor.fetchone()[0]} rows")
+
+        legacy_mb = 0.0
+        for legacy_table in LEGACY_TABLES.values():
+            if _table_exists(cursor, legacy_table):
+                cursor.execute("SELECT pg_total_relation_size(%s)", (legacy_table,))
+                legacy_mb += cursor.fetchone()[0] / (1024 * 1024)
+        if legacy_mb:
+            print(f"legacy tables: {legacy_mb:.1f} MB with indexes")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the unified document embeddings table")
+    parser.add_argument("command", choices=["migrate", "status"])
+    parser.add_argument("--target", default=UNIFIED_TABLE, help="Unified table name")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--maintenance-work-mem", help="maintenance_work_mem for the index builds, e.g. 2GB")
+    parser.add_argument("--drop-legacy", action="store_true",
+                        help="Drop the per-dataset tables after a successful migration")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print_status(args.target)
+    else:
+        migrate(args.target, method=args.method, maintenance_work_mem=args.maintenance_work_mem,
+                drop_legacy=args.drop_legacy)
@@ -7,6 +7,11 @@ import argparse
 from tqdm import tqdm
 from embedd_class import customembedding
 from db_utils import connect_db
+from pgvector_indexes import (build_hash_indexes, build_vector_index, lexical_statements, short_embedding_statements,
+                              QUANTIZATIONS, VECTOR_QUANTIZATION)
+from retrieval_cache import bump_corpus_version
+from unified_embeddings import (UNIFIED_TABLE, LEGACY_TABLES, PARTIAL_INDEX_DATASETS, unified_table_ddl,
+                                unified_index_statements, merge_datasets_sql)
 from psycopg2.extras import execute_values
 
 # Mapping of categories to PDF folder paths.
@@ -88,8 +93,13 @@ def count_nodes(data):
     recursive_count(data)
     return count
 
-def setup_database(table_name):
-    """Initialize the database with the proper schema for vector storage."""
+def setup_database(table_name, dataset=None, quantization="none"):
+    """
+    Initialize the database with the proper schema for vector storage.
+    With a dataset, table_name is the unified table (rows tagged with their datasets).
+    With quantization "matryoshka", the generated embedding_short column is added
+    so every inserted row gets its truncated first-stage vector.
+    """
     conn = connect_db()
     if not conn:
         logger.error("Failed to connect to the database")
@@ -100,6 +110,17 @@ def setup_database(table_name):
         # Create pgvector extension if it doesn't exist
         cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
         
+        if dataset:
+            cursor.execute(unified_table_ddl(table_name))
+            for statement in unified_index_statements(table_name):
+                cursor.execute(statement)
+            if quantization == "matryoshka":
+                for statement in short_embedding_statements(table_name):
+                    cursor.execute(statement)
+            conn.commit()
+            logger.info(f"Database setup completed successfully for unified table {table_name}")
+            return True
+        
         # Create the table for storing documents and embeddings
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS {table_name} (
@@ -126,12 +147,17 @@ def setup_database(table_name):
             )
         """)
         
-        # Create an index for faster vector similarity searches
-        cursor.execute(f"""
-            CREATE INDEX IF NOT EXISTS {table_name}_embedding_idx 
-            ON {table_name} 
-            USING ivfflat (embedding vector_l2_ops)
-        """)
+        # Generated tsvector column and GIN index for the API's hybrid (vector + full-text) search
+        for statement in lexical_statements(table_name):
+            cursor.execute(statement)
+        
+        # Truncated first-stage vectors for Matryoshka search
+        if quantization == "matryoshka":
+            for statement in short_embedding_statements(table_name):
+                cursor.execute(statement)
+        
+        # The vector and KG hash indexes are built after the load (see process_json_file):
+        # an ivfflat index created on an empty table has untrained lists.
         
         conn.commit()
         logger.info(f"Database setup completed successfully for table {table_name}")
@@ -144,8 +170,33 @@ def setup_database(table_name):
         cursor.close()
         conn.close()
 
-def flush_batch(batch_data, table_name, added_ids, added_docs, added_chapters, added_sections, added_subsections):
-    """Flush the current batch of embeddings to PostgreSQL."""
+def update_corpus_version(table_name):
+    """
+    Bump the table's row in corpus_versions so API workers drop retrieval
+    results cached against the previous contents.
+    """
+    conn = connect_db()
+    if not conn:
+        logger.error("Failed to connect to the database to bump the corpus version")
+        return
+    cursor = conn.cursor()
+    try:
+        version = bump_corpus_version(cursor, table_name)
+        conn.commit()
+        logger.info(f"Corpus version for {table_name} is now {version}")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error bumping corpus version for {table_name}: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+def flush_batch(batch_data, table_name, added_ids, added_docs, added_chapters, added_sections, added_subsections,
+                dataset=None):
+    """
+    Embed the queued rows in one batch and flush them to PostgreSQL.
+    With a dataset, rows are tagged with it and existing rows gain the tag.
+    """
     if not batch_data:
         return added_ids, added_docs, added_chapters, added_sections, added_subsections
     
@@ -156,6 +207,17 @@ def flush_batch(batch_data, table_name, added_ids, added_docs, added_chapters, a
     
     cursor = conn.cursor()
     try:
+        # Embed all queued contents (column 1) in one batched call and fill in the embedding column.
+        embeddings = embedding_model.embed_batch([row[1] for row in batch_data])
+        batch_data = [row[:2] + (prepare_embedding(embedding),) + row[3:] for row, embedding in zip(batch_data, embeddings)]
+        
+        datasets_column, datasets_update, changed = "", "", f"{table_name}.content != EXCLUDED.content"
+        if dataset:
+            batch_data = [row + ([dataset],) for row in batch_data]
+            datasets_column = ", datasets"
+            datasets_update = f",\n                {merge_datasets_sql(table_name)}"
+            changed = f"({changed} OR NOT {table_name}.datasets @> EXCLUDED.datasets)"
+        
         # Insert data using execute_values for efficiency
         # Use ON CONFLICT to update records if they already exist and content is different
         execute_values(cursor, f"""
@@ -164,7 +226,7 @@ def flush_batch(batch_data, table_name, added_ids, added_docs, added_chapters, a
                 category, pdf_path, hash_chapter, chapter_title, chapter_number,
                 hash_section, section_title, section_number, section_page_number,
                 hash_subsection, subsection_title, subsection_number, 
-                subsection_page_number, composite_id
+                subsection_page_number, composite_id{datasets_column}
             ) VALUES %s
             ON CONFLICT (id) DO UPDATE SET
                 content = EXCLUDED.content,
@@ -179,8 +241,8 @@ def flush_batch(batch_data, table_name, added_ids, added_docs, added_chapters, a
                 section_page_number = COALESCE(EXCLUDED.section_page_number, {table_name}.section_page_number),
                 subsection_title = COALESCE(EXCLUDED.subsection_title, {table_name}.subsection_title),
                 subsection_number = COALESCE(EXCLUDED.subsection_number, {table_name}.subsection_number),
-                subsection_page_number = COALESCE(EXCLUDED.subsection_page_number, {table_name}.subsection_page_number)
-            WHERE {table_name}.content != EXCLUDED.content
+                subsection_page_number = COALESCE(EXCLUDED.subsection_page_number, {table_name}.subsection_page_number){datasets_update}
+            WHERE {changed}
         """, batch_data)
         
         conn.commit()
@@ -212,12 +274,13 @@ def flush_batch(batch_data, table_name, added_ids, added_docs, added_chapters, a
 
 def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, json_chapters, json_sections, json_subsections,
                 added_ids, added_docs, added_chapters, added_sections, added_subsections,
-                composite_id_occurrences, cur_doc=None, cur_chapter=None, cur_section=None, parent_meta=None):
+                composite_id_occurrences, cur_doc=None, cur_chapter=None, cur_section=None, parent_meta=None,
+                dataset=None):
     """
     Recursively traverse the JSON structure.
     When a node contains a hash, build a composite ID, ensure uniqueness,
     and enrich metadata (ensuring 'hash_document' is always present).
-    Queue the node for embedding and update the global progress bar.
+    Queue the node for embedding (done per batch in flush_batch) and update the global progress bar.
     """
     if parent_meta is None:
         parent_meta = {}
@@ -270,14 +333,11 @@ def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, js
             doc_title = node.get('title', '')
             content = f"{category_prefix}Document: {doc_title}\n\n{raw_content}"
             
-            # Generate embedding
-            embedding = embedding_model(content)
-            
             # Prepare for batch insertion
             batch_data.append((
                 unique_id, 
                 content, 
-                prepare_embedding(embedding),  # Use helper function to handle different embedding types
+                None,  # embedding, computed for the whole batch in flush_batch
                 local_meta.get("type"),
                 local_meta.get("hash_document"),
                 local_meta.get("document_title"),
@@ -333,14 +393,11 @@ def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, js
             chapter_title = node.get('title', '')
             content = f"{category_prefix}Document: {doc_title}\nChapter: {chapter_title}\n\n{raw_content}"
             
-            # Generate embedding
-            embedding = embedding_model(content)
-            
             # Prepare for batch insertion
             batch_data.append((
                 unique_id, 
                 content, 
-                prepare_embedding(embedding),
+                None,  # embedding, computed for the whole batch in flush_batch
                 local_meta.get("type"),
                 local_meta.get("hash_document"),
                 local_meta.get("document_title"),
@@ -397,14 +454,11 @@ def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, js
             section_title = node.get('title', '')
             content = f"{category_prefix}Document: {doc_title}\nChapter: {chapter_title}\nSection: {section_title}\n\n{raw_content}"
             
-            # Generate embedding
-            embedding = embedding_model(content)
-            
             # Prepare for batch insertion
             batch_data.append((
                 unique_id, 
                 content, 
-                prepare_embedding(embedding),
+                None,  # embedding, computed for the whole batch in flush_batch
                 local_meta.get("type"),
                 local_meta.get("hash_document"),
                 local_meta.get("document_title"),
@@ -462,14 +516,11 @@ def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, js
             subsection_title = node.get('title', '')
             content = f"{category_prefix}Document: {doc_title}\nChapter: {chapter_title}\nSection: {section_title}\nSubsection: {subsection_title}\n\n{raw_content}"
             
-            # Generate embedding
-            embedding = embedding_model(content)
-            
             # Prepare for batch insertion
             batch_data.append((
                 unique_id, 
                 content, 
-                prepare_embedding(embedding),
+                None,  # embedding, computed for the whole batch in flush_batch
                 local_meta.get("type"),
                 local_meta.get("hash_document"),
                 local_meta.get("document_title"),
@@ -493,7 +544,8 @@ def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, js
 
         if len(batch_data) >= BATCH_SIZE:
             added_ids, added_docs, added_chapters, added_sections, added_subsections = flush_batch(
-                batch_data, table_name, added_ids, added_docs, added_chapters, added_sections, added_subsections
+                batch_data, table_name, added_ids, added_docs, added_chapters, added_sections, added_subsections,
+                dataset=dataset
             )
             batch_data.clear()
             
@@ -502,17 +554,24 @@ def process_node(node, pbar, batch_data, table_name, all_json_ids, json_docs, js
             if isinstance(value, (dict, list)):
                 process_node(value, pbar, batch_data, table_name, all_json_ids, json_docs, json_chapters, json_sections, json_subsections,
                             added_ids, added_docs, added_chapters, added_sections, added_subsections,
-                            composite_id_occurrences, cur_doc, cur_chapter, cur_section, local_meta)
+                            composite_id_occurrences, cur_doc, cur_chapter, cur_section, local_meta, dataset=dataset)
     elif isinstance(node, list):
         for item in node:
             process_node(item, pbar, batch_data, table_name, all_json_ids, json_docs, json_chapters, json_sections, json_subsections,
                         added_ids, added_docs, added_chapters, added_sections, added_subsections, 
-                        composite_id_occurrences, cur_doc, cur_chapter, cur_section, parent_meta)
+                        composite_id_occurrences, cur_doc, cur_chapter, cur_section, parent_meta, dataset=dataset)
             
     return batch_data
 
-def process_json_file(json_file_path, table_name):
-    """Process a single JSON file and store embeddings in the specified table."""
+def process_json_file(json_file_path, table_name, index_method="hnsw", rebuild_index=False, dataset=None,
+                      quantization="none"):
+    """
+    Process a single JSON file and store embeddings in the specified table,
+    then build the table's vector index ("hnsw", "ivfflat" or None to skip).
+    With a dataset, table_name is the unified table and the rows are tagged with
+    the dataset; the dataset's partial index is built as well. quantization selects
+    a full ("none"), "halfvec" or "binary" vector index; the table always keeps float32.
+    """
     # Sets to track composite hash IDs found in the JSON.
     all_json_ids = set()
     json_docs = set()
@@ -537,7 +596,7 @@ def process_json_file(json_file_path, table_name):
     logger.info(f"Target table: {table_name}")
     
     # Setup the database first
-    if not setup_database(table_name):
+    if not setup_database(table_name, dataset=dataset, quantization=quantization):
         logger.error("Database setup failed. Exiting.")
         return
         
@@ -559,7 +618,8 @@ def process_json_file(json_file_path, table_name):
         if isinstance(first_val, dict) and first_val.get("hash_document", "").strip():
             logger.info("Detected top-level document structure.")
             batch_data = process_node(data, pbar, batch_data, table_name, all_json_ids, json_docs, json_chapters, json_sections, json_subsections,
-                                   added_ids, added_docs, added_chapters, added_sections, added_subsections, composite_id_occurrences)
+                                   added_ids, added_docs, added_chapters, added_sections, added_subsections, composite_id_occurrences,
+                                   dataset=dataset)
         else:
             logger.info("Detected top-level category structure.")
             for category, docs in data.items():
@@ -570,7 +630,8 @@ def process_json_file(json_file_path, table_name):
                             if "title" in doc_val:
                                 doc_val["pdf_path"] = construct_pdf_path(category, doc_val["title"])
                             batch_data = process_node(doc_val, pbar, batch_data, table_name, all_json_ids, json_docs, json_chapters, json_sections, json_subsections,
-                                                   added_ids, added_docs, added_chapters, added_sections, added_subsections, composite_id_occurrences)
+                                                   added_ids, added_docs, added_chapters, added_sections, added_subsections, composite_id_occurrences,
+                                   dataset=dataset)
                 elif isinstance(docs, list):
                     for doc_val in docs:
                         if isinstance(doc_val, dict):
@@ -578,16 +639,31 @@ def process_json_file(json_file_path, table_name):
                             if "title" in doc_val:
                                 doc_val["pdf_path"] = construct_pdf_path(category, doc_val["title"])
                             batch_data = process_node(doc_val, pbar, batch_data, table_name, all_json_ids, json_docs, json_chapters, json_sections, json_subsections,
-                                                   added_ids, added_docs, added_chapters, added_sections, added_subsections, composite_id_occurrences)
+                                                   added_ids, added_docs, added_chapters, added_sections, added_subsections, composite_id_occurrences,
+                                   dataset=dataset)
     # Flush any remaining embeddings
     if batch_data:
         added_ids, added_docs, added_chapters, added_sections, added_subsections = flush_batch(
-            batch_data, table_name, added_ids, added_docs, added_chapters, added_sections, added_subsections
+            batch_data, table_name, added_ids, added_docs, added_chapters, added_sections, added_subsections,
+            dataset=dataset
         )
         batch_data.clear()
         
     pbar.close()
 
+    # Indexes for the API's KG hash filter, built concurrently so the table stays writable.
+    build_hash_indexes(table_name)
+
+    # Build the vector index now that the table holds its rows.
+    if index_method:
+        build_vector_index(table_name, method=index_method, rebuild=rebuild_index, quantization=quantization)
+        if dataset in PARTIAL_INDEX_DATASETS:
+            build_vector_index(table_name, method=index_method, rebuild=rebuild_index, dataset=dataset,
+                               quantization=quantization)
+
+    # Invalidate API retrieval caches for this table.
+    update_corpus_version(table_name)
+
     logger.info(f"Finished embedding nodes from {json_file_path} into PostgreSQL table {table_name}.")
     logger.info(f"Total unique composite IDs extracted from JSON: {len(all_json_ids)}")
     logger.info(f"Total unique composite IDs added to PostgreSQL: {len(added_ids)}")
@@ -645,6 +721,16 @@ if __name__ == "__main__":
     parser.add_argument("--json_files", nargs="+", help="Path(s) to JSON file(s)")
     parser.add_argument("--table_names", nargs="+", help="PostgreSQL table name(s) to use")
     parser.add_argument("--config", help="Path to JSON config file with mapping of JSON files to table names")
+    parser.add_argument("--index-method", choices=["hnsw", "ivfflat", "none"], default="hnsw",
+                        help="Vector index to build after loading each table (default: hnsw)")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="Drop and rebuild an existing vector index after loading")
+    parser.add_argument("--quantization", choices=list(QUANTIZATIONS), default=VECTOR_QUANTIZATION,
+                        help="Build a halfvec, binary-quantized or truncated (matryoshka) first-stage vector index, "
+                             "rescored at query time")
+    parser.add_argument("--unified", action="store_true",
+                        help=f"Load into the unified table ({UNIFIED_TABLE}), tagging rows with the dataset "
+                             f"of their per-dataset table name")
     
     args = parser.parse_args()
     
@@ -674,8 +760,17 @@ if __name__ == "__main__":
             logger.info(f"  - {json_file} -> {table_name}")
     
     # Process each JSON file in sequence
+    dataset_for_table = {table: dataset for dataset, table in LEGACY_TABLES.items()}
     for json_file, table_name in json_table_mapping.items():
-        process_json_file(json_file, table_name)
+        dataset = None
+        if args.unified:
+            if table_name not in dataset_for_table:
+                logger.error(f"No dataset is defined for table {table_name}; expected one of {list(dataset_for_table)}")
+                exit(1)
+            dataset, table_name = dataset_for_table[table_name], UNIFIED_TABLE
+        process_json_file(json_file, table_name,
+                          index_method=None if args.index_method == "none" else args.index_method,
+                          rebuild_index=args.rebuild_index, dataset=dataset, quantization=args.quantization)
     
     logger.info("All JSON files processed successfully")
     
@@ -701,7 +796,7 @@ if __name__ == "__main__":
     
     # Verify expected hashes in each table
     logger.info("Verifying expected hash documents in all tables...")
-    for table_name in json_table_mapping.values():
+    for table_name in ([UNIFIED_TABLE] if args.unified else json_table_mapping.values()):
         logger.info(f"Verifying hash documents in table {table_name}")
         verify_hash_documents(table_name, expected_hash_docs)
 
@@ -0,0 +1,81 @@
+"""
+Compare SIMILAR_TO construction: the former pairwise cosine_similarity loop
+against the blocked matrix product in similarity.py.
+
+Embeddings are synthetic clusters (so a 0.8 threshold finds pairs), or loaded
+from a .npy file of node embeddings. The loop is only run up to --loop-max
+nodes because it is quadratic in Python calls.
+
+Usage:
+    python benchmark_similarity.py [--nodes 2000 5000 20000] [--dims 1024] [--threshold 0.8]
+                                   [--embeddings sections.npy] [--loop-max 2000] [--block 1024]
+"""
+import argparse
+import time
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from similarity import similar_pairs
+
+
+def loop_pairs(node_embeddings, threshold):
+    """The previous KnowledgeGraph.find_similar_nodes: one cosine_similarity call per ordered pair."""
+    pairs = []
+    items = list(node_embeddings.items())
+    for node1, emb1 in items:
+        for node2, emb2 in items:
+            if node1 == node2:
+                continue
+            similarity = cosine_similarity([emb1], [emb2])[0][0]
+            if similarity >= threshold:
+                pairs.append((node1, node2, similarity))
+    return pairs
+
+
+def synthetic_embeddings(nodes, dims, clusters=None, noise=0.35, seed=0):
+    rng = np.random.default_rng(seed)
+    clusters = clusters or max(1, nodes // 20)
+    centres = rng.normal(size=(clusters, dims)).astype(np.float32)
+    assignment = rng.integers(0, clusters, size=nodes)
+    return centres[assignment] + noise * rng.normal(size=(nodes, dims)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SIMILAR_TO edge construction")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--dims", type=int, default=1024)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--embeddings", help=".npy file of node embeddings (rows are nodes)")
+    parser.add_argument("--loop-max", type=int, default=2000, help="Largest level the pairwise loop is run on")
+    parser.add_argument("--block", type=int, help="Rows per block of the matrix product")
+    args = parser.parse_args()
+
+    loaded = np.load(args.embeddings, mmap_mode="r") if args.embeddings else None
+    print(f"{'nodes':>8} {'pairs':>10} {'loop s':>10} {'blocked s':>10} {'speedup':>8} {'same edges':>10}")
+    for nodes in args.nodes:
+        if loaded is not None:
+            matrix = np.asarray(loaded[:nodes], dtype=np.float32)
+            nodes = matrix.shape[0]
+        else:
+            matrix = synthetic_embeddings(nodes, args.dims)
+        node_embeddings = {f"n{i}": matrix[i] for i in range(nodes)}
+
+        start = time.perf_counter()
+        blocked = similar_pairs(node_embeddings, threshold=args.threshold, top_k=0, block_size=args.block,
+                                approximate=False)
+        blocked_s = time.perf_counter() - start
+
+        if nodes <= args.loop_max:
+            start = time.perf_counter()
+            reference = loop_pairs(node_embeddings, args.threshold)
+            loop_s = time.perf_counter() - start
+            same = {(a, b) for a, b, _ in reference} == {(a, b) for a, b, _ in blocked}
+            print(f"{nodes:>8} {len(blocked):>10} {loop_s:>10.2f} {blocked_s:>10.2f} "
+                  f"{loop_s / blocked_s:>7.0f}x {str(same):>10}")
+        else:
+            print(f"{nodes:>8} {len(blocked):>10} {'-':>10} {blocked_s:>10.2f} {'-':>8} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
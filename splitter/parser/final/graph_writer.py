@@ -0,0 +1,135 @@
+import os
+import re
+import time
+from collections import defaultdict
+
+# Rows sent per UNWIND transaction.
+KG_BATCH_SIZE = int(os.environ.get("KG_BATCH_SIZE", 1000))
+
+NODE_LABELS = ("Document", "Chapter", "Section", "Subsection")
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _identifier(name):
+    # Labels and relationship types cannot be query parameters; only plain identifiers are allowed.
+    if not _IDENTIFIER.match(name):
+        raise ValueError(f"Invalid label or relationship type: {name!r}")
+    return name
+
+
+class GraphBatchWriter:
+    """
+    Buffers knowledge-graph nodes and relationships and writes them with
+    UNWIND in transactions of `batch_size` rows.
+
+    Nodes are merged on (label, hash), which is backed by a uniqueness
+    constraint (see ensure_schema), and relationships find their endpoints
+    by the same labeled hash lookup. Whenever a buffer is full, all pending
+    nodes are written before any pending relationship, so relationships
+    always find their endpoints. Call flush() (or use the writer as a
+    context manager) to write the remainder.
+
+    Args:
+        driver: A neo4j Driver.
+        batch_size (int): Rows per transaction.
+        progress (bool): Print throughput after each flush.
+    """
+
+    def __init__(self, driver, batch_size=KG_BATCH_SIZE, progress=True):
+        self.driver = driver
+        self.batch_size = batch_size
+        self.progress = progress
+        self._nodes = defaultdict(list)  # label -> [{"hash", "properties"}]
+        self._edges = defaultdict(list)  # (from label, relation, to label) -> [{"from", "to", "properties"}]
+        self._pending = 0
+        self.nodes_written = 0
+        self.edges_written = 0
+        self.transactions = 0
+        self.write_seconds = 0.0
+        self._started = time.perf_counter()
+
+    def ensure_schema(self, labels=NODE_LABELS):
+        """
+        Unique constraint on hash for every label (which also indexes it). When an
+        existing graph already holds duplicate hashes, a plain index is created instead.
+        """
+        with self.driver.session() as session:
+            for label in labels:
+                label = _identifier(label)
+                try:
+                    session.run(f"CREATE CONSTRAINT {label.lower()}_hash IF NOT EXISTS "
+                                f"FOR (n:{label}) REQUIRE n.hash IS UNIQUE").consume()
+                except Exception as e:
+                    print(f"Warning: Could not create a unique constraint on :{label}(hash) ({e}); "
+                          f"creating an index instead.")
+                    session.run(f"CREATE INDEX {label.lower()}_hash_idx IF NOT EXISTS "
+                                f"FOR (n:{label}) ON (n.hash)").consume()
+
+    def add_node(self, label, properties):
+        """Queue a node; properties must contain its "hash"."""
+        self._nodes[_identifier(label)].append({"hash": properties["hash"], "properties": properties})
+        self._added()
+
+    def add_relationship(self, from_label, from_hash, relation, to_label, to_hash, properties=None):
+        """Queue a relationship between two nodes identified by label and hash."""
+        key = (_identifier(from_label), _identifier(relation), _identifier(to_label))
+        self._edges[key].append({"from": from_hash, "to": to_hash, "properties": properties or {}})
+        self._added()
+
+    def _added(self):
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def _write(self, query, rows):
+        start = time.perf_counter()
+        with self.driver.session() as session:
+            session.execute_write(lambda tx: tx.run(query, rows=rows).consume())
+        self.write_seconds += time.perf_counter() - start
+        self.transactions += 1
+
+    def flush(self):
+        """Write all queued nodes, then all queued relationships."""
+        if not self._pending:
+            return
+        for label, rows in self._nodes.items():
+            query = f"""
+            UNWIND $rows AS row
+            MERGE (n:{label} {{hash: row.hash}})
+            SET n += row.properties
+            """
+            for start in range(0, len(rows), self.batch_size):
+                self._write(query, rows[start:start + self.batch_size])
+            self.nodes_written += len(rows)
+        for (from_label, relation, to_label), rows in self._edges.items():
+            query = f"""
+            UNWIND $rows AS row
+            MATCH (a:{from_label} {{hash: row.from}})
+            MATCH (b:{to_label} {{hash: row.to}})
+            MERGE (a)-[r:{relation}]->(b)
+            SET r += row.properties
+            """
+            for start in range(0, len(rows), self.batch_size):
+                self._write(query, rows[start:start + self.batch_size])
+            self.edges_written += len(rows)
+        self._nodes.clear()
+        self._edges.clear()
+        self._pending = 0
+        if self.progress:
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self._started
+        written = self.nodes_written + self.edges_written
+        print(f"Neo4j: {self.nodes_written} nodes, {self.edges_written} relationships in "
+              f"{self.transactions} transactions, {elapsed:.1f}s "
+              f"({written / elapsed if elapsed else 0:.0f} rows/s, {self.write_seconds:.1f}s writing)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
@@ -2,52 +2,47 @@ import os
 import json
 from embedd_class import customembedding
 from neo4j import GraphDatabase
-from sklearn.metrics.pairwise import cosine_similarity
 from tqdm import tqdm
+from graph_writer import GraphBatchWriter, KG_BATCH_SIZE
+from similarity import similar_pairs
 
 # Load embedding model
 embedding_function = customembedding("mixedbread-ai/mxbai-embed-large-v1")
 
 class KnowledgeGraph:
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, batch_size=KG_BATCH_SIZE):
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        # Nodes and relationships are buffered and written with UNWIND (see graph_writer.py).
+        self.writer = GraphBatchWriter(self.driver, batch_size=batch_size)
 
     def close(self):
+        self.writer.flush()
         self.driver.close()
 
     def add_node(self, label, properties):
-        query = f"""
-        MERGE (n:{label} {{title: $title}})
-        SET n.hash = $hash, n += $properties
-        """
-        with self.driver.session() as session:
-            session.run(query, title=properties["title"], hash=properties["hash"], properties=properties)
-
-    def add_relationship(self, node1_title, node2_title, relation, content=None, score=None):
-        query = f"""
-        MATCH (a {{title: $node1_title}}), (b {{title: $node2_title}})
-        MERGE (a)-[r:{relation}]->(b)
-        """
-        params = {"node1_title": node1_title, "node2_title": node2_title}
+        """Queue a node, merged on (label, hash)."""
+        self.writer.add_node(label, properties)
+
+    def add_relationship(self, node1_label, node1_hash, node2_label, node2_hash, relation, content=None, score=None):
+        """Queue a relationship between two nodes identified by label and hash."""
+        properties = {}
         if score is not None:
-            query += " SET r.score = $score"
-            params["score"] = score
+            properties["score"] = float(score)
         if content is not None:
-            query += " SET r.content = $content"
-            params["content"] = content
-        with self.driver.session() as session:
-            session.run(query, **params)
+            properties["content"] = content
+        self.writer.add_relationship(node1_label, node1_hash, relation, node2_label, node2_hash, properties)
 
-    def compute_similarity(self, emb1, emb2):
-        return cosine_similarity([emb1], [emb2])[0][0]
+    def bump_graph_version(self):
+        """Mark the graph as changed so the API drops its cached KG lookups."""
+        with self.driver.session() as session:
+            session.run("""
+                MERGE (m:GraphMeta {name: 'graph'})
+                SET m.version = coalesce(m.version, 0) + 1, m.updated_at = datetime()
+            """)
 
     def find_similar_nodes(self, node_list, threshold=0.8):
-        similar_pairs = []
-        for (node1, emb1), (node2, emb2) in [(n1, n2) for n1 in node_list.items() for n2 in node_list.items() if n1 != n2]:
-            similarity = self.compute_similarity(emb1, emb2)
-            if similarity >= threshold:
-                similar_pairs.append((node1, node2, similarity))
-        return similar_pairs
+        # Blocked matrix product over normalized embeddings instead of one call per pair.
+        return similar_pairs(node_list, threshold=threshold)
 
     def process_json(self, json_path):
         with open(json_path, "r") as f:
@@ -58,6 +53,8 @@ class KnowledgeGraph:
         section_embeddings = {}
         subsection_embeddings = {}
 
+        self.writer.ensure_schema()
+
         # Count total number of documents for progress display.
         total_docs = sum(len(doc_files) for doc_files in data.values())
         pbar = tqdm(total=total_docs, desc="Inserting Documents", unit="doc")
@@ -66,19 +63,22 @@ class KnowledgeGraph:
         for doc_type, doc_files in data.items():
             for doc_name, doc_data in doc_files.items():
                 doc_title = doc_data["title"]
-                # Check if the document already exists:
+                doc_hash = doc_data["hash_document"]
+                # Check if the document already exists (indexed lookup on hash):
                 with self.driver.session() as session:
-                    result = session.run("MATCH (n:Document {title: $title}) RETURN n LIMIT 1", title=doc_title)
+                    result = session.run("MATCH (n:Document {hash: $hash}) RETURN n LIMIT 1", hash=doc_hash)
                     if result.single() is not None:
                         print(f"Document '{doc_title}' already exists. Skipping insertion.")
                         pbar.update(1)
                         continue
 
-                doc_hash = doc_data["hash_document"]
+                # Texts of this document's nodes, embedded in one batched call below:
+                # (level embeddings dict, node hash, text)
+                pending = []
+
                 # Combine all chapter contents for document-level text.
                 doc_text = " ".join(chap["content"] for chap in doc_data.get("chapters", []))
-                doc_embedding = embedding_function.embed_query(doc_text)
-                document_embeddings[doc_title] = doc_embedding
+                pending.append((document_embeddings, doc_hash, doc_text))
 
                 self.add_node("Document", {"title": doc_title, "hash": doc_hash, "type": doc_type})
 
@@ -86,11 +86,10 @@ class KnowledgeGraph:
                     chap_hash = chapter["hash_chapter"]
                     chap_title = chapter["title"]
                     chap_text = chapter["content"]
-                    chap_embedding = embedding_function.embed_query(chap_text)
-                    chapter_embeddings[chap_title] = chap_embedding
+                    pending.append((chapter_embeddings, chap_hash, chap_text))
 
                     self.add_node("Chapter", {"title": chap_title, "hash": chap_hash, "content": chap_text})
-                    self.add_relationship(doc_title, chap_title, "CONTAINS", content=chap_text)
+                    self.add_relationship("Document", doc_hash, "Chapter", chap_hash, "CONTAINS", content=chap_text)
 
                     for section in chapter.get("sections", []):
                         sec_hash = section.get("hash_section")
@@ -99,11 +98,10 @@ class KnowledgeGraph:
                             continue
                         sec_title = section["title"]
                         sec_text = section["content"]
-                        sec_embedding = embedding_function.embed_query(sec_text)
-                        section_embeddings[sec_title] = sec_embedding
+                        pending.append((section_embeddings, sec_hash, sec_text))
 
                         self.add_node("Section", {"title": sec_title, "hash": sec_hash, "content": sec_text})
-                        self.add_relationship(chap_title, sec_title, "CONTAINS", content=sec_text)
+                        self.add_relationship("Chapter", chap_hash, "Section", sec_hash, "CONTAINS", content=sec_text)
 
                         for subsection in section.get("sublevels", []):
                             sub_hash = subsection.get("hash_subsection")
@@ -112,24 +110,26 @@ class KnowledgeGraph:
                                 continue
                             sub_title = subsection["title"]
                             sub_text = subsection["content"]
-                            sub_embedding = embedding_function.embed_query(sub_text)
-                            subsection_embeddings[sub_title] = sub_embedding
+                            pending.append((subsection_embeddings, sub_hash, sub_text))
 
                             self.add_node("Subsection", {"title": sub_title, "hash": sub_hash, "content": sub_text})
-                            self.add_relationship(sec_title, sub_title, "CONTAINS", content=sub_text)
+                            self.add_relationship("Section", sec_hash, "Subsection", sub_hash, "CONTAINS",
+                                                  content=sub_text)
+
+                vectors = embedding_function.embed_documents([text for _, _, text in pending])
+                for (level_embeddings, node_hash, _), vector in zip(pending, vectors):
+                    level_embeddings[node_hash] = vector
                 pbar.update(1)
         pbar.close()
 
-        # Compute SIMILAR_TO relationships
-        for d1, d2, score in self.find_similar_nodes(document_embeddings, threshold=0.8):
-            self.add_relationship(d1, d2, "SIMILAR_TO", score=score)
-        for c1, c2, score in self.find_similar_nodes(chapter_embeddings, threshold=0.8):
-            self.add_relationship(c1, c2, "SIMILAR_TO", score=score)
-        for s1, s2, score in self.find_similar_nodes(section_embeddings, threshold=0.8):
-            self.add_relationship(s1, s2, "SIMILAR_TO", score=score)
-        for sub1, sub2, score in self.find_similar_nodes(subsection_embeddings, threshold=0.8):
-            self.add_relationship(sub1, sub2, "SIMILAR_TO", score=score)
+        # Compute SIMILAR_TO relationships (embeddings are keyed by node hash)
+        for label, embeddings in (("Document", document_embeddings), ("Chapter", chapter_embeddings),
+                                  ("Section", section_embeddings), ("Subsection", subsection_embeddings)):
+            for h1, h2, score in self.find_similar_nodes(embeddings, threshold=0.8):
+                self.add_relationship(label, h1, label, h2, "SIMILAR_TO", score=score)
 
+        self.writer.flush()
+        self.bump_graph_version()
         print("Neo4j knowledge graph successfully updated.")
 
 # Example usage:
@@ -0,0 +1,113 @@
+import os
+import time
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # optional: approximate neighbours for very large levels
+    faiss = None
+
+# Rows of the similarity matrix computed at once (memory: block x n floats).
+KG_SIMILARITY_BLOCK = int(os.environ.get("KG_SIMILARITY_BLOCK", 1024))
+# Neighbours kept per node (0: every node above the threshold).
+KG_SIMILAR_TOP_K = int(os.environ.get("KG_SIMILAR_TOP_K", 0))
+# Levels with more nodes than this use faiss HNSW when it is installed (0: never).
+KG_SIMILARITY_ANN_MIN_NODES = int(os.environ.get("KG_SIMILARITY_ANN_MIN_NODES", 200000))
+# Neighbours searched per node by the approximate index.
+KG_SIMILARITY_ANN_K = int(os.environ.get("KG_SIMILARITY_ANN_K", 50))
+
+
+def normalized_matrix(embeddings):
+    """float32 matrix of L2-normalized rows, so a dot product is the cosine similarity."""
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _exact_pairs(matrix, threshold, top_k, block_size):
+    """(i, j, similarity) with i < j, each unordered pair once."""
+    n = matrix.shape[0]
+    found = {}
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        if top_k:
+            # Whole rows: a node's top-k can be anywhere in the matrix.
+            sims = matrix[start:stop] @ matrix.T
+            sims[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+            k = min(top_k, n - 1)
+            candidates = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            rows = np.repeat(np.arange(start, stop), k)
+            cols = candidates.ravel()
+            values = sims[rows - start, cols]
+        else:
+            # Upper triangle only: columns from the block's first row onwards.
+            sims = matrix[start:stop] @ matrix[start:].T
+            local_rows, local_cols = np.nonzero(sims >= threshold)
+            rows, cols = local_rows + start, local_cols + start
+            keep = cols > rows
+            rows, cols, values = rows[keep], cols[keep], sims[local_rows[keep], local_cols[keep]]
+        above = values >= threshold
+        for i, j, value in zip(rows[above], cols[above], values[above]):
+            found[(min(i, j), max(i, j))] = float(value)
+    return found
+
+
+def _approximate_pairs(matrix, threshold, top_k):
+    """Same as _exact_pairs using a faiss HNSW inner-product index (neighbours limited to k)."""
+    n, dims = matrix.shape
+    index = faiss.IndexHNSWFlat(dims, 32, faiss.METRIC_INNER_PRODUCT)
+    index.add(matrix)
+    k = min((top_k or KG_SIMILARITY_ANN_K) + 1, n)
+    sims, neighbours = index.search(matrix, k)
+    found = {}
+    for i in range(n):
+        for j, value in zip(neighbours[i], sims[i]):
+            if j < 0 or j == i or value < threshold:
+                continue
+            found[(min(i, int(j)), max(i, int(j)))] = float(value)
+    return found
+
+
+def similar_pairs(node_embeddings, threshold=0.8, top_k=None, block_size=None, approximate=None):
+    """
+    Pairs of nodes whose embeddings have a cosine similarity of at least threshold.
+
+    The similarity matrix is computed in row blocks of normalized embeddings, so
+    memory stays at block_size x n floats. Each unordered pair is found once and
+    returned in both directions, like the former pairwise loop.
+
+    Args:
+        node_embeddings (dict): Node key -> embedding.
+        threshold (float): Minimum cosine similarity.
+        top_k (int): Keep a pair only when one node is among the other's top_k neighbours
+                     (default KG_SIMILAR_TOP_K; 0 or None keeps every pair above threshold).
+        block_size (int): Rows per block (default KG_SIMILARITY_BLOCK).
+        approximate (bool): Use faiss HNSW (default: when installed and the level has more
+                            than KG_SIMILARITY_ANN_MIN_NODES nodes).
+
+    Returns:
+        List[Tuple[key, key, float]]: (node1, node2, similarity), both orders of every pair.
+    """
+    keys = list(node_embeddings)
+    if len(keys) < 2:
+        return []
+    matrix = normalized_matrix([node_embeddings[key] for key in keys])
+    top_k = KG_SIMILAR_TOP_K if top_k is None else top_k
+    if approximate is None:
+        approximate = (faiss is not None and KG_SIMILARITY_ANN_MIN_NODES > 0
+                       and len(keys) > KG_SIMILARITY_ANN_MIN_NODES)
+
+    start = time.perf_counter()
+    if approximate:
+        found = _approximate_pairs(matrix, threshold, top_k)
+    else:
+        found = _exact_pairs(matrix, threshold, top_k, block_size or KG_SIMILARITY_BLOCK)
+    print(f"SIMILAR_TO: {len(found)} pairs among {len(keys)} nodes in {time.perf_counter() - start:.2f}s "
+          f"({'approximate' if approximate else 'exact'})")
+
+    pairs = []
+    for (i, j), value in sorted(found.items()):
+        pairs.append((keys[i], keys[j], value))
+        pairs.append((keys[j], keys[i], value))
+    return pairs